@@ -0,0 +1,74 @@
+""" Measure how parallel depfile parsing scales with the number of jobs.
+
+    usage: python bench_depfile_parse.py [num depfiles] [headers per depfile]
+"""
+
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append('..')
+
+from doit_helpers import gcc_utils
+
+
+def make_depfiles(path, num_depfiles, headers_per_depfile, num_headers=500):
+    """ Write fake gcc dependency files to path, return their paths """
+    rand = random.Random(0)
+    headers = ['/opt/arduino/hardware/arduino/avr/cores/arduino/h%04d.h' % i
+               for i in range(num_headers)]
+    depfiles = []
+    for i in range(num_depfiles):
+        deps = ['src/dir%d/file%d.cpp' % (i % 20, i)]
+        deps += rand.sample(headers, min(headers_per_depfile, num_headers))
+        depfile = os.path.join(path, 'file%d.cpp.d' % i)
+        with open(depfile, 'w') as outfile:
+            outfile.write('build/obj/file%d.cpp.o: ' % i)
+            outfile.write(' \\\n '.join(deps) + '\n')
+        depfiles.append(depfile)
+    return depfiles
+
+
+def time_parse(depfiles, jobs, repeats=3):
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        gcc_utils.read_dependency_files(depfiles, jobs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    num_depfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    headers_per_depfile = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    job_counts = [1]
+    while job_counts[-1] * 2 <= multiprocessing.cpu_count():
+        job_counts.append(job_counts[-1] * 2)
+    if job_counts[-1] != multiprocessing.cpu_count():
+        job_counts.append(multiprocessing.cpu_count())
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        depfiles = make_depfiles(tmp_dir, num_depfiles, headers_per_depfile)
+        print('%d depfiles, %d headers each, %d cpus' % (
+            num_depfiles, headers_per_depfile, multiprocessing.cpu_count()))
+        serial = None
+        for jobs in job_counts:
+            elapsed = time_parse(depfiles, jobs)
+            if serial is None:
+                serial = elapsed
+            print('jobs: %3d  time: %7.3f s  speedup: %.2fx' % (
+                jobs, elapsed, serial / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+""" Compare the time and peak memory used to generate the tasks of a large
+    project with GccEnv's list and generator APIs.
+
+    Each run is done in a separate process so that peak memory use can be
+    measured. Sources don't need to exist to generate tasks.
+
+    usage: python bench_task_generation.py [num sources]
+"""
+
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.append('..')
+
+from doit_helpers import gcc_utils
+
+
+def make_env(num_sources):
+    env = gcc_utils.GccEnv('build')
+    env.variables['c++ source files'] = [
+        'src/dir%d/file%d.cpp' % (i % 100, i) for i in range(num_sources)]
+    env.variables['c++ header search paths'] = [
+        'include/lib%d' % i for i in range(20)]
+    env.variables['c++ preprocessor defs'] = ['F_CPU=16000000L', 'ARDUINO=105']
+    env.variables['c++ compiler flags'] = ['-c', '-g', '-Os', '-x c++']
+    return env
+
+
+def generate_list(env):
+    """ Hold all tasks, as doit does with get_*_tasks() """
+    tasks = env.get_cpp_compile_tasks()
+    tasks += env.get_link_exe_tasks('prog.exe')
+    return len(tasks)
+
+
+def generate_iter(env):
+    """ Handle tasks one at a time """
+    num_tasks = 0
+    for task in env.iter_cpp_compile_tasks():
+        num_tasks += 1
+    for task in env.iter_link_exe_tasks('prog.exe'):
+        num_tasks += 1
+    return num_tasks
+
+
+def generate_list_eager_digests(env):
+    """ As generate_list, but also calculate every command digest, as was
+        done when tasks were created before digests were deferred
+    """
+    tasks = env.get_cpp_compile_tasks()
+    tasks += env.get_link_exe_tasks('prog.exe')
+    for task in tasks:
+        for checker in task.get('uptodate', []):
+            checker._calc_digest()
+    return len(tasks)
+
+
+MODES = {
+    'list': generate_list,
+    'iter': generate_iter,
+    'list, eager digests': generate_list_eager_digests,
+}
+
+
+def run_mode(mode, num_sources):
+    """ Run in a child process. Print time taken and peak memory. """
+    env = make_env(num_sources)
+    start = time.time()
+    MODES[mode](env)
+    elapsed = time.time() - start
+    # kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%f %d' % (elapsed, peak_rss))
+
+
+def main():
+    num_sources = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print('%d sources' % num_sources)
+    for mode in ['list, eager digests', 'list', 'iter']:
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--child', mode, str(num_sources)])
+        elapsed, peak_rss = output.split()
+        print('%-20s time: %6.3f s  peak rss: %6.1f MB' % (
+            mode, float(elapsed), int(peak_rss) / 1024.0))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        run_mode(sys.argv[2], int(sys.argv[3]))
+    else:
+        main()
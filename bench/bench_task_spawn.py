@@ -0,0 +1,91 @@
+""" Measure the per-task overhead of running compile actions through a
+    shell with a create_folder action, compared to running argument list
+    actions directly in output directories created up front.
+
+    A trivial command stands in for the compiler, so the difference in
+    times is the overhead saved per task.
+
+    usage: python bench_task_spawn.py [num tasks]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from doit.action import CmdAction
+from doit.tools import create_folder
+
+sys.path.append('..')
+
+from doit_helpers import gcc_utils
+
+# does nothing, but accepts compiler arguments. A full path, so the
+# shell can't run it as a builtin.
+STAND_IN_COMPILER = '/bin/true'
+
+
+def get_sources(num_tasks):
+    return ['src/dir%d/file%d.c' % (i % 20, i) for i in range(num_tasks)]
+
+
+def run_shell_tasks(build_dir, sources):
+    """ The old way: create_folder, then a shell command, for each task """
+    for source in sources:
+        obj = os.path.join(build_dir, 'obj', os.path.basename(source) + '.o')
+        create_folder(os.path.dirname(obj))
+        cmd = gcc_utils.get_compile_cmd_str(
+            source, obj, compiler=STAND_IN_COMPILER, flags=['-x c', '-Os'])
+        _execute(CmdAction(cmd, shell=True))
+
+
+def run_argv_tasks(build_dir, sources):
+    """ The new way: create directories once, then run argument lists """
+    obj_dir = os.path.join(build_dir, 'obj')
+    gcc_utils.create_output_dirs([obj_dir], os.path.join(obj_dir, '.dirs_c'))
+    for source in sources:
+        obj = os.path.join(obj_dir, os.path.basename(source) + '.o')
+        cmd = gcc_utils.get_compile_cmd_args(
+            source, obj, compiler=STAND_IN_COMPILER, flags=['-x c', '-Os'])
+        _execute(CmdAction(cmd, shell=False))
+
+
+def time_tasks(run_tasks, sources, repeats=3):
+    best = None
+    for _ in range(repeats):
+        build_dir = tempfile.mkdtemp()
+        try:
+            start = time.time()
+            run_tasks(build_dir, sources)
+            elapsed = time.time() - start
+        finally:
+            shutil.rmtree(build_dir)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    num_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    sources = get_sources(num_tasks)
+
+    shell_time = time_tasks(run_shell_tasks, sources)
+    argv_time = time_tasks(run_argv_tasks, sources)
+    print('%d tasks' % num_tasks)
+    print('shell + create_folder: %7.3f s  %6.2f ms/task' % (
+        shell_time, 1000 * shell_time / num_tasks))
+    print('argv, dirs up front:   %7.3f s  %6.2f ms/task' % (
+        argv_time, 1000 * argv_time / num_tasks))
+    print('saved per task:                   %6.2f ms' % (
+        1000 * (shell_time - argv_time) / num_tasks))
+
+
+def _execute(action):
+    error = action.execute()
+    if error is not None:
+        raise Exception(str(error))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+""" Benchmark the build helpers' hot paths on a synthetic project, and
+    compare the results with a baseline to catch performance regressions.
+
+    Each benchmark is timed in isolation, and the best of several repeats
+    is kept:
+        find                  file_utils.find() of the sources
+        find_files            shutil2.find_files() of the sources
+        read_dependency_file  parse every depfile
+        dependency_dict_cold  get_dependency_dict() with no dependency db
+        dependency_dict_warm  get_dependency_dict() from a saved db
+        task_generation       generate all GccEnv compile and link tasks
+        noop_build            a doit run with everything up to date
+
+    The no-op build runs doit in a subprocess, with a fake compiler, and
+    needs a unix shell.
+
+    usage:
+        python run_benchmarks.py [options] [-o results.json]
+        python run_benchmarks.py [options] --baseline baseline.json
+
+    Exits with status 1 if any benchmark is slower than the baseline by
+    more than its threshold. Run with --help for the options.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+PACKAGE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PACKAGE_PATH)
+
+from doit_helpers import file_utils
+from doit_helpers import gcc_utils
+from doit_helpers import shutil2
+
+import synthetic_project
+
+# fraction a benchmark may be slower than the baseline before it's
+# reported as a regression. Timings of a few milliseconds are noisy.
+DEFAULT_THRESHOLD = 0.25
+
+# slowdowns smaller than this many seconds are never reported, as they're
+# within the timer and scheduling noise
+MIN_REGRESSION = 0.002
+
+RESULTS_VERSION = 1
+
+
+def time_best(func, repeats, setup=None):
+    """ Return the best and mean wall time of repeats calls to func.
+        setup is called before each repeat, and isn't timed.
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times)}
+
+
+def run_benchmarks(project, repeats, noop_build=True):
+    """ Run the benchmarks in the project's directory, return a
+        dictionary of benchmark name : {'best': s, 'mean': s}
+    """
+    results = {}
+    cwd = os.getcwd()
+    os.chdir(project.path)
+    try:
+        patterns = ['*.c', '*.cpp']
+        results['find'] = time_best(
+            lambda: file_utils.find('src', patterns, search_subdirs=True),
+            repeats)
+        results['find_files'] = time_best(
+            lambda: shutil2.find_files('src', patterns, search_subdirs=True),
+            repeats)
+
+        def read_depfiles():
+            for depfile in project.depfiles:
+                gcc_utils.read_dependency_file(depfile)
+        results['read_dependency_file'] = time_best(read_depfiles, repeats)
+
+        db_path = os.path.join('build', gcc_utils.DEPENDENCY_DB_FILENAME)
+
+        def remove_db():
+            if os.path.exists(db_path):
+                os.remove(db_path)
+        results['dependency_dict_cold'] = time_best(
+            lambda: gcc_utils.DependencyDb().get_dependency_dict('build'),
+            repeats, setup=remove_db)
+        gcc_utils.DependencyDb().get_dependency_dict('build')
+        results['dependency_dict_warm'] = time_best(
+            lambda: gcc_utils.DependencyDb().get_dependency_dict('build'),
+            repeats)
+
+        c_sources = [s for s in project.sources if s.endswith('.c')]
+        cpp_sources = [s for s in project.sources if s.endswith('.cpp')]
+
+        def generate_tasks():
+            env = gcc_utils.GccEnv('build')
+            env.variables['c header search paths'] = ['include']
+            env.variables['c++ header search paths'] = ['include']
+            env.variables['c source files'] = c_sources
+            env.variables['c++ source files'] = cpp_sources
+            for tasks in [env.iter_c_compile_tasks(),
+                          env.iter_cpp_compile_tasks(),
+                          env.iter_link_exe_tasks('build/prog.exe')]:
+                for task in tasks:
+                    pass
+        # the process-wide dependency db is loaded once, as in a doit run
+        generate_tasks()
+        results['task_generation'] = time_best(generate_tasks, repeats)
+
+        if noop_build:
+            results['noop_build'] = time_noop_build(project, repeats)
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def time_noop_build(project, repeats):
+    """ Build the project with doit until it's up to date, then time doit
+        runs that have nothing to do
+    """
+    project.write_dodo(PACKAGE_PATH)
+    cmd = [sys.executable, '-m', 'doit', '-f', 'dodo.py']
+
+    def build():
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(cmd, cwd=project.path, stdout=devnull) != 0:
+                raise Exception('doit build of %s failed' % project.path)
+    build()
+    return time_best(build, repeats)
+
+
+def compare(results, baseline, thresholds={}):
+    """ Compare results with baseline results. Return a list of report
+        lines and a list of the names of benchmarks that regressed.
+        thresholds is a dictionary of benchmark name : fraction that
+        overrides DEFAULT_THRESHOLD.
+    """
+    lines = ['%-22s %10s %10s %8s' % ('benchmark', 'baseline', 'now',
+                                      'change')]
+    regressions = []
+    for name in sorted(results):
+        now = results[name]['best']
+        if name not in baseline:
+            lines.append('%-22s %10s %9.4fs %8s' % (name, '-', now, 'new'))
+            continue
+        before = baseline[name]['best']
+        change = (now - before) / before if before > 0 else 0.0
+        flag = ''
+        if change > thresholds.get(name, DEFAULT_THRESHOLD) and \
+                now - before > MIN_REGRESSION:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        lines.append('%-22s %9.4fs %9.4fs %+7.1f%%%s' % (
+            name, before, now, change * 100, flag))
+    return lines, regressions
+
+
+def read_results(path):
+    with open(path) as infile:
+        data = json.load(infile)
+    if data.get('version') != RESULTS_VERSION:
+        raise Exception('%s: unsupported results version' % path)
+    return data
+
+
+def write_results(path, params, results):
+    with open(path, 'w') as outfile:
+        json.dump({
+            'version': RESULTS_VERSION,
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': params,
+            'results': results,
+        }, outfile, indent=1, sort_keys=True)
+
+
+def parse_threshold(value):
+    """ Parse 'name=fraction' """
+    name, _, fraction = value.rpartition('=')
+    if not name:
+        raise argparse.ArgumentTypeError('expected name=fraction: ' + value)
+    return name, float(fraction)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the build helpers on a synthetic project.')
+    parser.add_argument('--sources', type=int, default=1000)
+    parser.add_argument('--headers', type=int, default=200)
+    parser.add_argument('--fan-out', type=int, default=10,
+                        help='headers included by each source')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='depth of the source directory tree')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--no-build', action='store_true',
+                        help="don't time a no-op doit build")
+    parser.add_argument('-o', '--output', help='write results to a JSON file')
+    parser.add_argument('--baseline', help='compare with a results file')
+    parser.add_argument('--threshold', type=parse_threshold, action='append',
+                        default=[], metavar='NAME=FRACTION',
+                        help='regression threshold for a benchmark '
+                             '(default %.2f)' % DEFAULT_THRESHOLD)
+    parser.add_argument('--keep', metavar='DIR',
+                        help='generate the project in DIR and keep it')
+    args = parser.parse_args()
+
+    path = args.keep or tempfile.mkdtemp()
+    project = synthetic_project.SyntheticProject(
+        path, args.sources, args.headers, args.fan_out, args.depth)
+    try:
+        project.generate()
+        noop_build = not args.no_build and os.path.exists('/bin/sh')
+        results = run_benchmarks(project, args.repeats, noop_build)
+    finally:
+        if not args.keep:
+            shutil.rmtree(path)
+
+    params = project.get_params()
+    if args.output:
+        write_results(args.output, params, results)
+
+    if not args.baseline:
+        for name in sorted(results):
+            print('%-22s best: %9.4f s  mean: %9.4f s' % (
+                name, results[name]['best'], results[name]['mean']))
+        return 0
+
+    baseline = read_results(args.baseline)
+    if baseline['params'] != params:
+        print('warning: baseline was run with different parameters: %r' %
+              baseline['params'])
+    lines, regressions = compare(results, baseline['results'],
+                                 dict(args.threshold))
+    print('\n'.join(lines))
+    if regressions:
+        print('%d regression(s): %s' % (len(regressions),
+                                        ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+""" Generate synthetic c/c++ projects for benchmarking the build helpers.
+
+    usage: python synthetic_project.py <path> [num sources] [num headers]
+"""
+
+import os
+import random
+import sys
+
+# stands in for the compiler when building a synthetic project. Creates
+# the object, and leaves the project's fake depfile alone, so builds
+# don't change the dependencies.
+FAKE_COMPILER_SCRIPT = '''#!/bin/sh
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-o" ]; then
+        shift
+        touch "$1"
+    fi
+    shift
+done
+'''
+
+DODO_TEMPLATE = '''import sys
+sys.path.append(%(package_path)r)
+
+from doit_helpers import file_checker
+from doit_helpers import file_utils
+from doit_helpers import gcc_utils
+
+DOIT_CONFIG = {'default_tasks': ['build'],
+               'check_file_uptodate': %(checker)s}
+
+env = gcc_utils.GccEnv('build')
+env.variables['c compiler'] = %(compiler)r
+env.variables['c++ compiler'] = %(compiler)r
+env.variables['linker'] = %(compiler)r
+env.variables['c header search paths'] = ['include']
+env.variables['c++ header search paths'] = ['include']
+env.variables['c source files'] = file_utils.find(
+    'src', '*.c', search_subdirs=True)
+env.variables['c++ source files'] = file_utils.find(
+    'src', '*.cpp', search_subdirs=True)
+
+
+def task_build():
+    for task in env.iter_c_compile_tasks():
+        yield task
+    for task in env.iter_cpp_compile_tasks():
+        yield task
+    for task in env.iter_link_exe_tasks('build/prog.exe'):
+        yield task
+'''
+
+
+class SyntheticProject:
+
+    """ A generated project. Sources are spread over a tree of
+        directories depth levels deep, and each includes fan_out
+        headers. Each source has a fake gcc depfile in the build
+        directory, as if it had been compiled.
+    """
+
+    def __init__(self, path, num_sources=1000, num_headers=200, fan_out=10,
+                 depth=2, cpp_fraction=0.5, seed=0):
+        self.path = os.path.abspath(path)
+        self.num_sources = num_sources
+        self.num_headers = num_headers
+        self.fan_out = min(fan_out, num_headers)
+        self.depth = depth
+        self.cpp_fraction = cpp_fraction
+        self.seed = seed
+        self.src_dir = os.path.join(self.path, 'src')
+        self.include_dir = os.path.join(self.path, 'include')
+        self.obj_dir = os.path.join(self.path, 'build', 'obj')
+        self.sources = []
+        self.headers = []
+        self.depfiles = []
+
+    def get_params(self):
+        return {
+            'sources': self.num_sources,
+            'headers': self.num_headers,
+            'fan out': self.fan_out,
+            'depth': self.depth,
+            'c++ fraction': self.cpp_fraction,
+            'seed': self.seed,
+        }
+
+    def generate(self):
+        rand = random.Random(self.seed)
+        _mkdirs(self.include_dir)
+        _mkdirs(self.obj_dir)
+        for i in range(self.num_headers):
+            header = os.path.join(self.include_dir, 'h%05d.h' % i)
+            _write(header, 'int h%05d(void);\n' % i)
+            self.headers.append(header)
+
+        for i in range(self.num_sources):
+            ext = '.cpp' if rand.random() < self.cpp_fraction else '.c'
+            name = 's%06d%s' % (i, ext)
+            source = os.path.join(self._get_source_dir(i), name)
+            includes = rand.sample(self.headers, self.fan_out)
+            _mkdirs(os.path.dirname(source))
+            _write(source, ''.join('#include "%s"\n' % os.path.basename(h)
+                                   for h in includes) +
+                   'int f%06d(void) { return %d; }\n' % (i, i))
+            self.sources.append(source)
+
+            rel_source = os.path.relpath(source, self.path)
+            obj = 'build/obj/' + name + '.o'
+            depfile = os.path.join(self.obj_dir, name + '.d')
+            deps = [rel_source] + [os.path.relpath(h, self.path)
+                                   for h in includes]
+            _write(depfile, obj + ': ' + ' \\\n '.join(deps) + '\n')
+            self.depfiles.append(depfile)
+
+    def write_dodo(self, package_path, checker='file_checker.StatChecker'):
+        """ Write a dodo.py that builds the project with GccEnv and a fake
+            compiler. checker is the doit file checker, as python source.
+            Return the path of the dodo file.
+        """
+        compiler = os.path.join(self.path, 'fake_gcc.sh')
+        _write(compiler, FAKE_COMPILER_SCRIPT)
+        os.chmod(compiler, 0o755)
+        dodo = os.path.join(self.path, 'dodo.py')
+        _write(dodo, DODO_TEMPLATE % {'package_path': package_path,
+                                      'compiler': compiler,
+                                      'checker': checker})
+        return dodo
+
+    def _get_source_dir(self, index):
+        """ Spread sources over a tree of directories, 4 wide """
+        parts = [self.src_dir]
+        for level in range(self.depth):
+            parts.append('d%d' % ((index // (4 ** level)) % 4))
+        return os.path.join(*parts)
+
+
+def _mkdirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def _write(path, contents):
+    with open(path, 'w') as outfile:
+        outfile.write(contents)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    num_sources = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    num_headers = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    SyntheticProject(sys.argv[1], num_sources, num_headers).generate()
+
+
+if __name__ == '__main__':
+    main()
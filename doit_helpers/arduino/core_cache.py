@@ -0,0 +1,135 @@
+""" A machine-wide cache of built arduino core libraries, shared by all
+    projects that build the same core with the same settings.
+"""
+
+import hashlib
+import os
+
+from .. import file_utils
+from .. import shutil2
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.doit_helpers', 'arduino_core')
+
+CORE_LIB_FILENAME = 'core.a'
+
+
+class CoreCache:
+
+    """ Cache of arduino core libraries (core.a), keyed by a fingerprint
+        of the arduino install path and version, the hardware profile,
+        the exact compile settings and the core source and header files.
+
+        An arduino environment given a CoreCache links against the cached
+        core library if there is one for its fingerprint, and doesn't
+        generate any core compile tasks. Otherwise it builds the core as
+        usual and publishes the result to the cache.
+
+        Files are published by writing to a temporary file and renaming
+        it into place, so several doit processes can share the cache
+        safely. The core library is published last, and an entry is only
+        used once its core library exists.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def get_key(self, arduino_path, hardware, settings, sources,
+                header_dirs=[]):
+        """ Return the fingerprint of a core build.
+
+            @param settings:
+                Everything that affects how the core is compiled and
+                archived, eg. compilers, flags, defines and include paths.
+                Must have a stable repr().
+
+            @param sources:
+                The core source files. Their sizes and modification times
+                are included in the fingerprint.
+
+            @param header_dirs:
+                Directories the core's headers are found in, eg. the core,
+                variant and system include paths. Headers (*.h) in them
+                and their subdirectories are fingerprinted like sources,
+                so that editing eg. pins_arduino.h rebuilds the core.
+        """
+        hasher = hashlib.sha1()
+        for item in [os.path.abspath(arduino_path),
+                     _get_arduino_version(arduino_path),
+                     hardware.lower(),
+                     repr(settings)]:
+            hasher.update(item.encode('utf-8'))
+            hasher.update(b'\0')
+        headers = set()
+        for path in header_dirs:
+            headers.update(file_utils.find(path, '*.h', search_subdirs=True))
+        for source in list(sources) + sorted(headers):
+            try:
+                stat = os.stat(source)
+                source_id = '%s|%d|%r' % (source, stat.st_size, stat.st_mtime)
+            except OSError:
+                source_id = source
+            hasher.update(source_id.encode('utf-8'))
+            hasher.update(b'\0')
+        return hasher.hexdigest()
+
+    def get_entry_dir(self, key):
+        """ Return the directory that holds the cached files for key """
+        return os.path.join(self.cache_dir, key)
+
+    def get_core_lib_path(self, key):
+        """ Return where the core library for key is cached """
+        return os.path.join(self.get_entry_dir(key), CORE_LIB_FILENAME)
+
+    def is_cached(self, key):
+        """ Return True if a core library has been published for key """
+        return os.path.isfile(self.get_core_lib_path(key))
+
+    def get_cached_files(self, key):
+        """ Return the paths of all files cached for key, other than the
+            core library
+        """
+        entry_dir = self.get_entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return []
+        return [os.path.join(entry_dir, name)
+                for name in sorted(os.listdir(entry_dir))
+                if name != CORE_LIB_FILENAME and not name.startswith('.')]
+
+    def publish(self, key, core_lib, extra_files=[]):
+        """ doit python-action. Copy a built core library, and any other
+            files needed to link against it, into the cache.
+        """
+        entry_dir = self.get_entry_dir(key)
+        for path in extra_files:
+            shutil2.atomic_copy(
+                path, os.path.join(entry_dir, os.path.basename(path)))
+        # the core library is copied last, as its presence marks the
+        # entry as complete
+        shutil2.atomic_copy(core_lib, self.get_core_lib_path(key))
+        return True
+
+    def get_publish_task(self, key, core_lib, extra_files=[]):
+        """ Return a doit task that publishes a built core library """
+        return {
+            'name': 'publish core ' + key,
+            'actions': [(self.publish, [key, core_lib, extra_files])],
+            'file_dep': [core_lib] + list(extra_files),
+            'targets': [self.get_core_lib_path(key)],
+        }
+
+
+#------------------------------------------------------------------------
+# private functions
+
+
+def _get_arduino_version(arduino_path):
+    """ Return the version of the arduino install, or an empty string if
+        it can't be found
+    """
+    version_path = os.path.join(arduino_path, 'lib', 'version.txt')
+    try:
+        with open(version_path) as infile:
+            return infile.read().strip()
+    except (IOError, OSError):
+        return ''
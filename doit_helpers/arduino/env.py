@@ -1,8 +1,10 @@
 import os
-from doit.tools import create_folder
+from doit.tools import config_changed
 
 from .. import gcc_utils
 from .. import file_utils
+from .. import task_times
+from ..lazy import cached_property
 
 import uno
 import pro_mini_8mhz
@@ -10,7 +12,15 @@ import pro_mini_8mhz
 
 class ArduinoEnv:
 
-    def __init__(self, proj_name, arduino_path, build_dir, hardware):
+    def __init__(self, proj_name, arduino_path, build_dir, hardware,
+                 core_cache=None):
+        """ If a core_cache.CoreCache is given, the arduino core library is
+            taken from the cache when possible instead of being built.
+            Link against core_lib_output_path in either case.
+
+            Nothing is read from the filesystem here. The core sources are
+            searched for, and their depfiles read, when first needed.
+        """
         if hardware == 'uno':
             self.hardware_env = uno
         elif hardware == 'pro_mini_8mhz':
@@ -31,6 +41,8 @@ class ArduinoEnv:
         self.cpp_compiler = os.path.join(self.bin_path, 'avr-g++')
         self.linker = os.path.join(self.bin_path, 'avr-gcc')
         self.archiver = os.path.join(self.bin_path, 'avr-ar')
+        # see gcc_utils 'deterministic archives'
+        self.deterministic_archives = False
         self.objcopy = os.path.join(self.bin_path, 'avr-objcopy')
         self.print_size = os.path.join(self.bin_path, 'avr-size')
         self.avrdude = os.path.join(self.bin_path, 'avrdude')
@@ -48,24 +60,23 @@ class ArduinoEnv:
         self.cppflags = self.hardware_env.CPP_FLAGS
         self.cppdefs = self.hardware_env.CPP_DEFS
         self.cppincludes = self.cincludes
+        self.cpp_precompiled_headers = []
         self.ldflags = self.hardware_env.LINKER_FLAGS
         self.ldlibs = self.hardware_env.LINKER_LIBS
         self.ldincludes = []
 
-        self.core_csources = file_utils.find(self.core_path, '*.c')
-        self.core_cppsources = file_utils.find(self.core_path, '*.cpp')
-
         self.core_lib_output_dir = os.path.join(
             self.build_dir, '_arduino_core_')
         self.core_obj_output_dir = os.path.join(
             self.core_lib_output_dir, 'obj')
-        self.core_lib_output_path = os.path.join(
-            self.core_lib_output_dir, 'core.a')
-
-        self.core_objs = [self._source_to_obj_path(x)
-                          for x in self.core_csources + self.core_cppsources]
 
-        self._set_core_deps()
+        self.hardware = hardware
+        self.core_cache = core_cache
+        # a task_times.TaskTimes to record how long tasks take, and start
+        # the slowest core compile tasks first
+        self.task_times = None
+        # a build_trace.BuildTrace to trace the actions of all tasks
+        self.build_trace = None
 
         self.elf_target = os.path.join(self.build_dir, self.proj_name + '.elf')
         self.eep_target = os.path.join(self.build_dir, self.proj_name + '.eep')
@@ -74,11 +85,63 @@ class ArduinoEnv:
     # -------------------------------------------------------------------
     # public
 
+    @cached_property
+    def core_csources(self):
+        return file_utils.find(self.core_path, '*.c')
+
+    @cached_property
+    def core_cppsources(self):
+        return file_utils.find(self.core_path, '*.cpp')
+
+    @cached_property
+    def core_objs(self):
+        return [self._source_to_obj_path(x)
+                for x in self.core_csources + self.core_cppsources]
+
+    @cached_property
+    def core_cache_key(self):
+        if self.core_cache is None:
+            return None
+        return self.core_cache.get_key(
+            self.root_path, self.hardware, self._get_core_settings(),
+            self.core_csources + self.core_cppsources,
+            self.cincludes + self.cppincludes)
+
+    @cached_property
+    def core_lib_output_path(self):
+        if self._is_core_cached():
+            return self.core_cache.get_core_lib_path(self.core_cache_key)
+        return os.path.join(self.core_lib_output_dir, 'core.a')
+
+    @cached_property
+    def deps(self):
+        """ Dependencies of the core objects, read from their depfiles """
+        if self._is_core_cached():
+            return {}
+        elif os.path.exists(self.core_obj_output_dir):
+            return gcc_utils.get_dependency_dict(self.core_obj_output_dir)
+        else:
+            return {}
+
     def get_build_core_tasks(self):
-        tasks = self._get_compile_core_c_tasks()
-        tasks += self._get_compile_core_cpp_tasks()
-        tasks += self._get_archive_core_objs_tasks()
-        return tasks
+        return list(self.iter_build_core_tasks())
+
+    def iter_build_core_tasks(self):
+        """ Generate the tasks of get_build_core_tasks() one at a time.
+            Can be returned directly from a doit task creator.
+        """
+        if self._is_core_cached():
+            return
+        yield self._get_create_core_output_dirs_task()
+        for task in self._get_precompile_core_header_tasks():
+            yield task
+        for task in self._iter_compile_core_tasks():
+            yield task
+        for task in self._get_archive_core_objs_tasks():
+            yield task
+        if self.core_cache is not None:
+            yield self.core_cache.get_publish_task(
+                self.core_cache_key, self.core_lib_output_path)
 
     def get_build_exe_tasks(self, name, objs):
         tasks = self._get_build_elf_tasks(objs, self.elf_target)
@@ -89,6 +152,12 @@ class ArduinoEnv:
         tasks += self._get_print_size_task(self.elf_target)
         return tasks
 
+    def enable_precompiled_arduino_header(self):
+        """ Precompile Arduino.h, and include it in every core c++ source """
+        header = os.path.join(self.core_path, 'Arduino.h')
+        if header not in self.cpp_precompiled_headers:
+            self.cpp_precompiled_headers.append(header)
+
     def get_upload_task(self, serial_port):
         avrdude_flags = self.hardware_env.AVRDUDE_FLAGS
         avrdude_flags += ['-C' + self.avrdude_conf] + ['-P' + serial_port]
@@ -113,11 +182,30 @@ class ArduinoEnv:
         src_filename = os.path.basename(source)
         return os.path.join(self.core_obj_output_dir, src_filename) + '.d'
 
-    def _set_core_deps(self):
-        if os.path.exists(self.core_obj_output_dir):
-            self.deps = gcc_utils.get_dependency_dict(self.core_obj_output_dir)
-        else:
-            self.deps = {}
+    def _instrument_action(self, name, action,
+                           stage=task_times.STAGE_COMPILE):
+        """ Return action, timed and traced if there are task times and a
+            build trace
+        """
+        return gcc_utils.instrument_action(name, action, stage,
+                                           self.task_times, self.build_trace)
+
+    def _is_core_cached(self):
+        return self._core_is_cached
+
+    @cached_property
+    def _core_is_cached(self):
+        # decided once, so tasks stay consistent if another process
+        # publishes the core in the meantime
+        if self.core_cache is None:
+            return False
+        return self.core_cache.is_cached(self.core_cache_key)
+
+    def _get_core_settings(self):
+        """ Return everything that affects how the core is built """
+        return [self.c_compiler, self.cdefs, self.cflags, self.cincludes,
+                self.cpp_compiler, self.cppdefs, self.cppflags,
+                self.cppincludes, self.archiver, self.deterministic_archives]
 
     def _get_core_obj_deps(self, obj_path):
         if obj_path in self.deps:
@@ -125,95 +213,179 @@ class ArduinoEnv:
         else:
             return []
 
-    def _get_compile_core_c_tasks(self):
-        tasks = []
+    def _get_core_output_dirs_stamp(self):
+        return os.path.join(self.core_obj_output_dir, '.dirs')
+
+    def _get_create_core_output_dirs_task(self):
+        dirs = [self.core_obj_output_dir]
+        if self.cpp_precompiled_headers:
+            dirs.append(os.path.join(self.core_obj_output_dir, 'pch'))
+        stamp = self._get_core_output_dirs_stamp()
+        return {
+            'name': stamp,
+            'actions': [(gcc_utils.create_output_dirs, [dirs, stamp])],
+            'targets': [stamp],
+            'uptodate': [config_changed(' '.join(dirs))],
+            'clean': True
+        }
+
+    def _iter_compile_core_tasks(self):
+        """ Generate the core compile tasks. If there are task times, the
+            tasks are generated longest first.
+        """
+        if self.task_times is None:
+            for task in self._iter_compile_core_c_tasks():
+                yield task
+            for task in self._iter_compile_core_cpp_tasks():
+                yield task
+            return
+        tasks = list(self._iter_compile_core_c_tasks())
+        tasks += self._iter_compile_core_cpp_tasks()
+        for task in self.task_times.sort_tasks(
+                tasks, downstream=['archiving core']):
+            yield task
+
+    def _iter_compile_core_c_tasks(self):
+        dirs_stamp = self._get_core_output_dirs_stamp()
         for source in self.core_csources:
             obj = self._source_to_obj_path(source)
             dep = self._source_to_dep_path(source)
-            tasks.append({
+            compile_cmd = gcc_utils.get_compile_cmd_args(source, obj,
+                                                         compiler=self.c_compiler,
+                                                         defs=self.cdefs,
+                                                         includes=self.cincludes,
+                                                         flags=self.cflags)
+            yield {
                 'name': obj,
-                'actions': [(create_folder, [self.core_obj_output_dir]),
-                            gcc_utils.get_compile_cmd_str(source, obj,
-                                                          compiler=self.c_compiler,
-                                                          defs=self.cdefs,
-                                                          includes=self.cincludes,
-                                                          flags=self.cflags)],
+                'actions': [self._instrument_action(obj, compile_cmd)],
                 'targets': [obj, dep],
-                'file_dep': self._get_core_obj_deps(obj),
+                'file_dep': self._get_core_obj_deps(obj) + [dirs_stamp],
+                'uptodate': [gcc_utils.cmd_changed(compile_cmd)],
                 'clean': True
-            })
-        return tasks
+            }
 
-    def _get_compile_core_cpp_tasks(self):
-        tasks = []
+    def _iter_compile_core_cpp_tasks(self):
+        pch_args = []
+        pch_deps = []
+        for header in self.cpp_precompiled_headers:
+            gch = self._header_to_pch_path(header)
+            pch_args += ['-include', gch[:-len('.gch')]]
+            pch_deps += [gch, gch[:-len('.gch')]]
+        dirs_stamp = self._get_core_output_dirs_stamp()
         for source in self.core_cppsources:
             obj = self._source_to_obj_path(source)
             dep = self._source_to_dep_path(source)
-            tasks.append({
+            compile_cmd = gcc_utils.get_compile_cmd_args(source, obj,
+                                                         compiler=self.cpp_compiler,
+                                                         defs=self.cppdefs,
+                                                         includes=self.cppincludes,
+                                                         flags=self.cppflags,
+                                                         extra_args=pch_args)
+            yield {
                 'name': obj,
-                'actions': [(create_folder, [self.core_obj_output_dir]),
-                            gcc_utils.get_compile_cmd_str(source, obj,
-                                                          compiler=self.cpp_compiler,
-                                                          defs=self.cppdefs,
-                                                          includes=self.cppincludes,
-                                                          flags=self.cppflags)],
+                'actions': [self._instrument_action(obj, compile_cmd)],
                 'targets': [obj, dep],
-                'file_dep': self._get_core_obj_deps(obj),
+                'file_dep': self._get_core_obj_deps(obj) + pch_deps +
+                [dirs_stamp],
+                'uptodate': [gcc_utils.cmd_changed(compile_cmd)],
+                'clean': True
+            }
+
+    def _header_to_pch_path(self, header):
+        return os.path.join(self.core_obj_output_dir, 'pch',
+                            os.path.basename(header)) + '.gch'
+
+    def _get_precompile_core_header_tasks(self):
+        tasks = []
+        for header in self.cpp_precompiled_headers:
+            gch = self._header_to_pch_path(header)
+            dep = gch + '.d'
+            deps = self._get_core_obj_deps(gch)
+            pch_cmd = gcc_utils.get_pch_cmd_args(header, gch, dep, 'c++',
+                                                 compiler=self.cpp_compiler,
+                                                 defs=self.cppdefs,
+                                                 includes=self.cppincludes,
+                                                 flags=self.cppflags)
+            stub = gch[:-len('.gch')]
+            tasks.append({
+                'name': gch,
+                'actions': [self._instrument_action(gch, pch_cmd),
+                            (gcc_utils.write_pch_stub, [stub, header])],
+                'targets': [gch, dep, stub],
+                'file_dep': (deps if deps else [header]) +
+                [self._get_core_output_dirs_stamp()],
+                'uptodate': [gcc_utils.cmd_changed(pch_cmd)],
                 'clean': True
             })
         return tasks
 
     def _get_archive_core_objs_tasks(self):
-        archive_command = self.archiver + \
-            ' rcs ' + self.core_lib_output_path + ' '
-        archive_command += ' '.join(self.core_objs)
+        archive_command = gcc_utils.get_archive_cmd_args(
+            self.archiver, self.core_lib_output_path, self.core_objs,
+            self.deterministic_archives)
         return [{
             'name': 'archiving core',
-            'actions': [archive_command],
-            'targets': [self.core_lib_output_path],
+            'actions': [self._instrument_action(
+                'archiving core',
+                (gcc_utils.update_archive,
+                 [self.archiver, self.core_lib_output_path, self.core_objs],
+                 {'deterministic': self.deterministic_archives}),
+                task_times.STAGE_LINK)],
+            'targets': [self.core_lib_output_path,
+                        self.core_lib_output_path +
+                        gcc_utils.ARCHIVE_CMD_EXTENSION],
             'file_dep': self.core_objs,
+            'uptodate': [gcc_utils.cmd_changed(archive_command)],
             'clean': True
         }]
 
     def _get_build_elf_tasks(self, objs, dest):
+        link_cmd = gcc_utils.get_link_cmd_args(dest, objs,
+                                               linker=self.linker,
+                                               libdirs=self.ldincludes,
+                                               libs=self.ldlibs,
+                                               flags=self.ldflags)
         return [{
             'name': dest,
-            'actions': [gcc_utils.get_link_cmd_str(dest, objs,
-                                                   linker=self.linker,
-                                                   libdirs=self.ldincludes,
-                                                   libs=self.ldlibs,
-                                                   flags=self.ldflags)],
+            'actions': [self._instrument_action(dest, link_cmd,
+                                                task_times.STAGE_LINK)],
             'file_dep': objs,
             'targets': [dest],
+            'uptodate': [gcc_utils.cmd_changed(link_cmd)],
             'clean': True
         }]
 
     def _get_build_eeprom_binary_tasks(self, source, dest):
-        objcopy_cmd = ' '.join(
-            [self.objcopy] + self.hardware_env.OBJCOPY_EEPROM_FLAGS + [source, dest])
+        objcopy_cmd = [self.objcopy] + \
+            self.hardware_env.OBJCOPY_EEPROM_FLAGS + [source, dest]
         return [{
             'name': dest,
-            'actions': [objcopy_cmd],
+            'actions': [self._instrument_action(dest, objcopy_cmd,
+                                                task_times.STAGE_LINK)],
             'file_dep': [source],
             'targets': [dest],
+            'uptodate': [gcc_utils.cmd_changed(objcopy_cmd)],
             'clean': True
         }]
 
     def _get_build_flash_binary_tasks(self, source, dest):
-        objcopy_cmd = ' '.join(
-            [self.objcopy] + self.hardware_env.OBJCOPY_FLASH_FLAGS + [source, dest])
+        objcopy_cmd = [self.objcopy] + \
+            self.hardware_env.OBJCOPY_FLASH_FLAGS + [source, dest]
         return [{
             'name': dest,
-            'actions': [objcopy_cmd],
+            'actions': [self._instrument_action(dest, objcopy_cmd,
+                                                task_times.STAGE_LINK)],
             'file_dep': [source],
             'targets': [dest],
+            'uptodate': [gcc_utils.cmd_changed(objcopy_cmd)],
             'clean': True
         }]
 
     def _get_print_size_task(self, binary):
         return [{
             'name': 'size',
-            'actions': [self.print_size + ' ' + binary],
+            'actions': [self._instrument_action(
+                'size', [self.print_size, binary], task_times.STAGE_LINK)],
             'file_dep': [binary],
             # dummy target makes this always run
             'targets': ['print size'],
@@ -1,36 +1,86 @@
 """ An improvement over env.py (hopefully) """
 
-import glob
+import fnmatch
+import os
 
 from .. import gcc_utils
+from .. import task_times
+from ..lazy import cached_property
 import env_uno
 import env_due
 
 
 class ArduinoEnv():
 
-    """ Base arduino environment class """
+    """ Base arduino environment class
+
+        Every compile task lists the core headers it includes as file
+        dependencies. Set file_checker.StatChecker as the dodo file's
+        'check_file_uptodate' so that they're only hashed once per run.
+    """
 
     # -----------------------------
     # public
 
-    def __init__(self, proj_name, build_dir, arduino_path, hardware):
-        hardware_env = get_hardware_env(arduino_path, hardware)
+    def __init__(self, proj_name, build_dir, arduino_path, hardware,
+                 core_cache=None):
+        """ If a core_cache.CoreCache is given, the arduino core library is
+            taken from the cache when possible instead of being built.
 
-        self.arduino_core_env = gcc_utils.GccEnv(build_dir + '/core')
-        self.arduino_core_env.variables.update(hardware_env)
-        self.arduino_core_env.variables[
-            'core lib output path'] = build_dir + '/core/core.a'
+            Nothing is read from the filesystem here. The arduino core is
+            searched for when arduino_core_env is first used, eg. when
+            tasks are requested.
+        """
+        self.hardware_module = get_hardware_module(hardware)
+        self.build_dir = build_dir
+        self.arduino_path = arduino_path
+        self.hardware = hardware
 
         self.user_env = gcc_utils.GccEnv(build_dir)
         self.user_env.variables['project name'] = proj_name
-        self.user_env.variables.update(hardware_env)
+        self.user_env.variables.update(
+            self.hardware_module.get_tool_env(arduino_path))
         self.user_env.variables['c source files'] = []
         self.user_env.variables['c++ source files'] = []
         self.user_env.variables['arduino path'] = arduino_path
         self.user_env.variables['elf output'] = build_dir + '/' + proj_name + '.elf'
         self.user_env.variables['bin output'] = build_dir + '/' + proj_name + '.bin'
 
+        self.core_cache = core_cache
+
+    @cached_property
+    def arduino_core_env(self):
+        """ The GccEnv that builds the arduino core """
+        core_env = gcc_utils.GccEnv(self.build_dir + '/core')
+        core_env.variables.update(
+            self.hardware_module.get_tool_env(self.arduino_path))
+        core_env.variables.update(
+            self.hardware_module.get_core_source_files(self.arduino_path))
+        core_env.variables[
+            'core lib output path'] = self.build_dir + '/core/core.a'
+        # syscalls are linked directly, so can't be part of a unity batch
+        core_env.variables['unity build exclude'] = ['syscalls*']
+        for key in ['task times', 'build trace']:
+            core_env.variables[key] = self.user_env.variables[key]
+        return core_env
+
+    @cached_property
+    def core_cache_key(self):
+        """ The core's key in core_cache, None if there's no core_cache """
+        if self.core_cache is None:
+            return None
+        return self.core_cache.get_key(
+            self.arduino_path, self.hardware, self._get_core_settings(),
+            self._get_core_sources(), self._get_core_header_dirs())
+
+    @cached_property
+    def _core_is_cached(self):
+        # decided once, so tasks stay consistent if another process
+        # publishes the core in the meantime
+        if self.core_cache is None:
+            return False
+        return self.core_cache.is_cached(self.core_cache_key)
+
     def set_c_source_files(self, sources):
         self.user_env.variables['c source files'] = sources
 
@@ -41,18 +91,49 @@ class ArduinoEnv():
         self.user_env.variables['c header search paths'] += dirs
         self.user_env.variables['c++ header search paths'] += dirs
 
+    def enable_precompiled_arduino_header(self):
+        """ Precompile Arduino.h, and include it in every core and user
+            c++ source
+        """
+        header = self._find_core_header('Arduino.h')
+        for env in [self.arduino_core_env, self.user_env]:
+            if header not in env.variables['c++ precompiled headers']:
+                env.variables['c++ precompiled headers'].append(header)
+
     def set_serial_port(self, serial_port):
         self.user_env.variables['serial_port'] = serial_port
 
+    def set_task_times(self, task_times):
+        """ Record how long tasks take with a task_times.TaskTimes, and
+            start the tasks on the longest path to the link first
+        """
+        self._set_variable('task times', task_times)
+
+    def set_build_trace(self, build_trace):
+        """ Trace the actions of all tasks with a build_trace.BuildTrace """
+        self._set_variable('build trace', build_trace)
+
     def get_build_tasks(self):
+        return list(self.iter_build_tasks())
+
+    def iter_build_tasks(self):
+        """ Generate the tasks of get_build_tasks() one at a time. Can be
+            returned directly from a doit task creator.
+        """
         elf_output = self.user_env.variables['elf output']
         bin_output = self.user_env.variables['bin output']
-        tasks = self._get_build_core_tasks()
-        tasks += self.user_env.get_c_compile_tasks()
-        tasks += self.user_env.get_cpp_compile_tasks()
-        tasks += [self._get_due_link_task(elf_output)]
-        tasks += [self._get_create_binary_task(elf_output, bin_output)]
-        return tasks
+        if self.user_env.variables['task times'] is None:
+            for task in self._iter_build_core_tasks():
+                yield task
+            for task in self.user_env.iter_c_compile_tasks():
+                yield task
+            for task in self.user_env.iter_cpp_compile_tasks():
+                yield task
+        else:
+            for task in self._get_compile_tasks_by_priority(elf_output):
+                yield task
+        yield self._get_due_link_task(elf_output)
+        yield self._get_create_binary_task(elf_output, bin_output)
 
     def get_upload_tasks(self):
         return [self._get_due_upload_task()]
@@ -60,22 +141,128 @@ class ArduinoEnv():
     # -----------------------------
     # private
 
-    def _get_build_core_tasks(self):
-        tasks = self.arduino_core_env.get_c_compile_tasks()
-        tasks += self.arduino_core_env.get_cpp_compile_tasks()
-        tasks += [self._get_archive_core_task()]
-        return tasks
+    def _iter_build_core_tasks(self):
+        if self._is_core_cached():
+            return
+        for task in self.arduino_core_env.iter_c_compile_tasks():
+            yield task
+        for task in self.arduino_core_env.iter_cpp_compile_tasks():
+            yield task
+        yield self._get_archive_core_task()
+        if self.core_cache is not None:
+            yield self.core_cache.get_publish_task(
+                self.core_cache_key,
+                self.arduino_core_env.variables['core lib output path'],
+                self._get_core_link_objs())
+
+    def _get_compile_tasks_by_priority(self, elf_output):
+        """ Return the core and user build tasks, longest path to the end
+            of the link first. Core objects are archived before they are
+            linked, so that's on their path.
+        """
+        times = self.user_env.variables['task times']
+        core_tasks = list(self._iter_build_core_tasks())
+        user_tasks = list(self.user_env.iter_c_compile_tasks())
+        user_tasks += self.user_env.iter_cpp_compile_tasks()
+        core_lib = self._get_core_lib_path()
+        priorities = {}
+        for task in core_tasks:
+            downstream = [elf_output]
+            if task['name'] != core_lib:
+                downstream.append(core_lib)
+            priorities[task['name']] = times.get_priority(
+                task['name'], downstream)
+        for task in user_tasks:
+            priorities[task['name']] = times.get_priority(
+                task['name'], [elf_output])
+        return sorted(core_tasks + user_tasks,
+                      key=lambda task: -priorities[task['name']])
+
+    def _set_variable(self, key, value):
+        """ Set a variable of both the user and core environments """
+        self.user_env.variables[key] = value
+        # don't create the core env just for this
+        if 'arduino_core_env' in vars(self):
+            self.arduino_core_env.variables[key] = value
+
+    def _instrument_action(self, name, action,
+                           stage=task_times.STAGE_COMPILE):
+        """ Return action, timed and traced if there are task times and a
+            build trace
+        """
+        return gcc_utils.instrument_action(
+            name, action, stage, self.user_env.variables['task times'],
+            self.user_env.variables['build trace'])
+
+    def _is_core_cached(self):
+        return self._core_is_cached
+
+    def _get_core_lib_path(self):
+        """ Return the path of the core library to link against """
+        if self._is_core_cached():
+            return self.core_cache.get_core_lib_path(self.core_cache_key)
+        return self.arduino_core_env.variables['core lib output path']
+
+    def _find_core_header(self, name):
+        """ Return the path of a header in the arduino core """
+        variables = self.arduino_core_env.variables
+        search_paths = variables['c++ header search paths'] + \
+            [os.path.dirname(x) for x in self._get_core_sources()]
+        for path in search_paths:
+            header = os.path.join(path, name)
+            if os.path.isfile(header):
+                return header
+        raise Exception('Could not find ' + name + ' in the arduino core')
+
+    def _get_core_settings(self):
+        """ Return everything that affects how the core is built """
+        variables = self.arduino_core_env.variables
+        keys = ['c compiler', 'c preprocessor defs', 'c compiler flags',
+                'c header search paths', 'c++ compiler',
+                'c++ preprocessor defs', 'c++ compiler flags',
+                'c++ header search paths', 'archiver',
+                'deterministic archives']
+        return [(key, variables[key]) for key in keys]
+
+    def _get_core_sources(self):
+        variables = self.arduino_core_env.variables
+        return variables['c source files'] + variables['c++ source files']
+
+    def _get_core_header_dirs(self):
+        """ Return the directories the core's headers are found in """
+        variables = self.arduino_core_env.variables
+        source_dirs = set(os.path.dirname(x) for x in self._get_core_sources())
+        return variables['c header search paths'] + \
+            variables['c++ header search paths'] + sorted(source_dirs)
+
+    def _get_core_link_objs(self):
+        """ Return the core objects that are linked directly rather than
+            through the core library
+        """
+        if self._is_core_cached():
+            return [path for path in
+                    self.core_cache.get_cached_files(self.core_cache_key)
+                    if fnmatch.fnmatch(os.path.basename(path), 'syscalls*.o')]
+        return [obj for obj in self.arduino_core_env.get_all_objs()
+                if fnmatch.fnmatch(os.path.basename(obj), 'syscalls*.o')]
 
     def _get_archive_core_task(self):
         objs = self.arduino_core_env.get_all_objs()
         archiver = self.arduino_core_env.variables['archiver']
-        output = self.arduino_core_env.variables['core lib output path']
-        archive_command = archiver + ' rcs ' + output + ' ' + ' '.join(objs)
+        deterministic = self.arduino_core_env.variables[
+            'deterministic archives']
+        output = self._get_core_lib_path()
+        archive_command = gcc_utils.get_archive_cmd_args(
+            archiver, output, objs, deterministic)
         return {
             'name': output,
-            'actions': [archive_command],
-            'targets': [output],
+            'actions': [self._instrument_action(
+                output, (gcc_utils.update_archive, [archiver, output, objs],
+                         {'deterministic': deterministic}),
+                task_times.STAGE_LINK)],
+            'targets': [output, output + gcc_utils.ARCHIVE_CMD_EXTENSION],
             'file_dep': objs,
+            'uptodate': [gcc_utils.cmd_changed(archive_command)],
             'clean': True
         }
 
@@ -87,7 +274,7 @@ class ArduinoEnv():
         linker = self.user_env.variables['linker']
         flags = self.user_env.variables['linker flags']
         script = self.user_env.variables['linker script']
-        core = self.arduino_core_env.variables['core lib output path']
+        core = self._get_core_lib_path()
         link_map = output_dir + '/' + self.user_env.variables['project name'] + '.map'
 
         cmd_args = [linker] + flags
@@ -98,31 +285,35 @@ class ArduinoEnv():
             output,
         ]
 
+        core_link_objs = self._get_core_link_objs()
+        user_objs = self.user_env.get_all_objs()
         cmd_args += ['-Wl,--start-group']
-        cmd_args += glob.glob(self.arduino_core_env.variables['build directory'] + '/obj/syscalls*.o')
-        cmd_args += self.user_env.get_all_objs()
+        cmd_args += core_link_objs
+        cmd_args += user_objs
         cmd_args += [arduino_path + '/hardware/arduino/sam/variants/arduino_due_x/libsam_sam3x8e_gcc_rel.a']
         cmd_args += [core]
         cmd_args += ['-Wl,--end-group']
 
-        link_cmd = ' '.join(cmd_args)
-
         return {
             'name': output,
-            'actions': [link_cmd],
-            'file_dep': self.user_env.get_all_objs(),
+            'actions': [self._instrument_action(output, cmd_args,
+                                                task_times.STAGE_LINK)],
+            'file_dep': user_objs + [core] + core_link_objs,
             'targets': [output],
+            'uptodate': [gcc_utils.cmd_changed(cmd_args)],
             'clean': True
         }
 
     def _get_create_binary_task(self, input, output):
         objcopy = self.user_env.variables['objcopy']
-        cmd = ' '.join([objcopy, '-O binary', input, output])
+        cmd = [objcopy, '-O', 'binary', input, output]
         return {
             'name': output,
-            'actions': [cmd],
+            'actions': [self._instrument_action(output, cmd,
+                                                task_times.STAGE_LINK)],
             'file_dep': [input],
             'targets': [output],
+            'uptodate': [gcc_utils.cmd_changed(cmd)],
             'clean': True
         }
 
@@ -164,11 +355,16 @@ class ArduinoEnv():
 
 
 def get_hardware_env(arduino_path, hardware):
+    return get_hardware_module(hardware).get_env(arduino_path)
+
+
+def get_hardware_module(hardware):
+    """ Return the module that defines the environment for the given
+        hardware
+    """
     if hardware.lower() == 'uno':
-        env = env_uno.get_env(arduino_path)
+        return env_uno
     elif hardware.lower() == 'due':
-        env = env_due.get_env(arduino_path)
+        return env_due
     else:
         raise Exception('Unknown hardware type: ' + hardware)
-
-    return env
@@ -2,7 +2,34 @@ from .. import file_utils
 
 
 def get_env(arduino_path):
+    """ Return the environment variables for building with this hardware,
+        including the arduino core source files
+    """
+    env = get_tool_env(arduino_path)
+    env.update(get_core_source_files(arduino_path))
+    return env
+
+
+def get_core_source_files(arduino_path):
+    """ Return the arduino core source file variables. Searches the
+        arduino install.
+    """
+    return {
+        'c source files': file_utils.find(
+            arduino_path + '/hardware/arduino/sam/cores/arduino', ['*.c'],
+            search_subdirs=True),
+
+        'c++ source files': file_utils.find(
+            arduino_path + '/hardware/arduino/sam/cores/arduino', ['*.cpp'],
+            search_subdirs=True) +
+            [arduino_path + '/hardware/arduino/sam/variants/arduino_due_x/variant.cpp'],
+    }
+
 
+def get_tool_env(arduino_path):
+    """ Return the environment variables without the core source files.
+        Doesn't access the filesystem.
+    """
     bin_dir = arduino_path + '/hardware/tools/g++_arm_none_eabi/bin/'
 
     return {
@@ -45,9 +72,7 @@ def get_env(arduino_path):
             arduino_path + '/hardware/arduino/sam/variants/arduino_due_x',
         ],
 
-        'c source files': file_utils.find(
-            arduino_path + '/hardware/arduino/sam/cores/arduino', ['*.c'],
-            search_subdirs=True),
+        'c source files': [],
 
         # -------------------------------
         # c++
@@ -90,10 +115,7 @@ def get_env(arduino_path):
             arduino_path + '/hardware/arduino/sam/variants/arduino_due_x',
         ],
 
-        'c++ source files': file_utils.find(
-            arduino_path + '/hardware/arduino/sam/cores/arduino', ['*.cpp'],
-            search_subdirs=True) +
-            [arduino_path + '/hardware/arduino/sam/variants/arduino_due_x/variant.cpp'],
+        'c++ source files': [],
 
         # -------------------------------
         # linker
@@ -2,7 +2,33 @@ from .. import file_utils
 
 
 def get_env(arduino_path):
+    """ Return the environment variables for building with this hardware,
+        including the arduino core source files
+    """
+    env = get_tool_env(arduino_path)
+    env.update(get_core_source_files(arduino_path))
+    return env
+
+
+def get_core_source_files(arduino_path):
+    """ Return the arduino core source file variables. Searches the
+        arduino install.
+    """
+    return {
+        'c source files': file_utils.find(
+            arduino_path + '/hardware/arduino/cores/arduino',
+            ['*.c'], search_subdirs=True),
+
+        'c++ source files': file_utils.find(
+            arduino_path + '/hardware/arduino/cores/arduino',
+            ['*.cpp'], search_subdirs=True),
+    }
+
 
+def get_tool_env(arduino_path):
+    """ Return the environment variables without the core source files.
+        Doesn't access the filesystem.
+    """
     bin_dir = arduino_path + '/hardware/tools/avr/bin/'
 
     return {
@@ -32,9 +58,7 @@ def get_env(arduino_path):
 
         'c header search paths': [],
 
-        'c source files': file_utils.find(
-            arduino_path + '/hardware/arduino/cores/arduino',
-            ['*.c'], search_subdirs=True),
+        'c source files': [],
 
         # -------------------------------
         # c++
@@ -63,9 +87,7 @@ def get_env(arduino_path):
 
         'c++ header search paths': [],
 
-        'c++ source files': file_utils.find(
-            arduino_path + '/hardware/arduino/cores/arduino',
-            ['*.cpp'], search_subdirs=True),
+        'c++ source files': [],
 
         # -------------------------------
         # linker
@@ -0,0 +1,281 @@
+""" Per-task build tracing, to see where build time goes.
+
+    usage:
+        python build_trace.py summary <trace file> [number of tasks]
+            Print the slowest tasks of the most recent build.
+
+        python build_trace.py chrome <trace file> <output file>
+            Convert the most recent build to Chrome trace_event JSON, which
+            can be viewed at chrome://tracing or https://ui.perfetto.dev
+"""
+
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+import shutil2
+import task_times
+
+# cache status of tasks that don't use a cache
+CACHE_NONE = '-'
+
+
+class BuildTrace:
+
+    """ An append-only trace of the actions run by a build, shared by all
+        doit processes of the build. Set as the 'build trace' variable of a
+        GccEnv to trace its tasks.
+
+        Each traced action records its wall time, cpu time, the peak
+        memory use (RSS) of the processes it ran, its exit code, and for
+        compiles through an objcache.ObjectCache, whether the cache was
+        hit. Peak memory and cpu time are only available where the os
+        reports them, and are None otherwise. Python-actions that take a
+        run_cmd argument, such as ObjectCache.compile, CompileFarm.compile
+        and gcc_utils.update_archive, run their commands through the trace
+        so that each command's peak memory is known.
+
+        The trace is a file of JSON objects, one per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # identifies the actions run by this doit run
+        self.session = '%d.%d' % (time.time() * 1000, os.getpid())
+
+    def run(self, name, action, changed, stage=task_times.STAGE_COMPILE):
+        """ doit python-action. Run action, which is either a command
+            argument list or a python-action tuple, and record it in the
+            trace. changed is passed on to the python action if it takes
+            it, as doit would, and so is a run_cmd function that traces
+            the commands the python action runs.
+        """
+        start = time.time()
+        cmd_results = []
+
+        def run_cmd(cmd, shell=False):
+            cmd_results.append(_run_cmd(cmd, shell))
+            return cmd_results[-1][0]
+
+        before = _get_usage()
+        result = task_times.run_action(action, changed, run_cmd)
+        cache_status = CACHE_NONE
+        if isinstance(action, list):
+            exit_code, cpu, max_rss = cmd_results[0]
+        else:
+            cpu, max_rss = _get_usage_since(before)
+            exit_code = 1 if result is False else 0
+            cmd_max_rss = [r[2] for r in cmd_results if r[2] is not None]
+            if cmd_max_rss:
+                max_rss = max(cmd_max_rss)
+            # eg. ObjectCache.compile
+            cache_status = getattr(getattr(action[0], '__self__', None),
+                                   'last_status', CACHE_NONE)
+        self._record({
+            'session': self.session,
+            'name': name,
+            'stage': stage,
+            'start': start,
+            'end': time.time(),
+            'cpu': cpu,
+            'max_rss': max_rss,
+            'exit_code': exit_code,
+            'cache': cache_status,
+            'pid': os.getpid(),
+        })
+        return result
+
+    def get_traced_action(self, name, action, stage=task_times.STAGE_COMPILE):
+        """ Return a doit action that runs action and traces it """
+        return (self.run, [name, action], {'stage': stage})
+
+    def get_records(self, session=None):
+        """ Return the records of the given session, by default the most
+            recent one, in the order they were recorded
+        """
+        records = self._read_records()
+        if session is None and records:
+            session = records[-1]['session']
+        return [r for r in records if r['session'] == session]
+
+    def get_summary(self, num_tasks=10):
+        """ Return a summary of the slowest tasks of the most recent build """
+        records = self.get_records()
+        if not records:
+            return 'No actions traced in ' + self.path
+        wall = max(r['end'] for r in records) - min(r['start'] for r in records)
+        failed = len([r for r in records if r['exit_code'] != 0])
+        hits = len([r for r in records if r['cache'] == 'hit'])
+        remote_hits = len([r for r in records if r['cache'] == 'remote hit'])
+        misses = len([r for r in records if r['cache'] == 'miss'])
+        lines = [
+            'actions: %d (%d failed), cache hits: %d, remote hits: %d, '
+            'misses: %d' % (len(records), failed, hits, remote_hits, misses),
+            'build wall time: %.2f s, action cpu time: %.2f s' % (
+                wall, sum(r['cpu'] or 0 for r in records)),
+            '',
+            '%8s %8s %9s %4s %5s  %s' % (
+                'wall s', 'cpu s', 'rss MB', 'exit', 'cache', 'task'),
+        ]
+        slowest = sorted(records, key=lambda r: r['start'] - r['end'])
+        for r in slowest[:num_tasks]:
+            lines.append('%8.3f %8s %9s %4d %5s  %s' % (
+                r['end'] - r['start'],
+                '-' if r['cpu'] is None else '%.3f' % r['cpu'],
+                '-' if r['max_rss'] is None else
+                '%.1f' % (r['max_rss'] / 1024.0),
+                r['exit_code'], r['cache'], r['name']))
+        return '\n'.join(lines)
+
+    def get_chrome_trace(self, session=None):
+        """ Return the records of a session, by default the most recent
+            one, as a Chrome trace_event dictionary. Each doit process is
+            shown as a thread.
+        """
+        records = self.get_records(session)
+        origin = min(r['start'] for r in records) if records else 0
+        events = []
+        for r in records:
+            events.append({
+                'name': r['name'],
+                'cat': r['stage'],
+                'ph': 'X',
+                'ts': int((r['start'] - origin) * 1e6),
+                'dur': int((r['end'] - r['start']) * 1e6),
+                'pid': 1,
+                'tid': r['pid'],
+                'args': {
+                    'cpu s': r['cpu'],
+                    'max rss kB': r['max_rss'],
+                    'exit code': r['exit_code'],
+                    'cache': r['cache'],
+                },
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path, session=None):
+        """ Write get_chrome_trace() to a JSON file """
+        with open(path, 'w') as outfile:
+            json.dump(self.get_chrome_trace(session), outfile, indent=1)
+
+    #------------------------------------------------
+    # private
+
+    def _record(self, record):
+        """ Append a line to the trace. Small appends are atomic, so this
+            is safe with several doit processes.
+        """
+        line = json.dumps(record, sort_keys=True) + '\n'
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process
+                if not os.path.isdir(directory):
+                    raise
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def _read_records(self):
+        if not os.path.isfile(self.path):
+            return []
+        records = []
+        with open(self.path) as infile:
+            for line in infile:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # partly written
+                    continue
+        return records
+
+
+#------------------------------------------------------------------------
+# private functions
+
+
+def _run_cmd(cmd, shell=False):
+    """ Run cmd, return its exit code, cpu time and peak RSS in kB """
+    if not hasattr(os, 'wait4'):
+        return shutil2.run_cmd(cmd, shell), None, None
+    usage = []
+
+    def wait(process):
+        pid, status, rusage = os.wait4(process.pid, 0)
+        usage.append(rusage)
+        # stop Popen from waiting for the process again
+        process.returncode = _get_exit_code(status)
+        return process.returncode
+
+    exit_code = shutil2.run_cmd(cmd, shell, wait)
+    return (exit_code, usage[0].ru_utime + usage[0].ru_stime,
+            _max_rss_to_kb(usage[0].ru_maxrss))
+
+
+def _get_exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _get_usage():
+    """ Return the resource usage of this process and its children """
+    if resource is None:
+        return None
+    return (resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+def _get_usage_since(before):
+    """ Return the cpu time used since _get_usage() returned before, and
+        the peak RSS in kB of any child process that finished since then.
+        Peak RSS is None if it couldn't be told apart from earlier
+        children.
+    """
+    if before is None:
+        return None, None
+    after = _get_usage()
+    cpu = 0.0
+    for usage_before, usage_after in zip(before, after):
+        cpu += (usage_after.ru_utime + usage_after.ru_stime) - \
+            (usage_before.ru_utime + usage_before.ru_stime)
+    max_rss = None
+    if after[1].ru_maxrss > before[1].ru_maxrss:
+        max_rss = _max_rss_to_kb(after[1].ru_maxrss)
+    return cpu, max_rss
+
+
+def _max_rss_to_kb(max_rss):
+    # bytes on mac, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return max_rss // 1024
+    return max_rss
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ['summary', 'chrome']:
+        print(__doc__)
+        return
+    trace = BuildTrace(sys.argv[2])
+    if sys.argv[1] == 'summary':
+        num_tasks = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+        print(trace.get_summary(num_tasks))
+    elif len(sys.argv) > 3:
+        trace.write_chrome_trace(sys.argv[3])
+    else:
+        print(__doc__)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+""" Distributed compiling, in the style of distcc.
+
+    Sources are preprocessed locally, which also writes their depfiles.
+    The preprocessed source and the compile flags that don't affect
+    preprocessing are sent to a worker, which compiles them and sends
+    back the object.
+
+    usage: python compile_farm.py [port] [slots] [host] [compilers]
+        Run a worker that compiles up to slots sources at a time (by
+        default, the number of cpus). Listens on localhost:3633 by
+        default. compilers is a comma separated list of the compilers
+        the worker will run, by default gcc, g++, cc and c++.
+
+    Workers run whatever source they're sent, so only run them on a
+    trusted network.
+"""
+
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+try:
+    from SocketServer import BaseRequestHandler, TCPServer, ThreadingMixIn
+except ImportError:
+    from socketserver import BaseRequestHandler, TCPServer, ThreadingMixIn
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import shutil2
+
+DEFAULT_PORT = 3633
+
+DEFAULT_COMPILERS = ['gcc', 'g++', 'cc', 'c++']
+
+# seconds to wait to connect to a worker
+DEFAULT_CONNECT_TIMEOUT = 2.0
+# seconds to wait for a worker to compile a source
+DEFAULT_COMPILE_TIMEOUT = 300.0
+
+# largest message accepted, in bytes
+MAX_MESSAGE_SIZE = 256 * 1024 ** 2
+
+# preprocessor options that take the next argument as their value
+PREPROCESSOR_ARGS_WITH_VALUE = ['-I', '-D', '-U', '-include', '-imacros',
+                                '-isystem', '-iquote', '-idirafter', '-MF',
+                                '-MT', '-MQ', '-iprefix', '-iwithprefix',
+                                '-iwithprefixbefore', '-isysroot',
+                                '-imultilib', '-Xpreprocessor']
+
+# compile options that take the next argument as their value
+COMPILE_ARGS_WITH_VALUE = ['--param']
+
+# prefixes of options only used when preprocessing
+PREPROCESSOR_ARG_PREFIXES = ('-I', '-D', '-U', '-M', '-include', '-imacros',
+                             '-isystem', '-iquote', '-idirafter', '-Wp,')
+
+# options a worker accepts, and prefixes of the options it accepts:
+# optimisation, debug info, warnings, code generation, machine and
+# language standard options
+ALLOWED_ARGS = ['-w', '-ansi', '-pedantic', '-pedantic-errors', '-nostdlib',
+                '-pipe']
+ALLOWED_ARG_PREFIXES = ('-O', '-g', '-W', '-f', '-m', '-std=', '--param')
+
+# prefixes of allowed options that a worker still refuses, as they could
+# run other programs, or read or write files on the worker
+UNSAFE_ARG_PREFIXES = ('-Wa,', '-Wl,', '-Wp,', '-fplugin', '-fdump',
+                       '-fprofile', '-fauto-profile', '-fopt-info',
+                       '-fcallgraph-info', '-fdiagnostics-format',
+                       '-fcompare-debug', '-fsave-optimization-record')
+
+_HEADER_FORMAT = '>IQ'
+
+# a --param value, eg. max-inline-insns-single=500
+_PARAM_VALUE_REGEX = re.compile(r'^[A-Za-z0-9_.-]+=[A-Za-z0-9_.-]+$')
+
+
+class CompileFarm:
+
+    """ Compiles sources on a set of workers. Set as the 'compile farm'
+        variable of a GccEnv to use it for the environment's compile
+        tasks, and run doit with as many processes (doit -n) as there
+        are slots on all the workers.
+
+        workers is a list of 'host:port' addresses. Each source is sent
+        to the next worker in turn. Workers limit how many sources they
+        compile at once; a worker with no free slots is skipped. If no
+        worker is free, or they fail, the source is compiled locally. A
+        worker that can't be reached is not used again by this process.
+        A source whose compile a worker refuses, eg. because of an option
+        it doesn't allow, is compiled locally with a warning on stderr.
+
+        Compiles that can't be distributed, eg. of assembler sources,
+        commands with several sources or sources that -include a
+        precompiled header, are run locally, as are sources that fail to
+        preprocess. last_host is the address of the worker that ran the
+        last compile, or 'localhost'.
+    """
+
+    def __init__(self, workers, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 compile_timeout=DEFAULT_COMPILE_TIMEOUT):
+        self.workers = list(workers)
+        self.connect_timeout = connect_timeout
+        self.compile_timeout = compile_timeout
+        self.last_host = None
+        self._failed = set()
+        # set on first use, as doit -n forks its processes after the farm
+        # is created
+        self._next_worker = None
+
+    def compile(self, compiler, cmd, source, obj, dep,
+                run_cmd=shutil2.run_cmd):
+        """ doit python-action. Compile with cmd, an argument list, on a
+            worker if possible. dep is written by the local preprocessing
+            step. Local commands are run by run_cmd, see shutil2.run_cmd().
+        """
+        job = split_compile_cmd(cmd, obj, dep)
+        workers = self._get_workers()
+        if job is None or not workers:
+            return self._compile_locally(cmd, run_cmd)
+        preprocess_cmd, remote_args, suffix = job
+        preprocessed = _preprocess(preprocess_cmd, suffix, run_cmd)
+        if preprocessed is None:
+            # the local compile reports any errors
+            return self._compile_locally(cmd, run_cmd)
+
+        for worker in workers:
+            result = self._compile_remotely(worker, compiler, remote_args,
+                                            suffix, preprocessed)
+            if result is None:
+                continue
+            exit_code, errors, obj_data = result
+            if exit_code is None:
+                # refused by the worker's policy, eg. an option that
+                # could write files on the worker
+                sys.stderr.write('compile farm: %s refused to compile %s: '
+                                 '%s\n' % (worker, source, errors))
+                return self._compile_locally(cmd, run_cmd)
+            self.last_host = worker
+            if errors:
+                sys.stderr.write(errors)
+            if exit_code != 0:
+                return False
+            with open(obj, 'wb') as outfile:
+                outfile.write(obj_data)
+            return True
+        return self._compile_locally(cmd, run_cmd)
+
+    #------------------------------------------------
+    # private
+
+    def _get_workers(self):
+        """ Return the usable workers, starting with the next in turn """
+        workers = [w for w in self.workers if w not in self._failed]
+        if not workers:
+            return []
+        if self._next_worker is None:
+            # spread the doit processes of a build over the workers
+            self._next_worker = os.getpid()
+        start = self._next_worker % len(workers)
+        self._next_worker += 1
+        return workers[start:] + workers[:start]
+
+    def _compile_locally(self, cmd, run_cmd):
+        self.last_host = 'localhost'
+        return run_cmd(cmd) == 0
+
+    def _compile_remotely(self, worker, compiler, args, suffix, preprocessed):
+        """ Return (exit code, compiler errors, object data), or None if
+            the worker is busy or failed. If the worker refuses the job,
+            the exit code is None and the errors say why.
+        """
+        host, _, port = worker.rpartition(':')
+        try:
+            sock = socket.create_connection((host, int(port)),
+                                            self.connect_timeout)
+        except (socket.error, socket.timeout, ValueError):
+            self._failed.add(worker)
+            return None
+        try:
+            sock.settimeout(self.compile_timeout)
+            reply, _ = _recv_message(sock)
+            if reply.get('status') != 'ready':
+                return None
+            _send_message(sock, {'compiler': compiler, 'args': args,
+                                 'suffix': suffix}, preprocessed)
+            reply, obj_data = _recv_message(sock)
+        except (socket.error, socket.timeout, ValueError, EOFError):
+            self._failed.add(worker)
+            return None
+        finally:
+            sock.close()
+        if reply.get('status') == 'refused':
+            return None, reply.get('message', ''), b''
+        if reply.get('status') != 'done':
+            # the worker couldn't run the compiler
+            self._failed.add(worker)
+            return None
+        return reply['exit_code'], reply['errors'], obj_data
+
+
+class CompileWorker(ThreadingMixIn, TCPServer):
+
+    """ Compiles preprocessed sources sent by CompileFarm clients, up to
+        slots at a time. Only the named compilers are run, and only with
+        the options in ALLOWED_ARGS and ALLOWED_ARG_PREFIXES, so that
+        clients can't run other programs or write other files.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=DEFAULT_PORT, slots=None, host='localhost',
+                 compilers=DEFAULT_COMPILERS):
+        TCPServer.__init__(self, (host, port), _CompileRequestHandler)
+        if slots is None:
+            slots = multiprocessing.cpu_count()
+        self.slots = threading.Semaphore(slots)
+        self.compilers = list(compilers)
+
+    def get_address(self):
+        host, port = self.server_address[:2]
+        return '%s:%d' % (host, port)
+
+    def start(self):
+        """ Serve requests from a background thread, return the thread """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def check_job(self, job):
+        """ Return an error message if the job isn't allowed, else None """
+        if job.get('compiler') not in self.compilers:
+            return 'compiler not allowed: %r' % job.get('compiler')
+        if job.get('suffix') not in ['.i', '.ii']:
+            return 'unknown source type: %r' % job.get('suffix')
+        args = iter(job.get('args', []))
+        for arg in args:
+            if arg in ALLOWED_ARGS:
+                continue
+            if arg in COMPILE_ARGS_WITH_VALUE:
+                value = next(args, '')
+                if not _PARAM_VALUE_REGEX.match(value):
+                    return 'option value not allowed: %r %r' % (arg, value)
+            elif not arg.startswith(ALLOWED_ARG_PREFIXES) or \
+                    arg.startswith(UNSAFE_ARG_PREFIXES):
+                return 'option not allowed: %r' % arg
+        return None
+
+    def compile(self, job, preprocessed):
+        """ Return (exit code, compiler errors, object data) """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmp_dir, 'source' + job['suffix'])
+            obj = os.path.join(tmp_dir, 'source.o')
+            with open(source, 'wb') as outfile:
+                outfile.write(preprocessed)
+            process = subprocess.Popen(
+                [job['compiler']] + job['args'] + ['-c', source, '-o', obj],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            errors = process.communicate()[0]
+            obj_data = b''
+            if process.returncode == 0:
+                with open(obj, 'rb') as infile:
+                    obj_data = infile.read()
+            return process.returncode, errors.decode('utf-8', 'replace'), \
+                obj_data
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class _CompileRequestHandler(BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        if not server.slots.acquire(False):
+            _send_message(self.request, {'status': 'busy'})
+            return
+        try:
+            _send_message(self.request, {'status': 'ready'})
+            job, preprocessed = _recv_message(self.request)
+            error = server.check_job(job)
+            if error is not None:
+                _send_message(self.request, {'status': 'refused',
+                                             'message': error})
+                return
+            try:
+                exit_code, errors, obj_data = server.compile(job,
+                                                             preprocessed)
+            except OSError as e:
+                # eg. the compiler isn't installed
+                _send_message(self.request, {'status': 'error',
+                                             'message': str(e)})
+                return
+            _send_message(self.request, {'status': 'done',
+                                         'exit_code': exit_code,
+                                         'errors': errors}, obj_data)
+        except (socket.error, ValueError, EOFError):
+            pass
+        finally:
+            server.slots.release()
+
+
+def split_compile_cmd(cmd, obj, dep):
+    """ Split a gcc compile command, an argument list, into a command
+        that preprocesses the source and writes its depfile to dep, and
+        the compile options for the preprocessed source. Return
+        (preprocess command, compile options, preprocessed source suffix),
+        or None if the compile can't be distributed. The preprocess
+        command still needs '-E -o <output>' added.
+
+        Compiles that -include a precompiled header (a header with a .gch
+        next to it) aren't distributed. Locally, the precompiled header
+        saves parsing the header, but a worker would have to compile all
+        of its preprocessed text.
+    """
+    if not isinstance(cmd, list) or '-c' not in cmd:
+        return None
+    preprocess_cmd = [cmd[0]]
+    compile_args = []
+    sources = []
+    language = None
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg == '-c':
+            continue
+        elif arg == '-o':
+            next(args, None)
+        elif arg == '-x':
+            language = next(args, None)
+            preprocess_cmd += [arg, language]
+        elif arg == '-include':
+            header = next(args, '')
+            if os.path.isfile(header + '.gch'):
+                return None
+            preprocess_cmd += [arg, header]
+        elif arg in PREPROCESSOR_ARGS_WITH_VALUE:
+            preprocess_cmd += [arg, next(args, '')]
+        elif arg in COMPILE_ARGS_WITH_VALUE:
+            value = next(args, '')
+            preprocess_cmd += [arg, value]
+            compile_args += [arg, value]
+        elif arg.startswith(PREPROCESSOR_ARG_PREFIXES):
+            preprocess_cmd.append(arg)
+        elif not arg.startswith('-'):
+            sources.append(arg)
+            preprocess_cmd.append(arg)
+        else:
+            # eg. -O2, -std=c99 and -mmcu=, which also set predefined macros
+            preprocess_cmd.append(arg)
+            compile_args.append(arg)
+    if len(sources) != 1:
+        return None
+    if language is None:
+        language = 'c' if sources[0].endswith('.c') else 'c++'
+    if language not in ['c', 'c++'] or sources[0].endswith(('.s', '.S')):
+        return None
+    if any(a in preprocess_cmd for a in ['-MD', '-MMD']):
+        if '-MF' not in preprocess_cmd:
+            preprocess_cmd += ['-MF', dep]
+        if '-MT' not in preprocess_cmd and '-MQ' not in preprocess_cmd:
+            preprocess_cmd += ['-MT', obj]
+    return preprocess_cmd, compile_args, '.i' if language == 'c' else '.ii'
+
+
+#------------------------------------------------------------------------
+# private functions
+
+
+def _preprocess(preprocess_cmd, suffix, run_cmd):
+    """ Return the preprocessed source from preprocess_cmd, run by
+        run_cmd, or None if preprocessing failed. Preprocessor warnings
+        are written to sys.stderr, errors are left for the local compile
+        to report.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        preprocessed_path = os.path.join(tmp_dir, 'source' + suffix)
+        # run_cmd writes the command's output to sys.stdout and sys.stderr
+        output = StringIO()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = output
+        try:
+            exit_code = run_cmd(preprocess_cmd + ['-E', '-o',
+                                                  preprocessed_path])
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        if exit_code != 0:
+            return None
+        if output.getvalue():
+            sys.stderr.write(output.getvalue())
+        with open(preprocessed_path, 'rb') as infile:
+            return infile.read()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _send_message(sock, header, body=b''):
+    """ Send a JSON header and a byte string body """
+    header_data = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack(_HEADER_FORMAT, len(header_data), len(body)) +
+                 header_data)
+    if body:
+        sock.sendall(body)
+
+
+def _recv_message(sock):
+    """ Return the header and body of a message from _send_message() """
+    header_size, body_size = struct.unpack(
+        _HEADER_FORMAT, _recv_exactly(sock, struct.calcsize(_HEADER_FORMAT)))
+    if header_size > MAX_MESSAGE_SIZE or body_size > MAX_MESSAGE_SIZE:
+        raise ValueError('message too large')
+    header = json.loads(_recv_exactly(sock, header_size).decode('utf-8'))
+    if not isinstance(header, dict):
+        raise ValueError('invalid message')
+    return header, _recv_exactly(sock, body_size)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
+        print(__doc__)
+        return
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    slots = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    host = sys.argv[3] if len(sys.argv) > 3 else 'localhost'
+    compilers = sys.argv[4].split(',') if len(sys.argv) > 4 else \
+        DEFAULT_COMPILERS
+    worker = CompileWorker(port, slots, host, compilers)
+    print('Compiling with %s at %s' % (', '.join(compilers),
+                                       worker.get_address()))
+    worker.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
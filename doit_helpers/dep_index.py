@@ -0,0 +1,195 @@
+""" Reverse dependency index, to find what a change to a file rebuilds.
+
+    usage: python dep_index.py [options] <build dir> <file>...
+        Print the targets rebuilt when the given files change, and an
+        estimate of how long the rebuild will take. Run with --help for
+        the options.
+"""
+
+import argparse
+import os
+
+import task_times
+
+
+class DependencyIndex:
+
+    """ Index of the dependencies between files and build targets, in both
+        directions: target -> dependencies, eg. object -> source and
+        headers, and dependency -> targets, eg. header -> objects.
+
+        Built from a dependency dictionary of target : [dependencies],
+        eg. from get_dependency_dict(), and optionally a dictionary of
+        link output : [inputs]. Link outputs are treated as targets, so
+        rebuild sets follow a header through the objects that include it
+        to the programs and libraries they're linked into.
+
+        Lookups are dictionary lookups. Rebuild sets are computed once per
+        file and remembered.
+
+        Paths given to the index are compared as absolute paths, relative
+        to the current directory, so 'include/a.h' and its absolute path
+        are the same file. Returned paths are the targets' names as they
+        were given to the index.
+    """
+
+    def __init__(self, dependencies, links={}):
+        # key : name as given
+        self._names = {}
+        # target key : set of dependency keys
+        self._dependencies = {}
+        # dependency key : set of target keys
+        self._dependents = {}
+        self._link_outputs = set()
+        # file key : frozenset of target keys rebuilt when it changes
+        self._rebuild_sets = {}
+        for target, deps in dependencies.items():
+            self._add(target, deps)
+        for output, inputs in links.items():
+            self._link_outputs.add(self._add(output, inputs))
+
+    def get_dependencies(self, target):
+        """ Return the direct dependencies of target """
+        return self._get_names(self._dependencies.get(self._key(target), ()))
+
+    def get_dependents(self, path):
+        """ Return the targets that depend directly on path, eg. the
+            objects that include a header
+        """
+        return self._get_names(self._dependents.get(self._key(path), ()))
+
+    def get_rebuild_set(self, paths):
+        """ Return the targets that must be rebuilt if any of paths
+            change: the targets that depend on them, the targets that
+            depend on those, and so on up to the link outputs
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        keys = set()
+        for path in paths:
+            keys |= self._get_rebuild_keys(self._key(path))
+        return self._get_names(keys)
+
+    def is_link_output(self, target):
+        return self._key(target) in self._link_outputs
+
+    def get_rebuild_cost(self, paths, times, jobs=1):
+        """ Return the estimated (serial, parallel) time in seconds to
+            rebuild the targets affected by paths, from the durations
+            recorded by a task_times.TaskTimes. The parallel estimate
+            assumes jobs doit processes, and that the link outputs are
+            built one after another once everything else is done.
+        """
+        targets = self.get_rebuild_set(paths)
+        compiles = [t for t in targets if not self.is_link_output(t)]
+        links = [t for t in targets if self.is_link_output(t)]
+        serial = sum(times.get_duration(t) for t in targets)
+        return serial, times.get_estimated_makespan(compiles, links, jobs)
+
+    def get_rebuild_report(self, paths, times=None, jobs=1):
+        """ Return a printable report of get_rebuild_set(), and its
+            estimated cost if times is given
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        targets = self.get_rebuild_set(paths)
+        lines = []
+        for path in paths:
+            if self._key(path) not in self._dependents:
+                lines.append('%s: not a dependency of any target' % path)
+        lines.append('%d targets rebuilt (%d linked)' % (
+            len(targets), len([t for t in targets if self.is_link_output(t)])))
+        for target in targets:
+            if times is None:
+                lines.append('    ' + target)
+            else:
+                lines.append('    %8.3f s  %s' % (times.get_duration(target),
+                                                  target))
+        if times is not None:
+            serial, parallel = self.get_rebuild_cost(paths, times, jobs)
+            lines.append('estimated rebuild time: %.2f s, %.2f s with %d '
+                         'jobs' % (serial, parallel, jobs))
+        return '\n'.join(lines)
+
+    def get_report_task(self, times=None, jobs=1):
+        """ Return a doit task that prints get_rebuild_report() for the
+            files given on the command line. Return it from a task
+            creator, eg.
+
+                def task_impact():
+                    return env.get_dependency_index([exe]).get_report_task()
+
+            then run 'doit impact include/config.h'.
+        """
+        def print_report(paths):
+            print(self.get_rebuild_report(paths, times, jobs))
+        return {
+            'actions': [print_report],
+            'pos_arg': 'paths',
+            'uptodate': [False],
+            'verbosity': 2
+        }
+
+    #------------------------------------------------
+    # private
+
+    def _key(self, path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def _add(self, target, deps):
+        """ Add the edges from target to deps, return target's key """
+        target_key = self._key(target)
+        self._names[target_key] = target
+        target_deps = self._dependencies.setdefault(target_key, set())
+        for dep in deps:
+            dep_key = self._key(dep)
+            self._names.setdefault(dep_key, dep)
+            target_deps.add(dep_key)
+            self._dependents.setdefault(dep_key, set()).add(target_key)
+        return target_key
+
+    def _get_rebuild_keys(self, key):
+        if key not in self._rebuild_sets:
+            found = set()
+            pending = [key]
+            while pending:
+                for dependent in self._dependents.get(pending.pop(), ()):
+                    if dependent not in found:
+                        found.add(dependent)
+                        pending.append(dependent)
+            self._rebuild_sets[key] = frozenset(found)
+        return self._rebuild_sets[key]
+
+    def _get_names(self, keys):
+        return sorted(self._names[key] for key in keys)
+
+
+def main():
+    # gcc_utils imports this module
+    import gcc_utils
+    parser = argparse.ArgumentParser(
+        description='Print the targets rebuilt when files change.')
+    parser.add_argument('build_dir', help='directory searched for depfiles')
+    parser.add_argument('paths', nargs='+', metavar='file')
+    parser.add_argument('-t', '--times', help='task times file, to estimate '
+                        'the rebuild time')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('-C', '--directory',
+                        help='directory the build was run in, that the paths '
+                        'in the depfiles are relative to')
+    parser.add_argument('-l', '--link', action='append', default=[],
+                        metavar='OUTPUT',
+                        help='a link output built from all the targets')
+    args = parser.parse_args()
+    if args.directory:
+        os.chdir(args.directory)
+
+    dependencies = gcc_utils.get_dependency_dict(args.build_dir)
+    links = dict((output, list(dependencies)) for output in args.link)
+    index = DependencyIndex(dependencies, links)
+    times = task_times.TaskTimes(args.times) if args.times else None
+    print(index.get_rebuild_report(args.paths, times, args.jobs))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,28 @@
 import copy
+import fnmatch
+import hashlib
+import multiprocessing
 import os
-from doit.tools import create_folder
-
+import re
+import shlex
+import tempfile
+import time
+from doit.tools import config_changed
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import dep_index
 import file_utils
+import shutil2
+import task_times
+
+try:
+    intern
+except NameError:
+    from sys import intern
 
 #------------------------------------------------------------------------
 # constants
@@ -13,20 +33,79 @@ DEFAULT_ENV = {
     'c compiler flags': ['-c', '-MMD'],
     'c header search paths': [],
     'c source files': [],
+    'c precompiled headers': [],
 
     'c++ compiler': 'gcc',
     'c++ preprocessor defs': [],
     'c++ compiler flags': ['-c', '-MMD'],
     'c++ header search paths': [],
     'c++ source files': [],
+    'c++ precompiled headers': [],
 
     'linker': 'gcc',
     'linker script': None,
     'linker libraries': [],
     'linker flags': [],
     'linker library search paths': [],
+
+    'archiver': 'ar',
+    # zero archive member timestamps, uids and gids, so that archiving
+    # the same objects always gives the same archive
+    'deterministic archives': False,
+
+    # number of processes used to parse dependency files. None uses
+    # all cpus.
+    'dependency scan jobs': 1,
+
+    # an objcache.ObjectCache to reuse previously compiled objects,
+    # None to always run the compiler
+    'object cache': None,
+    # a compile_farm.CompileFarm to compile on other machines, None to
+    # compile locally
+    'compile farm': None,
+
+    # a task_times.TaskTimes to record how long tasks take, and start
+    # the slowest compile tasks first. None to generate compile tasks in
+    # source list order.
+    'task times': None,
+    # a build_trace.BuildTrace to record the time and resources used by
+    # each action, None to not trace
+    'build trace': None,
+
+    # number of sources compiled together in each unity build batch,
+    # None to compile each source separately
+    'unity build batch size': None,
+    # sources that can't be compiled in a unity batch, as paths or
+    # filename patterns
+    'unity build exclude': [],
 }
 
+# file extension of generated unity build sources, by language
+UNITY_SOURCE_EXTENSIONS = {'c': '.c', 'c++': '.cpp'}
+
+# language names that can be used in file names
+LANGUAGE_FILE_NAMES = {'c': 'c', 'c++': 'cpp'}
+
+# appended to an archive's path to get the file that records the command
+# the archive was last built with
+ARCHIVE_CMD_EXTENSION = '.cmd'
+
+# task value that cmd_changed() checkers save the command digest under
+CMD_DIGEST_KEY = '_cmd_changed'
+
+# name of the dependency database file stored in each scanned directory
+DEPENDENCY_DB_FILENAME = '.depdb'
+
+# below this many depfiles, parsing is done serially even if several
+# jobs are requested, as starting worker processes costs more than it saves
+PARALLEL_DEPFILE_THRESHOLD = 2000
+
+# number of depfiles handed to a worker process at a time
+PARALLEL_DEPFILE_CHUNK_SIZE = 250
+
+# bump this whenever the format of parsed dependency data changes
+DEPENDENCY_DB_VERSION = 2
+
 #------------------------------------------------------------------------
 
 
@@ -35,6 +114,29 @@ class GccEnv:
     """ gcc environment class. Stores environment variables such
         as compiler path, preprocessor definitions etc., and provides
         methods for generating doit tasks to compile and link programs.
+
+        Headers listed in 'c precompiled headers' or 'c++ precompiled
+        headers' are precompiled with the same settings as the sources,
+        and included (with -include) at the top of every source of that
+        language. The precompile tasks are part of the compile tasks. If
+        gcc can't use a precompiled header, eg. after a change of
+        compiler, it falls back to the header itself.
+
+        If 'unity build batch size' is set, sources are grouped into
+        batches of that size (in source list order), and each batch is
+        compiled as a single generated source that #includes its members.
+        Each batch has its own object and depfile, so incremental builds
+        work per batch. get_all_objs() returns the batch objects.
+
+        The get_*_tasks methods return lists of tasks. The iter_*_tasks
+        methods generate the same tasks one at a time, which uses less
+        memory for large projects. They can be returned directly from a
+        doit task creator.
+
+        Compile tasks list every header a source includes as a file
+        dependency. Set file_checker.StatChecker as the dodo file's
+        'check_file_uptodate' so that a header shared by many tasks is
+        only hashed once per run.
     """
 
     #------------------------------------------------
@@ -43,92 +145,83 @@ class GccEnv:
     def __init__(self, build_dir):
         self.variables = copy.deepcopy(DEFAULT_ENV)
         self.variables['build directory'] = build_dir
+        self._depmap = None
 
     def get_c_compile_tasks(self):
         """ Return a list of doit tasks for compiling the c source files
             set in the environment variables.
         """
-        tasks = []
-        depmap = get_dependency_dict(self.variables['build directory'])
-        for source in self.variables['c source files']:
-            obj = self._source_to_obj_path(
-                source, self.variables['build directory'])
-            dep = self._source_to_dep_path(
-                source, self.variables['build directory'])
-            source_deps = depmap.get(obj, [source])
-            tasks.append({
-                'name': obj,
-                'actions': [(create_folder, [os.path.dirname(obj)]),
-                            get_compile_cmd_str(source, obj,
-                                                compiler=self.variables[
-                                                    'c compiler'],
-                                                defs=self.variables[
-                                                    'c preprocessor defs'],
-                                                includes=self.variables[
-                                                    'c header search paths'],
-                                                flags=self.variables[
-                                                    'c compiler flags'])],
-                'targets': [obj, dep],
-                'file_dep': source_deps,
-                'clean': True
-            })
-        return tasks
+        return list(self.iter_c_compile_tasks())
 
     def get_cpp_compile_tasks(self):
         """ Return a list of doit tasks for compiling the c++ source files
             set in the environment variables.
         """
-        tasks = []
-        depmap = get_dependency_dict(self.variables['build directory'])
-        for source in self.variables['c++ source files']:
-            obj = self._source_to_obj_path(
-                source, self.variables['build directory'])
-            dep = self._source_to_dep_path(
-                source, self.variables['build directory'])
-            source_deps = depmap.get(obj, [source])
-            tasks.append({
-                'name': obj,
-                'actions': [(create_folder, [os.path.dirname(obj)]),
-                            get_compile_cmd_str(source, obj,
-                                                compiler=self.variables[
-                                                    'c++ compiler'],
-                                                defs=self.variables[
-                                                    'c++ preprocessor defs'],
-                                                includes=self.variables[
-                                                    'c++ header search paths'],
-                                                flags=self.variables[
-                                                    'c++ compiler flags'])],
-                'targets': [obj, dep],
-                'file_dep': source_deps,
-                'clean': True
-            })
-        return tasks
+        return list(self.iter_cpp_compile_tasks())
 
     def get_link_exe_tasks(self, exe_output):
-        return [{
+        return list(self.iter_link_exe_tasks(exe_output))
+
+    def iter_c_compile_tasks(self):
+        """ Generate the tasks of get_c_compile_tasks() """
+        for task in self._iter_compile_tasks('c'):
+            yield task
+
+    def iter_cpp_compile_tasks(self):
+        """ Generate the tasks of get_cpp_compile_tasks() """
+        for task in self._iter_compile_tasks('c++'):
+            yield task
+
+    def iter_link_exe_tasks(self, exe_output):
+        """ Generate the tasks of get_link_exe_tasks() """
+        objs = self.get_all_objs()
+        link_cmd = get_link_cmd_args(exe_output, objs,
+                                     linker=self.variables['linker'],
+                                     libdirs=self.variables[
+                                         'linker library search paths'],
+                                     libs=self.variables['linker libraries'],
+                                     flags=self.variables['linker flags'])
+        yield {
             'name': exe_output,
-            'actions': [get_link_cmd_str(exe_output, self.get_all_objs(),
-                                         linker=self.variables['linker'],
-                                         libdirs=self.variables[
-                                             'linker library search paths'],
-                                         libs=self.variables[
-                                             'linker libraries'],
-                                         flags=self.variables[
-                                             'linker flags'])],
-            'file_dep': self.get_all_objs(),
+            'actions': [self._instrument_action(exe_output, link_cmd,
+                                                task_times.STAGE_LINK)],
+            'file_dep': objs,
             'targets': [exe_output],
+            'uptodate': [cmd_changed(link_cmd)],
             'clean': True
-        }]
+        }
 
     def get_all_objs(self):
         """ Return a list of all compiler output objects (.o files) """
-        all_sources = self.variables[
-            'c source files'] + self.variables['c++ source files']
-        objs = []
-        for src in all_sources:
-            objs.append(self._source_to_obj_path(
-                src, self.variables['build directory']))
-        return objs
+        build_dir = self.variables['build directory']
+        all_sources = self._get_compiled_sources('c') + \
+            self._get_compiled_sources('c++')
+        return [self._source_to_obj_path(src, build_dir)
+                for src in all_sources]
+
+    def get_dependency_index(self, link_outputs=[]):
+        """ Return a dep_index.DependencyIndex of the build directory's
+            dependency files, with each of link_outputs linked from all
+            the objects. See get_dependency_index_task() to query it.
+        """
+        objs = self.get_all_objs()
+        return dep_index.DependencyIndex(
+            self._get_dependency_map(),
+            dict((output, objs) for output in link_outputs))
+
+    def get_dependency_index_task(self, link_outputs=[], jobs=1):
+        """ Return a doit task that prints the targets rebuilt when the
+            files given on the command line change, with the estimated
+            rebuild time if the 'task times' variable is set. Return it
+            from a task creator, eg.
+
+                def task_impact():
+                    return env.get_dependency_index_task(['build/app.exe'])
+
+            then run 'doit impact include/config.h'.
+        """
+        return self.get_dependency_index(link_outputs).get_report_task(
+            self.variables['task times'], jobs)
 
     def __str__(self):
         """ Pretty-print all environment varialbes """
@@ -145,6 +238,203 @@ class GccEnv:
     #------------------------------------------------
     # private
 
+    def _iter_compile_tasks(self, language):
+        """ Generate doit tasks for compiling the source files of the
+            given language, 'c' or 'c++'
+        """
+        dirs_stamp = self._get_output_dirs_stamp(language)
+        yield self._get_output_dirs_task(language)
+        for task in self._get_precompiled_header_tasks(language):
+            yield task
+        for task in self._get_unity_source_tasks(language):
+            yield task
+        build_dir = self.variables['build directory']
+        unity_members = dict(self._get_unity_batches(language))
+        depmap = self._get_dependency_map()
+        compiler = self.variables[language + ' compiler']
+        cache = self.variables['object cache']
+        farm = self.variables['compile farm']
+        times = self.variables['task times']
+        timed_tasks = []
+        pch_args = []
+        pch_deps = []
+        for header in self.variables[language + ' precompiled headers']:
+            gch = self._header_to_pch_path(header, language)
+            pch_args += ['-include', gch[:-len('.gch')]]
+            pch_deps += [gch, gch[:-len('.gch')]]
+        for source in self._get_compiled_sources(language):
+            obj = self._source_to_obj_path(source, build_dir)
+            dep = self._source_to_dep_path(source, build_dir)
+            source_deps = depmap.get(obj, [source]) + pch_deps + [dirs_stamp]
+            if source in unity_members:
+                source_deps = source_deps + unity_members[source]
+            compile_cmd = get_compile_cmd_args(
+                source, obj,
+                compiler=compiler,
+                defs=self.variables[language + ' preprocessor defs'],
+                includes=self.variables[language + ' header search paths'],
+                flags=self.variables[language + ' compiler flags'],
+                extra_args=pch_args)
+            if cache is not None:
+                compile_action = (cache.compile,
+                                  [compiler, compile_cmd, source, obj, dep],
+                                  {'farm': farm})
+            elif farm is not None:
+                compile_action = (farm.compile,
+                                  [compiler, compile_cmd, source, obj, dep])
+            else:
+                compile_action = compile_cmd
+            task = {
+                'name': obj,
+                'actions': [self._instrument_action(obj, compile_action)],
+                'targets': [obj, dep],
+                'file_dep': source_deps,
+                'uptodate': [cmd_changed(compile_cmd)],
+                'clean': True
+            }
+            if times is None:
+                yield task
+            else:
+                timed_tasks.append(task)
+        for task in self._sort_timed_tasks(timed_tasks):
+            yield task
+
+    def _instrument_action(self, name, action,
+                           stage=task_times.STAGE_COMPILE):
+        """ Return action, timed and traced if the environment has task
+            times and a build trace
+        """
+        return instrument_action(name, action, stage,
+                                 self.variables['task times'],
+                                 self.variables['build trace'])
+
+    def _sort_timed_tasks(self, tasks):
+        """ Return tasks longest first, if there are task times """
+        times = self.variables['task times']
+        if times is None:
+            return tasks
+        return times.sort_tasks(tasks)
+
+    def _get_compiled_sources(self, language):
+        """ Return the sources of the given language that are passed to the
+            compiler: generated unity sources, and any sources that aren't
+            part of a unity batch
+        """
+        if self.variables['unity build batch size'] is None:
+            return self.variables[language + ' source files']
+        return self._get_unity_excluded_sources(language) + \
+            [unity_source for unity_source, members
+             in self._get_unity_batches(language)]
+
+    def _get_unity_excluded_sources(self, language):
+        patterns = self.variables['unity build exclude']
+        return [source for source in self.variables[language + ' source files']
+                if any(fnmatch.fnmatch(source, p) or
+                       fnmatch.fnmatch(os.path.basename(source), p)
+                       for p in patterns)]
+
+    def _get_unity_batches(self, language):
+        """ Return a list of (unity source path, [member sources]) """
+        batch_size = self.variables['unity build batch size']
+        if batch_size is None:
+            return []
+        excluded = set(self._get_unity_excluded_sources(language))
+        sources = [x for x in self.variables[language + ' source files']
+                   if x not in excluded]
+        unity_name = 'unity_' + LANGUAGE_FILE_NAMES[language]
+        batches = []
+        for i in range(0, len(sources), batch_size):
+            unity_source = os.path.join(
+                self.variables['build directory'], 'unity',
+                '%s_%d%s' % (unity_name, i // batch_size,
+                             UNITY_SOURCE_EXTENSIONS[language]))
+            batches.append((unity_source, sources[i:i + batch_size]))
+        return batches
+
+    def _get_unity_source_tasks(self, language):
+        """ Return a list of doit tasks that generate the unity sources """
+        tasks = []
+        for unity_source, members in self._get_unity_batches(language):
+            tasks.append({
+                'name': unity_source,
+                'actions': [(write_unity_source, [unity_source, members])],
+                'targets': [unity_source],
+                'file_dep': [self._get_output_dirs_stamp(language)],
+                'uptodate': [config_changed(' '.join(members))],
+                'clean': True
+            })
+        return tasks
+
+    def _get_precompiled_header_tasks(self, language):
+        """ Return a list of doit tasks for precompiling the headers of
+            the given language, 'c' or 'c++'
+        """
+        tasks = []
+        depmap = self._get_dependency_map()
+        for header in self.variables[language + ' precompiled headers']:
+            gch = self._header_to_pch_path(header, language)
+            dep = gch + '.d'
+            pch_cmd = get_pch_cmd_args(
+                header, gch, dep, language,
+                compiler=self.variables[language + ' compiler'],
+                defs=self.variables[language + ' preprocessor defs'],
+                includes=self.variables[language + ' header search paths'],
+                flags=self.variables[language + ' compiler flags'])
+            stub = gch[:-len('.gch')]
+            tasks.append({
+                'name': gch,
+                'actions': [self._instrument_action(gch, pch_cmd),
+                            (write_pch_stub, [stub, header])],
+                'targets': [gch, dep, stub],
+                'file_dep': depmap.get(gch, [header]) +
+                [self._get_output_dirs_stamp(language)],
+                'uptodate': [cmd_changed(pch_cmd)],
+                'clean': True
+            })
+        return tasks
+
+    def _get_output_dirs_task(self, language):
+        """ Return a doit task that creates all output directories needed
+            to compile the given language, so that each compile task
+            doesn't have to
+        """
+        build_dir = self.variables['build directory']
+        dirs = [os.path.join(build_dir, 'obj')]
+        if self.variables[language + ' precompiled headers']:
+            dirs.append(os.path.join(build_dir, 'pch', language))
+        if self._get_unity_batches(language):
+            dirs.append(os.path.join(build_dir, 'unity'))
+        stamp = self._get_output_dirs_stamp(language)
+        return {
+            'name': stamp,
+            'actions': [(create_output_dirs, [dirs, stamp])],
+            'targets': [stamp],
+            'uptodate': [config_changed(' '.join(dirs))],
+            'clean': True
+        }
+
+    def _get_output_dirs_stamp(self, language):
+        """ Return the path of the file written once the output directories
+            for the given language have been created. Tasks that write to
+            those directories depend on it.
+        """
+        return os.path.join(self.variables['build directory'], 'obj',
+                            '.dirs_' + LANGUAGE_FILE_NAMES[language])
+
+    def _header_to_pch_path(self, header, language):
+        return os.path.join(self.variables['build directory'], 'pch',
+                            language, os.path.basename(header)) + '.gch'
+
+    def _get_dependency_map(self):
+        """ Return the target : [dependencies] map for the build directory.
+            Only scanned once per environment.
+        """
+        if self._depmap is None:
+            self._depmap = get_dependency_dict(
+                self.variables['build directory'],
+                jobs=self.variables['dependency scan jobs'])
+        return self._depmap
+
     def _source_to_obj_path(self, src, build_dir):
         src_filename = os.path.basename(src)
         return os.path.join(build_dir, 'obj', src_filename) + '.o'
@@ -154,79 +444,510 @@ class GccEnv:
         return os.path.join(build_dir, 'obj', src_filename) + '.d'
 
 
-def get_compile_cmd_str(src, obj, compiler='gcc', defs=[], includes=[], flags=[]):
+def get_compile_cmd_args(src, obj, compiler='gcc', defs=[], includes=[],
+                         flags=[], extra_args=[]):
+    """ Return the command to compile src to obj as an argument list,
+        which doit runs directly rather than through a shell. Flags and
+        defs are split into arguments the way a shell would, so '-x c'
+        is two arguments and quoting still works, eg. '-Wl,-Map,"a b.map"'
+        or 'VERSION=\\"1.0\\"'. extra_args are added after the flags as
+        they are, so they can hold paths with spaces, eg.
+        ['-include', 'my build/pch/c/big.h'].
+    """
+    flags = _split_flags(flags)
     cmd_args = [compiler]
-    cmd_args += ['-D' + d for d in defs]
+    cmd_args += _split_flags(['-D' + d for d in defs])
     cmd_args += ['-I' + i for i in includes]
     cmd_args += flags
+    cmd_args += extra_args
     if '-c' not in flags:
         cmd_args += ['-c']
     cmd_args += ['-o', obj]
     cmd_args += [src]
-    return _arg_list_to_command_string(cmd_args)
+    return cmd_args
 
 
-def get_link_cmd_str(target, objs, linker='gcc', libdirs=[], libs=[], flags=[],
-                     linker_script=None):
+def get_compile_cmd_str(src, obj, compiler='gcc', defs=[], includes=[], flags=[],
+                        extra_args=[]):
+    return _arg_list_to_command_string(get_compile_cmd_args(
+        src, obj, compiler, defs, includes, flags, extra_args))
+
+
+def instrument_action(name, action, stage=task_times.STAGE_COMPILE,
+                      times=None, trace=None):
+    """ Return a doit action that runs action, an argument list or a
+        python-action tuple, recording it in times (a task_times.TaskTimes)
+        and trace (a build_trace.BuildTrace) if they're given.
+    """
+    if trace is not None:
+        action = trace.get_traced_action(name, action, stage)
+    if times is not None:
+        action = times.get_timed_action(name, action, stage)
+    return action
+
+
+def cmd_changed(cmd):
+    """ Return a doit uptodate checker for a task that runs cmd, an
+        argument list or a command string. The task is out of date if cmd
+        differs from the command it last ran, eg. because flags or
+        defines were changed, even if its file_dep are unchanged.
+    """
+    return _CmdChanged(cmd)
+
+
+def create_output_dirs(dirs, stamp):
+    """ Create the given directories if they don't exist, then write the
+        (empty) stamp file
+    """
+    for path in dirs:
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # created by another process
+                if not os.path.isdir(path):
+                    raise
+    with open(stamp, 'w'):
+        pass
+
+
+def write_unity_source(path, sources):
+    """ Write a unity build source that #includes all the given sources.
+        The file is only rewritten if its contents change.
+    """
+    contents = ''.join(
+        '#include "%s"\n' % os.path.abspath(x).replace('\\', '/')
+        for x in sources)
+    if os.path.isfile(path):
+        with open(path) as infile:
+            if infile.read() == contents:
+                return
+    with open(path, 'w') as outfile:
+        outfile.write(contents)
+
+
+def write_pch_stub(path, header):
+    """ Write a header that #includes header, for sources to -include
+        in place of a precompiled header. gcc uses path + '.gch' when it
+        is valid for the compile, and otherwise reads this stub and so
+        the header itself. The file is only rewritten if its contents
+        change.
+    """
+    write_unity_source(path, [header])
+
+
+def get_pch_cmd_args(header, gch, dep, language, compiler='gcc', defs=[],
+                     includes=[], flags=[]):
+    """ Return the command to precompile header to gch as an argument
+        list, writing its dependencies to dep. language is 'c' or 'c++'.
+        Use the same defs, includes and flags as the sources that will
+        use the header.
+
+        To use the precompiled header, write a stub header with
+        write_pch_stub() to gch without its '.gch' extension, and add
+        '-include' and the stub to a source's extra_args.
+    """
+    # -x applies to the inputs that follow it, so this overrides any
+    # '-x c' or '-x c++' in flags
+    pch_args = ['-MMD', '-MF', dep, '-x', language + '-header']
+    return get_compile_cmd_args(header, gch, compiler=compiler, defs=defs,
+                                includes=includes, flags=flags,
+                                extra_args=pch_args)
+
+
+def get_pch_cmd_str(header, gch, dep, language, compiler='gcc', defs=[],
+                    includes=[], flags=[]):
+    return _arg_list_to_command_string(get_pch_cmd_args(
+        header, gch, dep, language, compiler, defs, includes, flags))
+
+
+def get_link_cmd_args(target, objs, linker='gcc', libdirs=[], libs=[],
+                      flags=[], linker_script=None):
+    """ Return the link command as an argument list. See
+        get_compile_cmd_args().
+    """
     cmd_args = [linker]
-    cmd_args += flags
+    cmd_args += _split_flags(flags)
     cmd_args += ['-L' + d for d in libdirs]
     if linker_script is not None:
         cmd_args += ['-T' + linker_script]
     cmd_args += ['-o', target]
     cmd_args += objs
     cmd_args += ['-l' + lib for lib in libs]
-    return _arg_list_to_command_string(cmd_args)
+    return cmd_args
+
+
+def get_link_cmd_str(target, objs, linker='gcc', libdirs=[], libs=[], flags=[],
+                     linker_script=None):
+    return _arg_list_to_command_string(get_link_cmd_args(
+        target, objs, linker, libdirs, libs, flags, linker_script))
+
+
+def get_archive_cmd_args(archiver, archive, objs, deterministic=False):
+    """ Return the command to add objs to archive, creating it if needed,
+        as an argument list. See 'deterministic archives'.
+    """
+    modifiers = 'rcsD' if deterministic else 'rcs'
+    return [archiver, modifiers, archive] + list(objs)
+
 
+def update_archive(archiver, archive, objs, changed, deterministic=False,
+                   run_cmd=shutil2.run_cmd):
+    """ doit python-action. Bring archive up to date with objs.
 
-def get_dependency_dict(path, depfile_pattern='*.d'):
+        If the archive was last built by the same command, only the
+        objects in changed are replaced. doit fills in changed with the
+        task's changed file_dep. Otherwise the archive is rebuilt from
+        scratch, so members of removed objects don't linger. The command
+        is recorded in archive + ARCHIVE_CMD_EXTENSION, which should be
+        one of the task's targets. The archiver is run by run_cmd, see
+        shutil2.run_cmd().
+    """
+    cmd = get_archive_cmd_args(archiver, archive, objs, deterministic)
+    cmd_path = archive + ARCHIVE_CMD_EXTENSION
+    last_cmd = None
+    if os.path.isfile(cmd_path):
+        with open(cmd_path) as infile:
+            last_cmd = infile.read().splitlines()
+
+    if last_cmd == cmd and os.path.isfile(archive) and changed is not None:
+        changed = set(changed)
+        objs_to_add = [obj for obj in objs if obj in changed]
+        if not objs_to_add:
+            return True
+    else:
+        if os.path.isfile(archive):
+            os.remove(archive)
+        objs_to_add = objs
+
+    if os.path.isfile(cmd_path):
+        os.remove(cmd_path)
+    if run_cmd(get_archive_cmd_args(
+            archiver, archive, objs_to_add, deterministic)) != 0:
+        return False
+    with open(cmd_path, 'w') as outfile:
+        outfile.write('\n'.join(cmd) + '\n')
+    return True
+
+
+def get_dependency_dict(path, depfile_pattern='*.d', jobs=1):
     """ Search path and all subdirectories for dependency files,
-        return a dictionary of target : [dependencies] pairs
+        return a dictionary of target : [dependencies] pairs.
+
+        Parsed depfiles are cached in the process-wide dependency
+        database, see get_dependency_db(). See read_dependency_files()
+        for jobs.
+    """
+    return _dependency_db.get_dependency_dict(path, depfile_pattern, jobs)
+
+
+def get_dependency_db():
+    """ Return the dependency database shared by all environments
+        in this process.
+    """
+    return _dependency_db
+
+
+class DependencyDb:
+
+    """ Cache of parsed gcc dependency files. Stores the targets and
+        dependencies of each depfile along with the depfile's modification
+        time and size, so that a depfile is only re-parsed when it changes.
+
+        The cache is kept in memory for the life of the process, and
+        saved to a database file in each directory that is scanned, so
+        that unchanged depfiles are not re-parsed by later doit runs.
     """
-    depfiles = file_utils.find(path, depfile_pattern, search_subdirs=True)
-    deps = {}
-    for dep in depfiles:
-        deps.update(read_dependency_file(dep))
-    return deps
+
+    # depfiles modified less than this many seconds before they were
+    # parsed aren't cached, since another change within the filesystem's
+    # timestamp resolution wouldn't change the mtime
+    RACY_INTERVAL = 2.0
+
+    def __init__(self):
+        # depfile path : (mtime, size, {target : [dependencies]})
+        self.entries = {}
+        self._loaded_dbs = set()
+        # database path : number of entries in the saved database
+        self._num_saved = {}
+
+    def get_dependency_dict(self, path, depfile_pattern='*.d', jobs=1):
+        """ Search path and all subdirectories for dependency files,
+            return a dictionary of target : [dependencies] pairs
+        """
+        db_path = os.path.join(path, DEPENDENCY_DB_FILENAME)
+        self._load(db_path)
+        depfiles = file_utils.find(path, depfile_pattern, search_subdirs=True)
+        scanned = []
+        stale = {}
+        for depfile in depfiles:
+            key = os.path.abspath(depfile)
+            try:
+                stat = os.stat(depfile)
+            except OSError:
+                continue
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != stat.st_mtime or \
+                    entry[1] != stat.st_size:
+                stale[depfile] = (key, stat)
+            scanned.append(key)
+
+        racy = {}
+        if stale:
+            parsed = read_dependency_files(list(stale.keys()), jobs)
+            now = time.time()
+            for depfile, (key, stat) in stale.items():
+                entry = (stat.st_mtime, stat.st_size, parsed[depfile])
+                if now - stat.st_mtime < self.RACY_INTERVAL:
+                    racy[key] = entry
+                    self.entries.pop(key, None)
+                else:
+                    self.entries[key] = entry
+
+        deps = {}
+        for key in scanned:
+            deps.update((racy.get(key) or self.entries[key])[2])
+        entries = dict((k, self.entries[k]) for k in scanned
+                       if k in self.entries)
+        if stale or len(entries) != self._num_saved.get(db_path):
+            self._save(db_path, entries)
+        return deps
+
+    def clear(self):
+        """ Forget all in-memory entries. Database files are not removed. """
+        self.entries = {}
+        self._loaded_dbs = set()
+        self._num_saved = {}
+
+    #------------------------------------------------
+    # private
+
+    def _load(self, db_path):
+        if db_path in self._loaded_dbs:
+            return
+        self._loaded_dbs.add(db_path)
+        if not os.path.isfile(db_path):
+            return
+        try:
+            with open(db_path, 'rb') as infile:
+                version, entries = pickle.load(infile)
+        except Exception:
+            # corrupt or unreadable database, everything will be re-parsed
+            return
+        if version != DEPENDENCY_DB_VERSION:
+            return
+        for key, entry in entries.items():
+            self.entries.setdefault(key, entry)
+        self._num_saved[db_path] = len(entries)
+
+    def _save(self, db_path, entries):
+        db_dir = os.path.dirname(db_path)
+        if not os.path.isdir(db_dir):
+            return
+        try:
+            # a temporary file of its own, as other doit processes may be
+            # saving the same database
+            fd, tmp_path = tempfile.mkstemp(dir=db_dir,
+                                            prefix=DEPENDENCY_DB_FILENAME)
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                pickle.dump((DEPENDENCY_DB_VERSION, entries), outfile,
+                            pickle.HIGHEST_PROTOCOL)
+            shutil2.replace(tmp_path, db_path)
+        except (IOError, OSError):
+            # the database is only a cache, don't fail the build over it
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._num_saved[db_path] = len(entries)
 
 
 def read_dependency_file(path):
     """ Scan a gcc-generated dependency file for targets
         and their dependencies. Returns a dictionary of
-        target : [dependencies] pairs
+        target : [dependencies] pairs.
+
+        Handles line continuations, escaped spaces and hashes, '$$',
+        rules with several targets and windows drive letters. Rules
+        without dependencies (the phony header rules written by -MP)
+        are ignored.
     """
+    with open(path) as infile:
+        return _parse_dependency_text(infile.read(), None)
 
-    def get_target_from_line(line):
-        """ Return target, remainder if a target found in the line.
-            Otherwise return None, None
-        """
-        line_split = line.split(': ')
-        if len(line_split) == 2:
-            return line_split[0], line_split[1]
-        return None, None
 
-    def get_deps_from_string(string):
-        return [s for s in string.split() if s != '\\']
+def read_dependency_files(paths, jobs=1,
+                          threshold=PARALLEL_DEPFILE_THRESHOLD,
+                          chunk_size=PARALLEL_DEPFILE_CHUNK_SIZE):
+    """ Parse many gcc-generated dependency files. Returns a dictionary
+        of depfile path : {target : [dependencies]} pairs.
+
+        Target and dependency strings are interned, so a header shared
+        by many depfiles is only stored once.
+
+        @param jobs:
+            Number of processes to parse with, None to use all cpus.
+        @param threshold:
+            Fewer depfiles than this are always parsed in this process.
+        @param chunk_size:
+            Number of depfiles handed to a worker process at a time.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs <= 1 or len(paths) < threshold:
+        return _read_dependency_files_serial(paths)
+
+    chunks = [paths[i:i + chunk_size]
+              for i in range(0, len(paths), chunk_size)]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        chunk_results = pool.map(_read_dependency_files_serial, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    # strings are only interned within each worker, intern them here
+    # so that shared headers are stored once in this process
+    results = {}
+    for chunk_result in chunk_results:
+        for path, target_dict in chunk_result.items():
+            results[path] = dict(
+                (intern(target), list(map(intern, deps)))
+                for target, deps in target_dict.items())
+    return results
+
+
+#------------------------------------------------------------------------
+# private functions
+
+_dependency_db = DependencyDb()
+
+
+# the colon ending a rule's targets is followed by whitespace or the end of
+# the line, which tells it apart from a windows drive letter (C:/x.c)
+_DEPFILE_RULE_SEPARATOR = re.compile(r':(?=\s|$)')
+
+# a path is a run of non-whitespace characters and escaped spaces/hashes
+_DEPFILE_PATH = re.compile(r'(?:\\[ #]|\S)+')
+
+
+def _parse_dependency_text(text, intern_func):
+    """ Return a dictionary of target : [dependencies] pairs from the
+        contents of a gcc dependency file. Paths are passed through
+        intern_func if it is given.
+    """
+    first = _DEPFILE_RULE_SEPARATOR.search(text)
+    if first is None:
+        return {}
+
+    # Fast path for the usual depfile: a single rule for the object file,
+    # with no backslashes other than line continuations (so no escaped
+    # characters) and no '$$'.
+    if '$' not in text and \
+            _DEPFILE_RULE_SEPARATOR.search(text, first.end()) is None:
+        targets = text[:first.start()].split()
+        deps = text[first.end():].split()
+        num_continuations = deps.count('\\')
+        if text.count('\\') == num_continuations:
+            if num_continuations:
+                deps = list(filter(_is_not_continuation, deps))
+            if intern_func is not None:
+                targets = list(map(intern_func, targets))
+                deps = list(map(intern_func, deps))
+            return _add_depfile_rule({}, targets, deps)
 
     target_dict = {}
-    with open(path) as infile:
-        current_target = None
-        current_deps = []
-        for line in infile:
-            tgt, remainder = get_target_from_line(line)
-            if tgt is None:
-                current_deps += get_deps_from_string(line)
+    text = text.replace('\\\r\n', ' ').replace('\\\n', ' ')
+    for line in text.splitlines():
+        match = _DEPFILE_RULE_SEPARATOR.search(line)
+        if match is not None:
+            _add_depfile_rule(
+                target_dict,
+                _split_depfile_paths(line[:match.start()], intern_func),
+                _split_depfile_paths(line[match.end():], intern_func))
+    return target_dict
+
+
+def _add_depfile_rule(target_dict, targets, deps):
+    # rules without dependencies are the phony header rules made by -MP
+    if deps:
+        for target in targets:
+            if target in target_dict:
+                target_dict[target] = target_dict[target] + deps
             else:
-                if current_target is not None:
-                    target_dict[current_target] = current_deps
-                current_target = tgt
-                current_deps = get_deps_from_string(remainder)
-    target_dict[current_target] = current_deps
+                target_dict[target] = deps
     return target_dict
 
 
-#------------------------------------------------------------------------
-# private functions
+def _split_depfile_paths(string, intern_func):
+    paths = []
+    for path in _DEPFILE_PATH.findall(string):
+        if path == '\\':
+            # stray line continuation
+            continue
+        if '\\' in path:
+            path = path.replace('\\ ', ' ').replace('\\#', '#')
+        if '$' in path:
+            path = path.replace('$$', '$')
+        if intern_func is not None:
+            path = intern_func(path)
+        paths.append(path)
+    return paths
+
+
+_is_not_continuation = '\\'.__ne__
+
+
+def _read_dependency_files_serial(paths):
+    results = {}
+    for path in paths:
+        with open(path) as infile:
+            results[path] = _parse_dependency_text(infile.read(), intern)
+    return results
+
+
+class _CmdChanged(object):
+
+    """ doit uptodate checker that works like doit.tools.config_changed on
+        a digest of a command. The digest is saved in the task's values
+        under CMD_DIGEST_KEY, and is only calculated once doit needs it.
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self._digest = None
+
+    def configure_task(self, task):
+        task.value_savers.append(lambda: {CMD_DIGEST_KEY: self.get_digest()})
+
+    def __call__(self, task, values):
+        """ Return True if the command is unchanged """
+        last_digest = values.get(CMD_DIGEST_KEY)
+        return last_digest is not None and last_digest == self.get_digest()
+
+    def get_digest(self):
+        if self._digest is None:
+            cmd = self.cmd
+            if isinstance(cmd, list):
+                cmd = _arg_list_to_command_string(cmd)
+            # doit stores the value, so store a digest rather than what
+            # may be a very long link command
+            self._digest = hashlib.md5(cmd.encode('utf-8')).hexdigest()
+        return self._digest
+
+
+def _split_flags(flags):
+    """ Split flags such as '-x c' that hold several arguments, honouring
+        shell quoting and escapes as the shell did for command strings
+    """
+    split = []
+    for flag in flags:
+        split += shlex.split(flag)
+    return split
 
 
 def _arg_list_to_command_string(arg_list):
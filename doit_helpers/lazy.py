@@ -0,0 +1,24 @@
+""" Helpers for deferring work until it's needed """
+
+
+class cached_property(object):
+
+    """ Decorator for a method that computes an attribute. The method is
+        called the first time the attribute is read, and the result is
+        stored on the instance, so it is only computed once.
+
+        The attribute can also be assigned, as with any plain attribute,
+        in which case the method isn't called at all.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+        self.__name__ = func.__name__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.func(instance)
+        instance.__dict__[self.__name__] = value
+        return value
@@ -0,0 +1,383 @@
+""" A ccache-style cache of compiled objects, shared between builds """
+
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import gcc_utils
+import shutil2
+
+# default maximum total size of cached objects and depfiles, in bytes
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+
+# number of different header sets remembered per compile command and
+# source. More than one is only needed when headers change back and forth,
+# eg. when switching branches.
+MAX_MANIFEST_ENTRIES = 8
+
+# number of objects stored between checks of the cache size
+CLEANUP_INTERVAL = 100
+
+
+class ObjectCache:
+
+    """ Content-addressed cache of compiler outputs (.o and .d files).
+        Set as the 'object cache' variable of a GccEnv to use it for the
+        environment's compile tasks.
+
+        Lookups work like ccache's direct mode. A compile is identified
+        by the compiler executable, the full compile command and the
+        contents of the source file. For each compile, the cache keeps a
+        manifest of the headers listed in the depfiles of previous
+        compiles, along with hashes of their contents. If every header
+        of a manifest entry still has the same contents, the cached
+        object and depfile are copied to the output paths instead of
+        running the compiler. last_status is 'hit' or 'miss' after each
+        compile.
+
+        The least recently used objects are removed when the cache grows
+        past max_size. Hits and misses are counted in the cache
+        directory, see get_stats().
+
+        If a remote_cache.RemoteStore is given, compiles that miss the
+        local cache are looked up in the remote store before running the
+        compiler, and are uploaded to it afterwards, so that machines
+        sharing a store reuse each other's objects. last_status is then
+        'remote hit' after a remote hit. Machines sharing a store should
+        build from the same paths, as manifests and depfiles name headers
+        by their paths.
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE, remote=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.remote = remote
+        self._compiler_ids = {}
+        self._file_digests = {}
+        self._stores_until_cleanup = 0
+        self.last_status = None
+
+    def compile(self, compiler, cmd, source, obj, dep, farm=None,
+                run_cmd=shutil2.run_cmd):
+        """ doit python-action. Restore obj and dep from the cache, or run
+            the compile command cmd and add its outputs to the cache.
+            cmd is either an argument list or a shell command string.
+            If a compile_farm.CompileFarm is given, misses are compiled
+            with it. Commands are run by run_cmd, see shutil2.run_cmd().
+        """
+        manifest_key = self._get_manifest_key(compiler, cmd, source)
+        if self._restore(manifest_key, obj, dep):
+            self.last_status = 'hit'
+            self._record_stat('h')
+            return True
+        if self.remote is not None and \
+                self._restore_remote(manifest_key, obj, dep):
+            self.last_status = 'remote hit'
+            self._record_stat('r')
+            return True
+        self.last_status = 'miss'
+        self._record_stat('m')
+        if farm is not None:
+            if not farm.compile(compiler, cmd, source, obj, dep, run_cmd):
+                return False
+        elif run_cmd(cmd, shell=not isinstance(cmd, list)) != 0:
+            return False
+        stored = self._store(manifest_key, obj, dep)
+        if stored is not None and self.remote is not None and \
+                not self.remote.read_only:
+            self._upload(manifest_key, stored[0], stored[1], obj, dep)
+        return True
+
+    def get_stats(self):
+        """ Return a dictionary of cache statistics: hits, remote hits,
+            misses and the total size of cached files in bytes
+        """
+        hits = remote_hits = misses = 0
+        stats_path = self._get_stats_path()
+        if os.path.isfile(stats_path):
+            with open(stats_path, 'rb') as infile:
+                data = infile.read()
+            hits = data.count(b'h')
+            remote_hits = data.count(b'r')
+            misses = data.count(b'm')
+        size = sum(entry[1] for entry in self._get_object_files())
+        return {'hits': hits, 'remote hits': remote_hits, 'misses': misses,
+                'size': size}
+
+    def zero_stats(self):
+        """ Reset the hit and miss counts """
+        if os.path.isfile(self._get_stats_path()):
+            os.remove(self._get_stats_path())
+
+    def cleanup(self):
+        """ Remove the least recently used objects until the cache is
+            no larger than max_size
+        """
+        files = self._get_object_files()
+        total = sum(entry[1] for entry in files)
+        # sort by last use, oldest first
+        for path, size, used in sorted(files, key=lambda entry: entry[2]):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """ Remove everything from the cache """
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    #------------------------------------------------
+    # private
+
+    def _get_manifest_key(self, compiler, cmd, source):
+        hasher = hashlib.sha1()
+        hasher.update(self._get_compiler_id(compiler).encode('utf-8'))
+        hasher.update(b'\0')
+        if isinstance(cmd, list):
+            cmd = '\0'.join(cmd)
+        hasher.update(cmd.encode('utf-8'))
+        hasher.update(b'\0')
+        hasher.update(self._get_file_digest(source).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def _get_compiler_id(self, compiler):
+        """ Return a string identifying the compiler executable. Changes
+            if the compiler is upgraded or replaced.
+        """
+        if compiler not in self._compiler_ids:
+            path = _find_executable(compiler)
+            if path is None:
+                self._compiler_ids[compiler] = compiler
+            else:
+                stat = os.stat(path)
+                self._compiler_ids[compiler] = '%s|%d|%r' % (
+                    os.path.realpath(path), stat.st_size, stat.st_mtime)
+        return self._compiler_ids[compiler]
+
+    def _get_file_digest(self, path):
+        """ Return a hash of the file's contents, None if it doesn't exist.
+            Hashes are remembered for as long as the file is unchanged.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (stat.st_mtime, stat.st_size)
+        cached = self._file_digests.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        hasher = hashlib.sha1()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(65536), b''):
+                hasher.update(block)
+        digest = hasher.hexdigest()
+        self._file_digests[path] = (key, digest)
+        return digest
+
+    def _restore(self, manifest_key, obj, dep):
+        for result_key, headers in self._read_manifest(manifest_key):
+            if all(self._get_file_digest(path) == digest
+                   for path, digest in headers):
+                cached_obj, cached_dep = self._get_result_paths(result_key)
+                try:
+                    shutil.copyfile(cached_obj, obj)
+                    shutil.copyfile(cached_dep, dep)
+                    # mark as recently used
+                    os.utime(cached_obj, None)
+                    os.utime(cached_dep, None)
+                except (IOError, OSError):
+                    # evicted by another process
+                    continue
+                return True
+        return False
+
+    def _restore_remote(self, manifest_key, obj, dep):
+        """ Restore obj and dep from the remote store, and keep a copy
+            in the local cache
+        """
+        for result_key, headers in self._read_remote_manifest(manifest_key):
+            if not all(self._get_file_digest(path) == digest
+                       for path, digest in headers):
+                continue
+            value = self.remote.get('r-' + result_key)
+            contents = _unpack_result(value) if value is not None else None
+            if contents is None:
+                continue
+            for path, data in zip([obj, dep], contents):
+                with open(path, 'wb') as outfile:
+                    outfile.write(data)
+            self._store(manifest_key, obj, dep)
+            return True
+        return False
+
+    def _upload(self, manifest_key, result_key, headers, obj, dep):
+        """ Upload a compile's outputs and add them to the remote
+            manifest. Concurrent uploads of the same manifest may drop
+            each other's entries, which only costs a remote miss.
+        """
+        contents = []
+        for path in [obj, dep]:
+            with open(path, 'rb') as infile:
+                contents.append(infile.read())
+        if not self.remote.put('r-' + result_key, _pack_result(*contents)):
+            return
+        entries = [e for e in self._read_remote_manifest(manifest_key)
+                   if e[0] != result_key]
+        entries.insert(0, (result_key, headers))
+        self.remote.put('m-' + manifest_key, json.dumps(
+            entries[:MAX_MANIFEST_ENTRIES]).encode('utf-8'))
+
+    def _read_remote_manifest(self, manifest_key):
+        """ Return a list of (result key, [(header, digest)]). Manifests
+            are JSON rather than pickles, as they come from other
+            machines.
+        """
+        value = self.remote.get('m-' + manifest_key)
+        if value is None:
+            return []
+        try:
+            return [(result_key, [tuple(h) for h in headers])
+                    for result_key, headers in json.loads(
+                        value.decode('utf-8'))]
+        except (ValueError, TypeError):
+            return []
+
+    def _store(self, manifest_key, obj, dep):
+        """ Add obj and dep to the cache. Return the result key and
+            the (header, digest) list of the stored entry, None if they
+            couldn't be stored.
+        """
+        if not os.path.isfile(obj) or not os.path.isfile(dep):
+            return None
+        headers = []
+        for deps in gcc_utils.read_dependency_file(dep).values():
+            for path in deps:
+                digest = self._get_file_digest(path)
+                if digest is None:
+                    return None
+                headers.append((path, digest))
+
+        hasher = hashlib.sha1(manifest_key.encode('utf-8'))
+        for path, digest in headers:
+            hasher.update(('%s|%s\0' % (path, digest)).encode('utf-8'))
+        result_key = hasher.hexdigest()
+
+        cached_obj, cached_dep = self._get_result_paths(result_key)
+        shutil2.atomic_copy(obj, cached_obj)
+        shutil2.atomic_copy(dep, cached_dep)
+
+        entries = [e for e in self._read_manifest(manifest_key)
+                   if e[0] != result_key]
+        entries.insert(0, (result_key, headers))
+        self._write_manifest(manifest_key, entries[:MAX_MANIFEST_ENTRIES])
+
+        if self._stores_until_cleanup <= 0:
+            self.cleanup()
+            self._stores_until_cleanup = CLEANUP_INTERVAL
+        self._stores_until_cleanup -= 1
+        return result_key, headers
+
+    def _get_result_paths(self, result_key):
+        base = os.path.join(self.cache_dir, 'objects', result_key[:2],
+                            result_key)
+        return base + '.o', base + '.d'
+
+    def _get_manifest_path(self, manifest_key):
+        return os.path.join(self.cache_dir, 'manifests', manifest_key[:2],
+                            manifest_key)
+
+    def _read_manifest(self, manifest_key):
+        path = self._get_manifest_path(manifest_key)
+        if not os.path.isfile(path):
+            return []
+        try:
+            with open(path, 'rb') as infile:
+                return pickle.load(infile)
+        except Exception:
+            return []
+
+    def _write_manifest(self, manifest_key, entries):
+        path = self._get_manifest_path(manifest_key)
+        shutil2.mkdirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as outfile:
+            pickle.dump(entries, outfile, pickle.HIGHEST_PROTOCOL)
+        shutil2.replace(tmp_path, path)
+
+    def _get_stats_path(self):
+        return os.path.join(self.cache_dir, 'stats')
+
+    def _record_stat(self, stat):
+        """ Append a single character to the stats file. Small appends
+            are atomic, so this is safe with several doit processes.
+        """
+        shutil2.mkdirs(self.cache_dir)
+        fd = os.open(self._get_stats_path(),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, stat.encode('ascii'))
+        finally:
+            os.close(fd)
+
+    def _get_object_files(self):
+        """ Return a list of (path, size, last used time) for all cached
+            objects and depfiles
+        """
+        files = []
+        for root, dirnames, filenames in os.walk(
+                os.path.join(self.cache_dir, 'objects')):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+
+#------------------------------------------------------------------------
+# private functions
+
+
+def _pack_result(obj_data, dep_data):
+    """ Pack an object and depfile into a single value for the remote
+        store
+    """
+    return struct.pack('>Q', len(obj_data)) + obj_data + dep_data
+
+
+def _unpack_result(value):
+    """ Return (obj data, dep data), None if value isn't valid """
+    if len(value) < 8:
+        return None
+    obj_size = struct.unpack('>Q', value[:8])[0]
+    if obj_size > len(value) - 8:
+        return None
+    return value[8:8 + obj_size], value[8 + obj_size:]
+
+
+def _find_executable(name):
+    if os.path.dirname(name):
+        return name if os.path.isfile(name) else None
+    extensions = ['']
+    if os.name == 'nt':
+        extensions += os.environ.get('PATHEXT', '.EXE').lower().split(';')
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        for ext in extensions:
+            path = os.path.join(directory, name + ext)
+            if os.path.isfile(path):
+                return path
+    return None
@@ -0,0 +1,198 @@
+""" A shared store for objcache.ObjectCache, reached over HTTP, so that
+    objects compiled by one machine can be reused by others.
+
+    The protocol is plain HTTP. GET /<key> returns the value stored under
+    key, or 404 if there is none. PUT /<key> stores the request body
+    under key. Keys are made of letters, digits, '-' and '_'.
+
+    usage: python remote_cache.py <directory> [port] [host]
+        Run a stand-in server that keeps values as files in directory.
+        Good enough for testing and a small team. Listens on
+        localhost:8765 by default.
+"""
+
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+
+try:
+    from urllib2 import HTTPError, Request, URLError, build_opener, \
+        ProxyHandler
+except ImportError:
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, build_opener, ProxyHandler
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import shutil2
+
+# seconds to wait for the server before compiling locally instead
+DEFAULT_TIMEOUT = 2.0
+
+DEFAULT_PORT = 8765
+
+# largest value the stand-in server accepts, in bytes
+MAX_VALUE_SIZE = 256 * 1024 ** 2
+
+KEY_REGEX = re.compile(r'^[0-9A-Za-z_-]+$')
+
+
+class RemoteStore:
+
+    """ Client of a shared cache server. Pass it as the remote of an
+        objcache.ObjectCache.
+
+        In read-only mode, values are fetched but never uploaded, eg. for
+        developer machines that should use the objects built by CI but
+        not add their own.
+
+        If the server can't be reached or doesn't answer within timeout
+        seconds, the store is disabled for the rest of the process, so
+        the build carries on with local compiles without waiting for the
+        server again.
+    """
+
+    def __init__(self, url, read_only=False, timeout=DEFAULT_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.read_only = read_only
+        self.timeout = timeout
+        self.disabled = False
+        # the server is usually on the local network
+        self._opener = build_opener(ProxyHandler({}))
+
+    def get(self, key):
+        """ Return the value stored under key, None if there isn't one or
+            the server can't be reached
+        """
+        # keys can come from manifests fetched from the server
+        if self.disabled or not KEY_REGEX.match(key):
+            return None
+        try:
+            response = self._opener.open(self._get_url(key),
+                                         timeout=self.timeout)
+            try:
+                return response.read()
+            finally:
+                response.close()
+        except HTTPError:
+            # not found, or a server error
+            return None
+        except (URLError, socket.error, socket.timeout, IOError):
+            self.disabled = True
+            return None
+
+    def put(self, key, value):
+        """ Store value, a byte string, under key. Return True if it was
+            stored. Does nothing in read-only mode.
+        """
+        if self.disabled or self.read_only:
+            return False
+        request = Request(self._get_url(key), data=value)
+        request.add_header('Content-Type', 'application/octet-stream')
+        request.get_method = lambda: 'PUT'
+        try:
+            self._opener.open(request, timeout=self.timeout).close()
+            return True
+        except HTTPError:
+            return False
+        except (URLError, socket.error, socket.timeout, IOError):
+            self.disabled = True
+            return False
+
+    #------------------------------------------------
+    # private
+
+    def _get_url(self, key):
+        if not KEY_REGEX.match(key):
+            raise Exception('Invalid cache key: ' + key)
+        return self.url + '/' + key
+
+
+class CacheServer(ThreadingMixIn, HTTPServer):
+
+    """ Stand-in cache server. Values are stored as files under directory.
+        Nothing is ever removed.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, directory, port=DEFAULT_PORT, host='localhost'):
+        HTTPServer.__init__(self, (host, port), _CacheRequestHandler)
+        self.directory = directory
+
+    def get_url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        """ Serve requests from a background thread, return the thread """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key[-2:], key)
+
+
+class _CacheRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        key = self.path.lstrip('/')
+        if not KEY_REGEX.match(key):
+            self.send_error(400)
+            return
+        try:
+            with open(self.server.get_path(key), 'rb') as infile:
+                value = infile.read()
+        except (IOError, OSError):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(value)))
+        self.end_headers()
+        self.wfile.write(value)
+
+    def do_PUT(self):
+        key = self.path.lstrip('/')
+        length = int(self.headers.get('Content-Length') or -1)
+        if not KEY_REGEX.match(key) or not 0 <= length <= MAX_VALUE_SIZE:
+            self.send_error(400)
+            return
+        value = self.rfile.read(length)
+        path = self.server.get_path(key)
+        shutil2.mkdirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(value)
+        shutil2.replace(tmp_path, path)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PORT
+    host = sys.argv[3] if len(sys.argv) > 3 else 'localhost'
+    server = CacheServer(sys.argv[1], port, host)
+    print('Serving %s at %s' % (sys.argv[1], server.get_url()))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,75 @@
 """ Additions to python's shutil standard library """
 
 
+import atexit
+import collections
 import fnmatch
 import glob
+import itertools
+import multiprocessing
 import os
+import re
 import shutil
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+
+# files with these extensions are already compressed, so zipdir() stores
+# them as they are
+COMPRESSED_EXTENSIONS = frozenset([
+    '.zip', '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz', '.lz', '.lzma',
+    '.zst', '.7z', '.rar', '.jar', '.whl', '.apk', '.png', '.jpg', '.jpeg',
+    '.gif', '.webp', '.mp3', '.mp4', '.ogg',
+])
+
+# timestamp of every zipdir() entry, the earliest a zip file can store
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# size of the blocks files are read, compressed and copied in
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+# name of the file in which incremental unzip() records what it extracted
+UNZIP_MANIFEST_NAME = '.unzip_manifest'
+
+# bump this whenever the format of unzip manifests changes
+UNZIP_MANIFEST_VERSION = 1
+
+# attempts at removing a tree, and the delay before the second attempt,
+# doubled after each failed attempt. Removal fails when another process
+# has files open, eg. virus scanners and indexers on windows.
+RMTREE_ATTEMPTS = 6
+RMTREE_RETRY_DELAY = 0.05
+
+# trees with more files than this are removed by several threads
+RMTREE_PARALLEL_THRESHOLD = 1000
+RMTREE_JOBS = 8
+# trees being removed by rmtree() are moved into a directory of this name
+# next to them, which iter_files() and zipdir() don't search
+RMTREE_TOMBSTONE_DIR = '.rmtree-tombstones'
+
+# number of files copy_glob() copies at once
+COPY_JOBS = 8
+# modification times are copied with up to microsecond precision
+COPY_MTIME_TOLERANCE = 1e-5
 
 
 class SvnError(Exception):
@@ -27,38 +89,187 @@ def find_files(path, incl_patterns, excl_patterns=[], search_subdirs=False):
 
         Optionally searches all subdirectories.
     """
-    # convert patterns to lists if they are not already
-    if type(incl_patterns) is not list:
-        incl_patterns = [incl_patterns]
-    if type(excl_patterns) is not list:
-        excl_patterns = [excl_patterns]
-
-    # find all filenames that match any include patterns
-    matches = []
-    num_dirs_searched = 0
-    for root, dirnames, filenames in os.walk(path):
-        if not search_subdirs and num_dirs_searched >= 1:
-            break
-        else:
-            for filename in filenames:
-                for pattern in incl_patterns:
-                    if fnmatch.fnmatch(filename, pattern):
-                        matches.append(os.path.join(root, filename))
-                        break
-            num_dirs_searched += 1
-
-    # remove all filenames that match any exclude patterns
-    def isExcluded(filename):
-        for pattern in excl_patterns:
-            if fnmatch.fnmatch(filename, pattern):
-                return True
-        return False
+    return list(iter_files(path, incl_patterns, excl_patterns, search_subdirs))
+
+
+def iter_files(path, incl_patterns, excl_patterns=[], search_subdirs=False,
+               excl_full_path=False):
+    """ Generate the files under the given path whose names match any of
+        the include patterns and none of the exclude patterns. Patterns
+        are unix filename patterns (fnmatch), and may be a string or a
+        list of strings. Files are generated in the same order as
+        os.walk() would find them.
+
+        @param excl_full_path:
+            Match exclude patterns against each file's path (path joined
+            with any subdirectories and the filename) rather than just its
+            name. In this mode, subdirectories that can only contain
+            excluded files are not searched, eg. 'build*' or '*/.svn/*'.
+    """
+    incl_regex = _compile_patterns(incl_patterns)
+    excl_regex = _compile_patterns(excl_patterns)
+    excl_dir_regex = _compile_patterns(
+        [p for p in _as_list(excl_patterns) if p.endswith('*')]) \
+        if excl_full_path else None
+    normcase = os.path.normcase
+
+    dirs = [path]
+    while dirs:
+        current = dirs.pop()
+        subdirs = []
+        for entry in _list_dir(current):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                if entry.name == RMTREE_TOMBSTONE_DIR:
+                    continue
+                if search_subdirs and not entry.is_symlink():
+                    if excl_dir_regex is None or not excl_dir_regex.match(
+                            normcase(entry.path + os.sep)):
+                        subdirs.append(entry.path)
+                continue
+            name = normcase(entry.name)
+            if incl_regex is None or not incl_regex.match(name):
+                continue
+            if excl_regex is not None:
+                excl_name = normcase(entry.path) if excl_full_path else name
+                if excl_regex.match(excl_name):
+                    continue
+            yield entry.path
+        # searched in reverse, so the first subdirectory is searched first
+        subdirs.reverse()
+        dirs += subdirs
 
-    return [x for x in matches if not isExcluded(os.path.basename(x))]
 
+class DirSnapshotCache:
 
-def unzip(archive_path, dest=None):
-    """ Extract the given zip archive, to present dir if no dest is given """
+    """ Remembers directory listings, keyed by each directory's
+        modification time. A directory's mtime changes whenever an entry
+        is added, removed or renamed, so a listing can be reused for as
+        long as the directory's mtime is unchanged. This costs a single
+        stat per directory instead of a full listing, which matters on
+        slow or network filesystems.
+
+        Listings are kept in memory, and optionally saved to a file so
+        they can be reused by later runs. See use_dir_snapshot_file().
+    """
+
+    # directories modified less than this many seconds before they were
+    # listed aren't cached, since another change within the filesystem's
+    # timestamp resolution wouldn't change the mtime
+    RACY_INTERVAL = 2.0
+
+    # bump this whenever the format of the saved snapshots changes
+    VERSION = 2
+
+    def __init__(self, cache_path=None):
+        # absolute directory path : (mtime, [(name, is_dir, is_symlink)])
+        self.snapshots = {}
+        self.cache_path = cache_path
+        self._changed = False
+        if cache_path is not None:
+            self.load()
+
+    def get_listing(self, path):
+        """ Return a list of (name, is_dir, is_symlink) tuples for the
+            entries in path. Returns an empty list if path can't be listed.
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return []
+        # the cache file may be shared by several working directories
+        key = os.path.abspath(path)
+        snapshot = self.snapshots.get(key)
+        if snapshot is not None and snapshot[0] == mtime:
+            return snapshot[1]
+        try:
+            listing = _read_dir(path)
+        except OSError:
+            return []
+        if time.time() - mtime >= self.RACY_INTERVAL:
+            self.snapshots[key] = (mtime, listing)
+            self._changed = True
+        elif snapshot is not None:
+            del self.snapshots[key]
+            self._changed = True
+        return listing
+
+    def clear(self):
+        """ Forget all snapshots """
+        self.snapshots = {}
+        self._changed = True
+
+    def load(self):
+        """ Load snapshots from the cache file, if it exists """
+        if self.cache_path is None or not os.path.isfile(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'rb') as infile:
+                version, snapshots = pickle.load(infile)
+        except Exception:
+            # the snapshot file is only a cache, ignore it if it's corrupt
+            return
+        if version == self.VERSION:
+            for path, snapshot in snapshots.items():
+                self.snapshots.setdefault(path, snapshot)
+
+    def save(self):
+        """ Save snapshots to the cache file, if they have changed """
+        if self.cache_path is None or not self._changed:
+            return
+        cache_dir = os.path.dirname(self.cache_path) or '.'
+        try:
+            # a temporary file of its own, as other processes may be
+            # saving to the same cache file
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp')
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                pickle.dump((self.VERSION, self.snapshots), outfile,
+                            pickle.HIGHEST_PROTOCOL)
+            replace(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._changed = False
+
+
+def use_dir_snapshot_file(cache_path):
+    """ Save the directory listings used by find_files() and
+        file_utils.find() to cache_path when the process exits, and
+        reuse them from there in later runs. Call this before
+        searching for any files, eg. at the top of dodo.py.
+    """
+    global _dir_snapshots
+    if _dir_snapshots.cache_path == cache_path:
+        return
+    _dir_snapshots.save()
+    _dir_snapshots = DirSnapshotCache(cache_path)
+    atexit.register(_dir_snapshots.save)
+
+
+def unzip(archive_path, dest=None, incremental=False, jobs=None):
+    """ Extract the given zip archive, to present dir if no dest is given.
+
+        In incremental mode, files already in dest with the same size and
+        CRC as their entry are left alone, so their modification times
+        don't change. Other entries are extracted by jobs threads (by
+        default, one per cpu), with the entry's timestamp, and
+        permissions for zip files made on unix. Files not in the archive
+        aren't removed. What was extracted is recorded in a manifest
+        file in dest, UNZIP_MANIFEST_NAME. If neither the archive nor
+        the files it recorded have changed since, nothing is read.
+        Returns the names of the entries that were extracted.
+    """
+    if incremental:
+        return _unzip_incremental(archive_path, dest or '.', jobs)
     archive = zipfile.ZipFile(archive_path, 'r')
     if dest is not None:
         archive.extractall(dest)
@@ -66,53 +277,694 @@ def unzip(archive_path, dest=None):
         archive.extractall()
 
 
-def zipdir(path, dest):
-    """ Zip all contents of path to dest """
-    zipf = zipfile.ZipFile(dest, 'w', compression=zipfile.ZIP_DEFLATED)
+def zipdir(path, dest, jobs=None, compress_level=6):
+    """ Zip all files under path to dest, with names relative to path.
+
+        Archives are deterministic: entries are sorted by name, and have
+        a fixed timestamp and permissions (0644, or 0755 for
+        executables), so unchanged files give a byte-identical archive.
+        If dest already has the same contents it isn't rewritten, and
+        keeps its modification time. Otherwise it's replaced atomically.
+
+        Files are compressed by jobs threads (by default, one per cpu), a
+        chunk at a time, at most jobs * 2 files ahead of the one being
+        written to the archive. Already-compressed formats, see
+        COMPRESSED_EXTENSIONS, and files that don't get smaller are
+        stored uncompressed. Empty directories aren't stored.
+    """
+    skip = os.path.abspath(dest)
+    entries = []
     for root, dirs, files in os.walk(path):
-        for file in files:
-            zipf.write(os.path.join(root, file))
-    zipf.close()
+        if RMTREE_TOMBSTONE_DIR in dirs:
+            dirs.remove(RMTREE_TOMBSTONE_DIR)
+        for filename in files:
+            file_path = os.path.join(root, filename)
+            if os.path.abspath(file_path) != skip:
+                name = os.path.relpath(file_path, path).replace(os.sep, '/')
+                entries.append((name, file_path))
+    entries.sort()
+
+    dest_dir = os.path.dirname(dest) or '.'
+    mkdirs(dest_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.tmp')
+    os.close(fd)
+    _set_default_mode(tmp_path)
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = ThreadPool(jobs)
+    try:
+        zipf = zipfile.ZipFile(tmp_path, 'w', allowZip64=True)
+        try:
+            # compressed files are held in memory or open temporary files
+            # until they're written, so only compress a few files ahead
+            pending = collections.deque()
+            for name, file_path in entries:
+                pending.append((name, pool.apply_async(
+                    _compress_zip_entry, (file_path, compress_level))))
+                if len(pending) >= jobs * 2:
+                    name, result = pending.popleft()
+                    _write_zip_entry(zipf, name, *result.get())
+            while pending:
+                name, result = pending.popleft()
+                _write_zip_entry(zipf, name, *result.get())
+        finally:
+            zipf.close()
+    except:
+        pool.terminate()
+        os.remove(tmp_path)
+        raise
+    pool.close()
+    if _same_contents(tmp_path, dest):
+        os.remove(tmp_path)
+    else:
+        replace(tmp_path, dest)
 
 
 def mkdirs(path):
     """ Create the given directory if it doesn't already exist """
     if not os.path.exists(path):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(path):
+                raise
+
+
+def replace(src, dest):
+    """ Rename src to dest, replacing dest if it exists """
+    try:
+        os.rename(src, dest)
+    except OSError:
+        # os.rename won't overwrite on windows
+        if not os.path.exists(dest):
+            raise
+        os.remove(dest)
+        os.rename(src, dest)
+
 
+def atomic_copy(src, dest):
+    """ Copy src to dest such that other processes never see a partly
+        written dest. Creates dest's directory if needed.
+    """
+    dest_dir = os.path.dirname(dest) or '.'
+    mkdirs(dest_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        replace(tmp_path, dest)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-def copy_glob(pattern, dest):
+
+def copy_glob(pattern, dest, jobs=COPY_JOBS):
     """ Copy files by unix path pattern to the destination dir.
-        dest must be an existing directory, also if the pattern
-        returns directories, you're in trouble
+        dest must be an existing directory. Directories matched by the
+        pattern aren't copied.
+
+        Files already in dest with the same size and modification time,
+        or the same contents, are skipped, so that their modification
+        times don't change. The others are copied by jobs threads, with
+        their permissions and modification times, through temporary
+        files so that other processes never see a partly copied file.
+        Data is copied by the kernel where os.copy_file_range() or
+        os.sendfile() are available.
+
+        Returns a dictionary with the destination paths of the 'copied'
+        and 'skipped' files.
     """
     assert(os.path.isdir(dest))
-    items = glob.glob(pattern)
+    items = sorted(item for item in glob.glob(pattern)
+                   if os.path.isfile(item))
+    report = {'copied': [], 'skipped': []}
     if len(items) == 0:
         print 'warning: no files found in copy_glob. pattern: ' + pattern
-    else:
-        for item in items:
-            shutil.copy(item, dest)
+        return report
+    pool = ThreadPool(max(1, min(jobs, len(items))))
+    try:
+        copied = pool.map(
+            lambda item: _sync_file(
+                item, os.path.join(dest, os.path.basename(item))), items)
+    finally:
+        pool.close()
+    for item, was_copied in zip(items, copied):
+        report['copied' if was_copied else 'skipped'].append(
+            os.path.join(dest, os.path.basename(item)))
+    return report
+
+
+def rmtree(path, wait=False):
+    """ Remove a directory tree, retrying with backoff if files can't be
+        removed yet, eg. because the os or another process still has them
+        open. Does nothing if path isn't a directory.
+
+        Unless wait is True, the tree is moved into the hidden
+        RMTREE_TOMBSTONE_DIR next to it and removed by a background
+        thread, so this returns straight away and path can be reused at
+        once. Call wait_for_rmtrees() to wait for background removals.
+        They're waited for when the process exits.
+
+        The tree is removed before returning, and an exception raised if
+        that fails, if it can't be moved, if wait is True, or in a
+        multiprocessing child process (eg. doit -n), since those exit
+        without waiting for their threads.
+    """
+    global _rmtree_exit_registered
+    if not os.path.isdir(path) or os.path.islink(path):
+        return
+    if not wait and _can_remove_in_background():
+        tombstone = _get_tombstone_path(path)
+        try:
+            mkdirs(os.path.dirname(tombstone))
+            os.rename(path, tombstone)
+        except OSError:
+            pass
+        else:
+            thread = threading.Thread(target=_remove_tombstone,
+                                      args=(tombstone,))
+            with _rmtree_lock:
+                if not _rmtree_exit_registered:
+                    atexit.register(wait_for_rmtrees)
+                    _rmtree_exit_registered = True
+                _pending_rmtrees.append(thread)
+            try:
+                thread.start()
+            except RuntimeError:
+                # can't start new thread
+                with _rmtree_lock:
+                    _pending_rmtrees.remove(thread)
+                path = tombstone
+            else:
+                return
+    if not _remove_tree(path):
+        raise Exception('rmtree failed after %d attempts: %s' % (
+            RMTREE_ATTEMPTS, path))
+
 
+def wait_for_rmtrees():
+    """ Wait for the trees being removed in the background by rmtree().
+        Return the paths of the tombstones that couldn't be removed.
+    """
+    while True:
+        with _rmtree_lock:
+            if not _pending_rmtrees:
+                return list(_failed_rmtrees)
+            thread = _pending_rmtrees[0]
+        thread.join()
+
+
+
+def run_cmd(cmd, shell=False, wait=None):
+    """ Run a command and return its exit code. The command's output is
+        written to sys.stdout and sys.stderr once it finishes, so that
+        doit captures it, and shows it on failure, when this is run from
+        a python-action.
+
+        wait, if given, is called with the subprocess.Popen object in
+        place of its wait() method, and returns the exit code.
+    """
+    with tempfile.TemporaryFile() as out:
+        with tempfile.TemporaryFile() as err:
+            process = subprocess.Popen(cmd, shell=shell, stdout=out,
+                                       stderr=err)
+            if wait is None:
+                exit_code = process.wait()
+            else:
+                exit_code = wait(process)
+            for outfile, stream in [(out, sys.stdout), (err, sys.stderr)]:
+                outfile.seek(0)
+                data = outfile.read()
+                if data:
+                    if not isinstance(data, str):
+                        # python 3
+                        data = data.decode('utf-8', 'replace')
+                    stream.write(data)
+    return exit_code
+
+#------------------------------------------------------------------------
+# private functions
+
+_compiled_patterns = {}
+
+
+def _as_list(patterns):
+    if type(patterns) is not list:
+        return [patterns]
+    return patterns
 
-def rmtree(path):
-    """ A wrapper for shutil.rmtree() since it sometimes fails
-        due to OS file handling delays (?). At least on windows it does.
+
+def _compile_patterns(patterns):
+    """ Compile a list of fnmatch patterns into a single regex, or return
+        None if there are no patterns
+    """
+    patterns = tuple(os.path.normcase(p) for p in _as_list(patterns))
+    if not patterns:
+        return None
+    if patterns not in _compiled_patterns:
+        _compiled_patterns[patterns] = re.compile('|'.join(
+            '(?:%s)' % fnmatch.translate(p) for p in patterns))
+    return _compiled_patterns[patterns]
+
+
+class _DirEntry:
+
+    """ Minimal stand-in for os.DirEntry, for listings served from a
+        DirSnapshotCache
     """
-    max_attempts = 3
-    attempts = 0
+
+    def __init__(self, dir_path, name, is_dir, is_symlink):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        self._is_dir = is_dir
+        self._is_symlink = is_symlink
+
+    def is_dir(self):
+        return self._is_dir
+
+    def is_symlink(self):
+        return self._is_symlink
+
+
+_rmtree_lock = threading.Lock()
+_pending_rmtrees = []
+_failed_rmtrees = []
+_rmtree_exit_registered = False
+_tombstone_ids = itertools.count(1)
+
+
+def _can_remove_in_background():
+    """ multiprocessing children exit without running atexit handlers or
+        waiting for threads, which would leave tombstones behind
+    """
+    return multiprocessing.current_process().name == 'MainProcess'
+
+
+def _get_tombstone_path(path):
+    path = os.path.normpath(path)
+    with _rmtree_lock:
+        tombstone_id = next(_tombstone_ids)
+    return os.path.join(os.path.dirname(path), RMTREE_TOMBSTONE_DIR,
+                        '%s-%d-%d' % (os.path.basename(path), os.getpid(),
+                                      tombstone_id))
+
+
+def _remove_tombstone(tombstone):
+    """ Background thread of rmtree() """
     try:
-        shutil.rmtree(path)
-        attempts += 1
-    except:
-        if attempts < max_attempts:
-            time.sleep(0.5)
+        removed = _remove_tree(tombstone)
+    except Exception:
+        removed = False
+    if removed:
+        try:
+            # fails if other trees are still being removed
+            os.rmdir(os.path.dirname(tombstone))
+        except OSError:
+            pass
+    with _rmtree_lock:
+        if not removed:
+            _failed_rmtrees.append(tombstone)
+        _pending_rmtrees.remove(threading.current_thread())
+
+
+def _remove_tree(path):
+    """ Remove a directory tree, return True if it was removed """
+    delay = RMTREE_RETRY_DELAY
+    for attempt in range(RMTREE_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(delay)
+            delay *= 2
+        files = []
+        dirs = []
+        for root, dirnames, filenames in os.walk(path, topdown=False):
+            files += [os.path.join(root, name) for name in filenames]
+            # os.walk lists symlinks to directories but doesn't enter them
+            files += [os.path.join(root, name) for name in dirnames
+                      if os.path.islink(os.path.join(root, name))]
+            dirs.append(root)
+        if len(files) > RMTREE_PARALLEL_THRESHOLD:
+            pool = ThreadPool(RMTREE_JOBS)
+            try:
+                pool.map(_remove_file, files, chunksize=64)
+            finally:
+                pool.close()
+        else:
+            for file_path in files:
+                _remove_file(file_path)
+        # deepest first
+        for directory in dirs:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+        if not os.path.lexists(path):
+            return True
+    return False
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # read-only files can't be removed on windows
+        try:
+            os.chmod(path, 0o600)
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _unzip_incremental(archive_path, dest, jobs):
+    manifest_path = os.path.join(dest, UNZIP_MANIFEST_NAME)
+    archive_key = _get_stat_key(archive_path)
+    manifest = _read_unzip_manifest(manifest_path)
+    if manifest is not None and manifest[0] == archive_key and \
+            all(_get_stat_key(os.path.join(dest, name)) == entry[2]
+                for name, entry in manifest[1].items()):
+        return []
+    old_entries = manifest[1] if manifest is not None else {}
+    mkdirs(dest)
+
+    archive = zipfile.ZipFile(archive_path, 'r')
+    try:
+        infos = archive.infolist()
+    finally:
+        archive.close()
+    files = []
+    for info in infos:
+        path = _get_extract_path(dest, info.filename)
+        if info.filename.endswith('/'):
+            mkdirs(path)
+        else:
+            files.append((info, path))
+
+    jobs = max(1, min(jobs or multiprocessing.cpu_count(), len(files)))
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(
+            lambda group: _extract_changed(archive_path, group, old_entries),
+            [files[i::jobs] for i in range(jobs)])
+    finally:
+        pool.close()
+
+    entries = {}
+    extracted = []
+    for group_results in results:
+        for name, entry, written in group_results:
+            entries[name] = entry
+            if written:
+                extracted.append(name)
+    _write_unzip_manifest(manifest_path, (archive_key, entries))
+    return sorted(extracted)
+
+
+def _extract_changed(archive_path, files, old_entries):
+    """ Extract the (ZipInfo, path) pairs whose files differ from the
+        entries. Return a list of (name, manifest entry, extracted).
+    """
+    results = []
+    archive = zipfile.ZipFile(archive_path, 'r')
+    try:
+        for info, path in files:
+            stat_key = _get_stat_key(path)
+            old_entry = old_entries.get(info.filename)
+            if stat_key is not None and old_entry is not None and \
+                    old_entry == (info.CRC, info.file_size, stat_key):
+                written = False
+            elif stat_key is not None and stat_key[1] == info.file_size and \
+                    _get_file_crc(path) == info.CRC:
+                written = False
+            else:
+                _extract_entry(archive, info, path)
+                written = True
+            results.append((info.filename,
+                            (info.CRC, info.file_size, _get_stat_key(path)),
+                            written))
+    finally:
+        archive.close()
+    return results
+
+
+def _extract_entry(archive, info, path):
+    """ Extract an entry to path through a temporary file, with the
+        entry's timestamp and unix permissions
+    """
+    directory = os.path.dirname(path) or '.'
+    mkdirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            source = archive.open(info)
+            try:
+                shutil.copyfileobj(source, outfile, ZIP_CHUNK_SIZE)
+            finally:
+                source.close()
+        mode = (info.external_attr >> 16) & 0o777
+        if info.create_system == 3 and mode:
+            os.chmod(tmp_path, mode)
         else:
-            raise Exception('rmtree failed after' + str(max_attempts) + 'attempts')
+            _set_default_mode(tmp_path)
+        timestamp = time.mktime(info.date_time + (0, 0, -1))
+        os.utime(tmp_path, (timestamp, timestamp))
+        replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _get_extract_path(dest, name):
+    """ Return the path to extract an entry to. Raises an exception
+        for names that would be extracted outside dest.
+    """
+    parts = name.split('/')
+    if name.startswith('/') or '..' in parts or ':' in parts[0]:
+        raise Exception('Unsafe path in zip file: ' + name)
+    return os.path.join(dest, *parts)
+
+
+def _get_file_crc(path):
+    crc = 0
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(ZIP_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xffffffff
+
+
+def _get_stat_key(path):
+    """ Return (mtime, size) of a file, None if it doesn't exist """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def _read_unzip_manifest(path):
+    """ Return (archive stat key, {name: (crc, size, stat key)}), None
+        if there is no valid manifest
+    """
+    try:
+        with open(path, 'rb') as infile:
+            version, manifest = pickle.load(infile)
+    except Exception:
+        return None
+    if version != UNZIP_MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def _write_unzip_manifest(path, manifest):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix='.tmp')
+    with os.fdopen(fd, 'wb') as outfile:
+        pickle.dump((UNZIP_MANIFEST_VERSION, manifest), outfile,
+                    pickle.HIGHEST_PROTOCOL)
+    replace(tmp_path, path)
+
+
+def _compress_zip_entry(path, compress_level, store=False):
+    """ Compress a file for zipdir() into a temporary file. Return the
+        temporary file, positioned at its start, the file's CRC, size,
+        compressed size, compression type and whether it's executable.
+    """
+    store = store or \
+        os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS
+    compressor = None if store else \
+        zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    output = tempfile.SpooledTemporaryFile(max_size=4 * ZIP_CHUNK_SIZE)
+    crc = 0
+    size = 0
+    with open(path, 'rb') as infile:
+        executable = bool(os.fstat(infile.fileno()).st_mode & 0o111)
+        for chunk in iter(lambda: infile.read(ZIP_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            output.write(chunk if store else compressor.compress(chunk))
+    if not store:
+        output.write(compressor.flush())
+        if output.tell() >= size:
+            output.close()
+            return _compress_zip_entry(path, compress_level, store=True)
+    compress_size = output.tell()
+    output.seek(0)
+    compress_type = zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED
+    return (output, crc & 0xffffffff, size, compress_size, compress_type,
+            executable)
+
+
+def _write_zip_entry(zipf, name, data, crc, size, compress_size,
+                     compress_type, executable):
+    """ Add data compressed by _compress_zip_entry() to an open zip file.
+        zipfile can only compress entries itself, so this writes the
+        entry's header and data, and registers it to be written to the
+        central directory when the zip file is closed.
+
+        This uses zipfile internals (fp, filelist, NameToInfo, _didModify
+        and start_dir) as they are in python 2.7. test_zipdir checks the
+        archives, including ZIP64 ones, with zipfile and unzip.
+    """
+    zinfo = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+    # unix, whatever system the zip file is made on
+    zinfo.create_system = 3
+    zinfo.external_attr = (0o100755 if executable else 0o100644) << 16
+    zinfo.compress_type = compress_type
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = compress_size
+    zinfo.header_offset = zipf.fp.tell()
+    zipf.fp.write(zinfo.FileHeader())
+    shutil.copyfileobj(data, zipf.fp, ZIP_CHUNK_SIZE)
+    data.close()
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[name] = zinfo
+    zipf._didModify = True
+    zipf.start_dir = zipf.fp.tell()
+
+
+def _sync_file(src, dest):
+    """ Copy src to dest unless dest has the same size and either the
+        same modification time or contents. Return True if it was copied.
+    """
+    src_stat = os.stat(src)
+    try:
+        dest_stat = os.stat(dest)
+    except OSError:
+        dest_stat = None
+    if dest_stat is not None and dest_stat.st_size == src_stat.st_size:
+        if abs(dest_stat.st_mtime - src_stat.st_mtime) < \
+                COPY_MTIME_TOLERANCE or \
+                _same_contents(src, dest):
+            return False
+    dest_dir = os.path.dirname(dest) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            with open(src, 'rb') as infile:
+                _copy_file_data(infile, outfile, src_stat.st_size)
+        shutil.copystat(src, tmp_path)
+        replace(tmp_path, dest)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+
+def _copy_file_data(infile, outfile, size):
+    """ Copy size bytes from infile to outfile, in the kernel if the os
+        supports it
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    in_fd = infile.fileno()
+    out_fd = outfile.fileno()
+    copied = 0
+    try:
+        if copy_file_range is not None:
+            while copied < size:
+                count = copy_file_range(in_fd, out_fd, size - copied)
+                if count == 0:
+                    break
+                copied += count
+            return
+        if sendfile is not None and sys.platform.startswith('linux'):
+            while copied < size:
+                count = sendfile(out_fd, in_fd, copied, size - copied)
+                if count == 0:
+                    break
+                copied += count
+            return
+    except OSError:
+        # eg. not supported by the filesystem
+        if copied > 0:
+            raise
+    shutil.copyfileobj(infile, outfile, ZIP_CHUNK_SIZE)
+
+
+def _get_umask():
+    """ Return the process umask. The only way to read it is to set it,
+        which briefly changes it for every thread, so this is called once
+        at import rather than by the threads that need it.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def _set_default_mode(path):
+    """ Give a file made by tempfile.mkstemp() the permissions of a
+        newly created file, rather than 0600
+    """
+    os.chmod(path, 0o666 & ~_umask)
+
+
+def _same_contents(path1, path2):
+    """ Return True if both files exist and have the same contents """
+    try:
+        if os.path.getsize(path1) != os.path.getsize(path2):
+            return False
+        with open(path1, 'rb') as file1:
+            with open(path2, 'rb') as file2:
+                while True:
+                    chunk = file1.read(ZIP_CHUNK_SIZE)
+                    if chunk != file2.read(ZIP_CHUNK_SIZE):
+                        return False
+                    if not chunk:
+                        return True
+    except (IOError, OSError):
+        return False
+
+
+def _list_dir(path):
+    """ Return a list of directory entries for path, empty if the path
+        can't be listed
+    """
+    listing = _dir_snapshots.get_listing(path)
+    return [_DirEntry(path, *entry) for entry in listing]
+
+
+def _read_dir(path):
+    """ List path, return a list of (name, is_dir, is_symlink) tuples """
+    if _scandir is not None:
+        listing = []
+        for entry in _scandir(path):
+            try:
+                listing.append((entry.name, entry.is_dir(),
+                                entry.is_symlink()))
+            except OSError:
+                pass
+        return listing
+    listing = []
+    for name in os.listdir(path):
+        item = os.path.join(path, name)
+        listing.append((name, os.path.isdir(item), os.path.islink(item)))
+    return listing
+
 
-    # sleep after removing tree as OS delays can cause errors
-    # shortly after this function
-    time.sleep(0.5)
+_dir_snapshots = DirSnapshotCache()
+_umask = _get_umask()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,252 @@
+""" Records how long build tasks take, so that later builds can start the
+    slowest tasks first.
+
+    usage: python task_times.py <times file> [jobs]
+        Print a report of predicted and actual build time for the most
+        recent build recorded in the times file.
+"""
+
+import heapq
+import inspect
+import os
+import sys
+import time
+
+import shutil2
+
+# tasks that can run in parallel with each other
+STAGE_COMPILE = 'compile'
+# tasks that need all compile tasks to finish first, eg. archive and link
+STAGE_LINK = 'link'
+
+
+class TaskTimes:
+
+    """ An append-only record of task run times, shared by all doit
+        processes of a build. Set as the 'task times' variable of a
+        GccEnv to record its tasks' times.
+
+        doit starts tasks in the order they are generated. With task
+        times, compile tasks are generated longest critical path first:
+        the task's own duration plus the durations of the tasks that must
+        wait for it, eg. archiving the arduino core. This keeps a few
+        slow sources from starting last and holding up the link when
+        running with several processes (doit -n).
+
+        Tasks that haven't been timed are estimated to take the mean time
+        of those that have.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # identifies the times recorded by this doit run
+        self.session = '%d.%d' % (time.time() * 1000, os.getpid())
+        self._durations = None
+        self._mean_duration = None
+
+    def run(self, name, action, changed, stage=STAGE_COMPILE):
+        """ doit python-action. Run action, which is either a command
+            argument list or a python-action tuple, and record how long it
+            took if it succeeded. changed is passed on to the python
+            action if it takes it, as doit would.
+        """
+        start = time.time()
+        result = run_action(action, changed)
+        if result is not False:
+            self._record(name, stage, start, time.time())
+        return result
+
+    def get_timed_action(self, name, action, stage=STAGE_COMPILE):
+        """ Return a doit action that runs action and records its time """
+        return (self.run, [name, action], {'stage': stage})
+
+    def get_duration(self, name):
+        """ Return how long the task took the last time it was run, or an
+            estimate if it hasn't been timed
+        """
+        durations = self._get_durations()
+        if name in durations:
+            return durations[name]
+        return self._mean_duration
+
+    def get_priority(self, name, downstream=[]):
+        """ Return the length of the critical path from the start of the
+            task to the end of the build, given the names of the tasks
+            that must wait for it. Higher priority tasks should start
+            first.
+        """
+        return self.get_duration(name) + \
+            sum(self.get_duration(x) for x in downstream)
+
+    def sort_tasks(self, tasks, downstream=[]):
+        """ Return doit tasks in the order they should start, highest
+            priority first. Tasks of equal priority keep their order.
+        """
+        priorities = dict((task['name'], self.get_priority(task['name'],
+                                                           downstream))
+                          for task in tasks)
+        return sorted(tasks, key=lambda task: -priorities[task['name']])
+
+    def get_estimated_makespan(self, compile_names, link_names=[], jobs=1):
+        """ Return the estimated time to run the named compile and link
+            stage tasks with jobs doit processes, longest compile tasks
+            first
+        """
+        durations = sorted((self.get_duration(name) for name in compile_names),
+                           reverse=True)
+        return _get_list_schedule_makespan(durations, jobs) + \
+            sum(self.get_duration(name) for name in link_names)
+
+    def get_makespan_report(self, jobs=1):
+        """ Return a report comparing the time the most recent build took
+            with the time predicted from the builds before it, with the
+            given number of doit processes
+        """
+        records = self._read_records()
+        if not records:
+            return 'No task times recorded in ' + self.path
+        last_session = records[-1][0]
+        history = {}
+        session_records = []
+        for record in records:
+            if record[0] == last_session:
+                session_records.append(record)
+            else:
+                history[record[1]] = record[4] - record[3]
+
+        known = [history[r[1]] for r in session_records if r[1] in history]
+        mean = sum(known) / len(known) if known else 0.0
+        predicted_compile = []
+        predicted_link = 0.0
+        for session, name, stage, start, end in session_records:
+            duration = history.get(name, mean)
+            if stage == STAGE_LINK:
+                predicted_link += duration
+            else:
+                predicted_compile.append(duration)
+        predicted = _get_list_schedule_makespan(
+            sorted(predicted_compile, reverse=True), jobs) + predicted_link
+        actual = max(r[4] for r in session_records) - \
+            min(r[3] for r in session_records)
+
+        lines = [
+            'tasks run:          %d (%d timed before)' % (
+                len(session_records), len(known)),
+            'jobs:               %d' % jobs,
+            'predicted makespan: %.2f s' % predicted,
+            'actual makespan:    %.2f s' % actual,
+        ]
+        if predicted > 0:
+            lines.append('actual / predicted: %.2f' % (actual / predicted))
+        return '\n'.join(lines)
+
+    def get_report_task(self, jobs=1):
+        """ Return a doit task that prints get_makespan_report() """
+        def print_report():
+            print(self.get_makespan_report(jobs))
+        return {
+            'name': 'task times report',
+            'actions': [print_report],
+            'verbosity': 2
+        }
+
+    #------------------------------------------------
+    # private
+
+    def _record(self, name, stage, start, end):
+        """ Append a line to the times file. Small appends are atomic, so
+            this is safe with several doit processes.
+        """
+        line = '%s\t%s\t%s\t%r\t%r\n' % (self.session, name, stage, start,
+                                         end)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def _read_records(self):
+        """ Return a list of (session, name, stage, start, end) in the
+            order they were recorded
+        """
+        if not os.path.isfile(self.path):
+            return []
+        records = []
+        with open(self.path) as infile:
+            for line in infile:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 5:
+                    # partly written
+                    continue
+                try:
+                    records.append((fields[0], fields[1], fields[2],
+                                    float(fields[3]), float(fields[4])))
+                except ValueError:
+                    continue
+        return records
+
+    def _get_durations(self):
+        """ Return a dictionary of task name: latest duration. Read once,
+            so the order of tasks doesn't change during a build.
+        """
+        if self._durations is None:
+            self._durations = {}
+            for session, name, stage, start, end in self._read_records():
+                self._durations[name] = end - start
+            if self._durations:
+                self._mean_duration = sum(self._durations.values()) / \
+                    len(self._durations)
+            else:
+                self._mean_duration = 0.0
+        return self._durations
+
+
+def run_action(action, changed, run_cmd=shutil2.run_cmd):
+    """ Run a doit action the way doit would, and return its result.
+        action is either a command argument list, which is run by run_cmd
+        and succeeds if run_cmd returns 0, or a python-action tuple.
+        Command output is written to sys.stdout and sys.stderr, where doit
+        captures it.
+        changed and run_cmd are passed on to the python-action if it takes
+        them, so that eg. ObjectCache.compile runs its commands through
+        run_cmd too.
+    """
+    if isinstance(action, list):
+        return run_cmd(action) == 0
+    func, args = action[0], action[1]
+    kwargs = dict(action[2]) if len(action) > 2 else {}
+    func_args = inspect.getargspec(func).args
+    if 'changed' in func_args:
+        kwargs['changed'] = changed
+    if 'run_cmd' in func_args:
+        kwargs['run_cmd'] = run_cmd
+    return func(*args, **kwargs)
+
+
+#------------------------------------------------------------------------
+# private functions
+
+
+def _get_list_schedule_makespan(durations, jobs):
+    """ Return the time taken to run tasks of the given durations, in
+        order, each starting as soon as one of jobs workers is free
+    """
+    workers = [0.0] * max(jobs, 1)
+    for duration in durations:
+        heapq.heappush(workers, heapq.heappop(workers) + duration)
+    return max(workers)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    print(TaskTimes(sys.argv[1]).get_makespan_report(jobs))
+
+
+if __name__ == '__main__':
+    main()
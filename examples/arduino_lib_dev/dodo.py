@@ -3,9 +3,11 @@ import os
 import sys
 
 sys.path.append('../..')
+from doit_helpers import file_checker
 from doit_helpers.arduino import env2 as arduino_env
 
-# DOIT_CONFIG = {'default_tasks': ['build_exe']}
+DOIT_CONFIG = {'check_file_uptodate': file_checker.StatChecker}
+# DOIT_CONFIG['default_tasks'] = ['build_exe']
 
 # ---------------------------------------------------------------------
 # Build settings
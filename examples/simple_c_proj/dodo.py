@@ -2,10 +2,12 @@ import sys
 
 sys.path.append('../..')
 
+from doit_helpers import file_checker
 from doit_helpers import file_utils
 from doit_helpers import gcc_utils
 
-DOIT_CONFIG = {'default_tasks': ['run_exe']}
+DOIT_CONFIG = {'default_tasks': ['run_exe'],
+               'check_file_uptodate': file_checker.StatChecker}
 
 BUILD_DIR = 'build'
 SOURCES = file_utils.find('src', ['*.c'])
@@ -0,0 +1,31 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+sys.path.append('..')
+
+from doit_helpers import shutil2
+
+
+class TmpDirTestCase(unittest.TestCase):
+
+    """ Test case with a temporary directory, tmp_dir, that is removed
+        after each test
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, contents):
+        """ Write a file, named relative to tmp_dir, creating its
+            directory if needed. Return its path.
+        """
+        path = os.path.join(self.tmp_dir, name)
+        shutil2.mkdirs(os.path.dirname(path))
+        with open(path, 'w') as outfile:
+            outfile.write(contents)
+        return path
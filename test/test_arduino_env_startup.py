@@ -0,0 +1,75 @@
+import subprocess
+import sys
+import unittest
+sys.path.append('..')
+
+from doit_helpers.arduino import env2
+
+FAKE_ARDUINO_PATH = 'test_data/fake_arduino'
+
+# Maximum number of filesystem accesses allowed while importing
+# doit_helpers.arduino.env2 and constructing an environment. Startup
+# happens whenever a dodo file is loaded, even for 'doit help', so it
+# shouldn't depend on the size of the arduino install.
+STARTUP_FS_ACCESS_BUDGET = 2
+
+# Run in a new process, so the module isn't already imported. Counts calls
+# to the functions used to access the filesystem, and prints the total.
+COUNT_STARTUP_FS_ACCESS_SCRIPT = '''
+import os
+import sys
+sys.path.append('..')
+
+# doit is a dependency rather than part of this package, so is imported
+# before counting starts
+import doit.tools
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+num_accesses = [0]
+
+def counted(func):
+    def wrapper(*args, **kwargs):
+        num_accesses[0] += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+for name in ['stat', 'lstat', 'listdir', 'open', 'access']:
+    setattr(os, name, counted(getattr(os, name)))
+if hasattr(os, 'scandir'):
+    os.scandir = counted(os.scandir)
+try:
+    import scandir
+    scandir.scandir = counted(scandir.scandir)
+except ImportError:
+    pass
+builtins.open = counted(builtins.open)
+
+from doit_helpers.arduino import env2
+env = env2.ArduinoEnv('proj', 'build', %r, 'uno')
+env.set_cpp_source_files(['src/main.cpp'])
+sys.stdout.write(str(num_accesses[0]))
+'''
+
+
+class ArduinoEnvStartupTestCase(unittest.TestCase):
+
+    def test_startup_fs_access_is_within_budget(self):
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             COUNT_STARTUP_FS_ACCESS_SCRIPT % FAKE_ARDUINO_PATH])
+        self.assertTrue(int(output) <= STARTUP_FS_ACCESS_BUDGET,
+                        'startup accessed the filesystem %s times' % output)
+
+    def test_core_is_found_when_tasks_are_requested(self):
+        env = env2.ArduinoEnv('proj', 'build', FAKE_ARDUINO_PATH, 'uno')
+        core_dir = FAKE_ARDUINO_PATH + '/hardware/arduino/cores/arduino'
+        self.assertEqual(
+            [core_dir + '/wiring.c'],
+            env.arduino_core_env.variables['c source files'])
+        self.assertEqual(['build/core/obj/wiring.c.o',
+                          'build/core/obj/main.cpp.o'],
+                         env.arduino_core_env.get_all_objs())
@@ -0,0 +1,92 @@
+import json
+import os
+import sys
+import unittest
+from distutils.spawn import find_executable
+sys.path.append('..')
+
+from doit_helpers import build_trace
+from doit_helpers import gcc_utils
+from doit_helpers import objcache
+from helpers import TmpDirTestCase
+
+
+class FakeCache:
+
+    def __init__(self):
+        self.last_status = None
+
+    def compile(self):
+        self.last_status = 'hit'
+        return True
+
+
+class BuildTraceTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.trace = build_trace.BuildTrace(
+            os.path.join(self.tmp_dir, 'trace'))
+
+    def run_python(self, name, code):
+        return self.trace.run(name, [sys.executable, '-c', code], [])
+
+    def test_commands_are_traced(self):
+        self.assertTrue(self.run_python('ok', 'x = [0] * 1000000'))
+        self.assertFalse(self.run_python('fails', 'import sys; sys.exit(3)'))
+        ok, fails = build_trace.BuildTrace(self.trace.path).get_records()
+        self.assertEqual(('ok', 0, '-'),
+                         (ok['name'], ok['exit_code'], ok['cache']))
+        self.assertEqual(('fails', 3), (fails['name'], fails['exit_code']))
+        self.assertTrue(ok['end'] >= ok['start'])
+        if hasattr(os, 'wait4'):
+            self.assertTrue(ok['cpu'] > 0)
+            self.assertTrue(ok['max_rss'] > 0)
+
+    def test_cache_status_is_traced(self):
+        cache = FakeCache()
+        self.assertTrue(self.trace.run('obj', (cache.compile, []), []))
+        self.assertEqual('hit', self.trace.get_records()[0]['cache'])
+
+    @unittest.skipIf(not hasattr(os, 'wait4') or
+                     find_executable('gcc') is None, 'needs wait4 and gcc')
+    def test_commands_of_python_actions_are_traced(self):
+        # a bigger process first, so the compile's peak memory can't be
+        # told from the peak of all child processes
+        self.run_python('big', 'x = bytearray(200 * 1024 * 1024)')
+        source = os.path.join(self.tmp_dir, 'main.c')
+        with open(source, 'w') as outfile:
+            outfile.write('int main(void) { return 0; }\n')
+        obj = source + '.o'
+        dep = obj + '.d'
+        cmd = ['gcc', '-MMD', '-MF', dep, '-c', '-o', obj, source]
+        cache = objcache.ObjectCache(os.path.join(self.tmp_dir, 'cache'))
+        self.assertTrue(self.trace.run(
+            'obj', (cache.compile, ['gcc', cmd, source, obj, dep]), []))
+        big, compiled = self.trace.get_records()
+        self.assertEqual('miss', compiled['cache'])
+        self.assertTrue(0 < compiled['max_rss'] < big['max_rss'])
+
+    def test_chrome_trace_and_summary(self):
+        self.run_python('fast', 'pass')
+        self.run_python('slow', 'import time; time.sleep(0.2)')
+        chrome_path = os.path.join(self.tmp_dir, 'trace.json')
+        self.trace.write_chrome_trace(chrome_path)
+        with open(chrome_path) as infile:
+            events = json.load(infile)['traceEvents']
+        self.assertEqual(['fast', 'slow'], [e['name'] for e in events])
+        self.assertEqual('X', events[1]['ph'])
+        self.assertTrue(events[1]['dur'] >= 200000)
+
+        summary = self.trace.get_summary(num_tasks=1).splitlines()
+        self.assertTrue(summary[-1].endswith('slow'))
+
+    def test_instrumented_actions_are_traced(self):
+        env = gcc_utils.GccEnv('build')
+        env.variables['c source files'] = ['main.c']
+        env.variables['build trace'] = self.trace
+        task = [t for t in env.get_c_compile_tasks()
+                if t['name'] == 'build/obj/main.c.o'][0]
+        func, args, kwargs = task['actions'][0]
+        self.assertEqual(self.trace.run, func)
+        self.assertEqual('build/obj/main.c.o', args[0])
@@ -0,0 +1,205 @@
+import os
+import subprocess
+import sys
+import unittest
+from StringIO import StringIO
+from distutils.spawn import find_executable
+sys.path.append('..')
+
+from doit_helpers import compile_farm
+from doit_helpers import gcc_utils
+from doit_helpers.arduino import env_due
+from doit_helpers.arduino import env_uno
+from helpers import TmpDirTestCase
+
+
+class SplitCompileCmdTestCase(unittest.TestCase):
+
+    def test_preprocessor_options_stay_local(self):
+        cmd = gcc_utils.get_compile_cmd_args(
+            'src/main.cpp', 'build/obj/main.cpp.o', compiler='g++',
+            defs=['F_CPU=16000000L'], includes=['include'],
+            flags=['-include', 'pch.h', '-c', '-Os', '-MMD', '-x c++'])
+        preprocess_cmd, compile_args, suffix = compile_farm.split_compile_cmd(
+            cmd, 'build/obj/main.cpp.o', 'build/obj/main.cpp.d')
+        self.assertEqual(['g++', '-DF_CPU=16000000L', '-Iinclude',
+                          '-include', 'pch.h', '-Os', '-MMD', '-x', 'c++',
+                          'src/main.cpp', '-MF', 'build/obj/main.cpp.d',
+                          '-MT', 'build/obj/main.cpp.o'], preprocess_cmd)
+        self.assertEqual(['-Os'], compile_args)
+        self.assertEqual('.ii', suffix)
+
+    def test_arduino_flags_are_distributed(self):
+        worker = compile_farm.CompileWorker(port=0, slots=1)
+        try:
+            for hardware in [env_due, env_uno]:
+                env = hardware.get_tool_env('arduino')
+                for language, suffix in [('c', '.i'), ('c++', '.ii')]:
+                    compiler = env[language + ' compiler']
+                    cmd = gcc_utils.get_compile_cmd_args(
+                        'src/main.cpp', 'build/obj/main.cpp.o',
+                        compiler=compiler,
+                        defs=env[language + ' preprocessor defs'],
+                        includes=env[language + ' header search paths'],
+                        flags=env[language + ' compiler flags'])
+                    job = compile_farm.split_compile_cmd(
+                        cmd, 'build/obj/main.cpp.o', 'build/obj/main.cpp.d')
+                    self.assertNotEqual(None, job)
+                    preprocess_cmd, compile_args, job_suffix = job
+                    self.assertEqual(suffix, job_suffix)
+                    if hardware is env_due:
+                        index = compile_args.index('--param')
+                        self.assertEqual('max-inline-insns-single=500',
+                                         compile_args[index + 1])
+                    worker.compilers = [compiler]
+                    self.assertEqual(None, worker.check_job({
+                        'compiler': compiler, 'suffix': suffix,
+                        'args': compile_args}))
+        finally:
+            worker.server_close()
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'needs fork')
+    def test_each_process_starts_at_its_own_worker(self):
+        workers = ['a:1', 'b:2', 'c:3']
+        farm = compile_farm.CompileFarm(workers)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # as in a doit -n process, forked after the farm was created
+            os.write(write_fd, farm._get_workers()[0].encode('ascii'))
+            os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        self.assertEqual(workers[pid % 3],
+                         os.read(read_fd, 100).decode('ascii'))
+        os.close(read_fd)
+
+    def test_worker_refuses_unsafe_options(self):
+        worker = compile_farm.CompileWorker(port=0, slots=1)
+        try:
+            job = {'compiler': 'gcc', 'suffix': '.i'}
+
+            def check(args):
+                return worker.check_job(dict(job, args=args))
+
+            self.assertEqual(None, check(['-Os', '-g', '-w', '-Wall',
+                                          '-mthumb', '-ffunction-sections',
+                                          '-std=c99']))
+            for args in [['--output=/tmp/x.o'], ['-o', '/tmp/x.o'],
+                         ['--dumpdir', '/tmp/'], ['-dumpdir', '/tmp/'],
+                         ['-dumpbase', '/tmp/x'], ['-aux-info', '/tmp/x'],
+                         ['-save-temps'], ['-B/tmp'], ['-fplugin=/tmp/x.so'],
+                         ['-wrapper', 'sh,-c,touch /tmp/x'],
+                         ['-fdump-tree-all=/tmp/x'], ['-Wl,-o,/tmp/x'],
+                         ['@/tmp/args'], ['/tmp/other.i'],
+                         ['--param', '/tmp/x'], ['--param']]:
+                self.assertNotEqual(None, check(args), args)
+        finally:
+            worker.server_close()
+
+    def test_assembler_is_compiled_locally(self):
+        cmd = gcc_utils.get_compile_cmd_args('start.S', 'start.S.o')
+        self.assertEqual(None, compile_farm.split_compile_cmd(
+            cmd, 'start.S.o', 'start.S.d'))
+
+
+@unittest.skipIf(find_executable('gcc') is None, 'needs gcc')
+class CompileFarmTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.worker = compile_farm.CompileWorker(port=0, slots=1)
+        self.worker.start()
+        self.source = self.write('main.c', '#include "thing.h"\n'
+                                 'int main() { return THING; }\n')
+        self.write('thing.h', '#define THING 0\n')
+        self.obj = os.path.join(self.tmp_dir, 'main.c.o')
+        self.dep = os.path.join(self.tmp_dir, 'main.c.d')
+
+    def tearDown(self):
+        self.worker.shutdown()
+        self.worker.server_close()
+        TmpDirTestCase.tearDown(self)
+
+    def compile(self, farm, flags=[]):
+        cmd = gcc_utils.get_compile_cmd_args(self.source, self.obj,
+                                             flags=['-c', '-MMD'] + flags)
+        return farm.compile('gcc', cmd, self.source, self.obj, self.dep)
+
+    def test_compiles_on_worker(self):
+        farm = compile_farm.CompileFarm([self.worker.get_address()])
+        self.assertTrue(self.compile(farm))
+        self.assertEqual(self.worker.get_address(), farm.last_host)
+        self.assertTrue(os.path.getsize(self.obj) > 0)
+        self.assertEqual({self.obj: [self.source, os.path.join(
+            self.tmp_dir, 'thing.h')]}, gcc_utils.read_dependency_file(
+                self.dep))
+
+    def test_options_with_values_are_compiled_on_worker(self):
+        farm = compile_farm.CompileFarm([self.worker.get_address()])
+        self.assertTrue(self.compile(
+            farm, ['--param max-inline-insns-single=500']))
+        self.assertEqual(self.worker.get_address(), farm.last_host)
+
+    def test_compile_errors_fail(self):
+        self.write('thing.h', '#define THING oops\n')
+        farm = compile_farm.CompileFarm([self.worker.get_address()])
+        self.assertFalse(self.compile(farm))
+        self.assertEqual(self.worker.get_address(), farm.last_host)
+
+    def test_preprocessing_errors_are_reported_once(self):
+        self.write('thing.h', '#error no thing\n')
+        farm = compile_farm.CompileFarm([self.worker.get_address()])
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertFalse(self.compile(farm))
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual('localhost', farm.last_host)
+        self.assertEqual(1, errors.count('error: #error no thing'))
+
+    def test_precompiled_headers_are_used_locally(self):
+        pch_dir = os.path.join(self.tmp_dir, 'pch')
+        os.mkdir(pch_dir)
+        stub = os.path.join(pch_dir, 'thing.h')
+        gcc_utils.write_pch_stub(stub, os.path.join(self.tmp_dir, 'thing.h'))
+        subprocess.check_call(['gcc', '-x', 'c-header', '-o', stub + '.gch',
+                               os.path.join(self.tmp_dir, 'thing.h')])
+        farm = compile_farm.CompileFarm([self.worker.get_address()])
+        self.assertTrue(self.compile(farm, ['-include', stub]))
+        self.assertEqual('localhost', farm.last_host)
+
+    def test_falls_back_to_local_compile(self):
+        self.worker.slots.acquire()
+        farm = compile_farm.CompileFarm([self.worker.get_address()])
+        # worker busy
+        self.assertTrue(self.compile(farm))
+        self.assertEqual('localhost', farm.last_host)
+        self.assertEqual(set(), farm._failed)
+
+        # worker can't be reached
+        closed_worker = compile_farm.CompileWorker(port=0)
+        closed_worker.server_close()
+        farm = compile_farm.CompileFarm([closed_worker.get_address()])
+        self.assertTrue(self.compile(farm))
+        self.assertEqual('localhost', farm.last_host)
+        self.assertEqual(set([closed_worker.get_address()]), farm._failed)
+
+    def test_refused_jobs_are_compiled_locally(self):
+        farm = compile_farm.CompileFarm([self.worker.get_address()])
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertTrue(self.compile(farm, ['-Wa,--noexecstack']))
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual('localhost', farm.last_host)
+        self.assertTrue('refused to compile' in errors)
+        self.assertTrue("'-Wa,--noexecstack'" in errors)
+        # the worker is still used for other sources
+        self.assertEqual(set(), farm._failed)
+        self.assertTrue(self.compile(farm))
+        self.assertEqual(self.worker.get_address(), farm.last_host)
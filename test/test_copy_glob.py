@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+sys.path.append('..')
+
+from doit_helpers import shutil2
+from helpers import TmpDirTestCase
+
+
+class CopyGlobTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.src = os.path.join(self.tmp_dir, 'src')
+        self.dest = os.path.join(self.tmp_dir, 'dest')
+        os.mkdir(self.dest)
+        self.write('src/a.h', 'a')
+        self.write('src/b.h', 'b' * 100000)
+        os.mkdir(os.path.join(self.src, 'dir.h'))
+        os.chmod(os.path.join(self.src, 'b.h'), 0o755)
+
+    def copy(self):
+        return shutil2.copy_glob(os.path.join(self.src, '*.h'), self.dest,
+                                 jobs=2)
+
+    def dest_path(self, name):
+        return os.path.join(self.dest, name)
+
+    def test_copies_files(self):
+        report = self.copy()
+        self.assertEqual([self.dest_path('a.h'), self.dest_path('b.h')],
+                         report['copied'])
+        self.assertEqual([], report['skipped'])
+        self.assertEqual(['a.h', 'b.h'], sorted(os.listdir(self.dest)))
+        with open(self.dest_path('b.h')) as infile:
+            self.assertEqual('b' * 100000, infile.read())
+        self.assertEqual(0o755, os.stat(self.dest_path('b.h')).st_mode & 0o777)
+        self.assertAlmostEqual(os.path.getmtime(os.path.join(self.src, 'b.h')),
+                               os.path.getmtime(self.dest_path('b.h')),
+                               places=3)
+
+    def test_unchanged_files_are_skipped(self):
+        self.copy()
+        self.write('src/a.h', 'A')
+        report = self.copy()
+        self.assertEqual([self.dest_path('a.h')], report['copied'])
+        self.assertEqual([self.dest_path('b.h')], report['skipped'])
+        with open(self.dest_path('a.h')) as infile:
+            self.assertEqual('A', infile.read())
+
+        # same contents with another time are skipped, and left alone
+        old_time = time.time() - 60
+        os.utime(self.dest_path('a.h'), (old_time, old_time))
+        report = self.copy()
+        self.assertEqual([], report['copied'])
+        self.assertEqual(int(old_time),
+                         int(os.path.getmtime(self.dest_path('a.h'))))
+
+    def test_no_matches(self):
+        report = shutil2.copy_glob(os.path.join(self.src, '*.c'), self.dest)
+        self.assertEqual({'copied': [], 'skipped': []}, report)
@@ -0,0 +1,57 @@
+import os
+import sys
+sys.path.append('..')
+
+from doit_helpers.arduino import core_cache
+from helpers import TmpDirTestCase
+
+
+class CoreCacheTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.cache = core_cache.CoreCache(os.path.join(self.tmp_dir, 'cache'))
+
+    def test_key_depends_on_settings(self):
+        key = self.cache.get_key('arduino', 'uno', [['-Os']], [])
+        self.assertEqual(key, self.cache.get_key('arduino', 'UNO', [['-Os']], []))
+        self.assertNotEqual(key, self.cache.get_key('arduino', 'uno', [['-O2']], []))
+        self.assertNotEqual(key, self.cache.get_key('arduino', 'due', [['-Os']], []))
+
+    def test_key_depends_on_headers(self):
+        core_dir = os.path.join(self.tmp_dir, 'core')
+        variant_dir = os.path.join(self.tmp_dir, 'variants', 'standard')
+        os.makedirs(os.path.join(core_dir, 'USB'))
+        os.makedirs(variant_dir)
+        source = self.write(os.path.join(core_dir, 'main.cpp'), 'main')
+        self.write(os.path.join(core_dir, 'USB', 'USBAPI.h'), 'usb')
+        pins = self.write(os.path.join(variant_dir, 'pins_arduino.h'), 'pins')
+
+        def get_key():
+            return self.cache.get_key('arduino', 'uno', [], [source],
+                                      [core_dir, variant_dir])
+
+        key = get_key()
+        self.assertEqual(key, get_key())
+        self.write(pins, 'more pins')
+        self.assertNotEqual(key, get_key())
+        key = get_key()
+        self.write(os.path.join(core_dir, 'USB', 'USBAPI.h'), 'more usb')
+        self.assertNotEqual(key, get_key())
+
+    def test_publish(self):
+        core_lib = os.path.join(self.tmp_dir, 'core.a')
+        syscalls = os.path.join(self.tmp_dir, 'syscalls_sam3.c.o')
+        for path in [core_lib, syscalls]:
+            with open(path, 'w') as outfile:
+                outfile.write(path)
+
+        key = self.cache.get_key('arduino', 'due', [], [])
+        self.assertFalse(self.cache.is_cached(key))
+        self.cache.publish(key, core_lib, [syscalls])
+        self.assertTrue(self.cache.is_cached(key))
+        self.assertEqual(['syscalls_sam3.c.o'],
+                         [os.path.basename(p)
+                          for p in self.cache.get_cached_files(key)])
+        with open(self.cache.get_core_lib_path(key)) as infile:
+            self.assertEqual(core_lib, infile.read())
@@ -0,0 +1,3 @@
+#ifndef Arduino_h
+#define Arduino_h
+#endif
@@ -0,0 +1,18 @@
+""" Stands in for gcc in tests. Writes the source and its headers to the
+    object file, and a depfile listing them.
+
+    usage: fake_gcc.py <source> <object> <depfile> [headers...]
+"""
+
+import sys
+
+source, obj, dep = sys.argv[1:4]
+headers = sys.argv[4:]
+
+with open(obj, 'w') as outfile:
+    for path in [source] + headers:
+        with open(path) as infile:
+            outfile.write(infile.read())
+
+with open(dep, 'w') as outfile:
+    outfile.write(obj + ': ' + ' '.join([source] + headers) + '\n')
@@ -0,0 +1,70 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+sys.path.append('..')
+
+from doit_helpers import dep_index
+from doit_helpers import gcc_utils
+from doit_helpers import task_times
+
+DEPENDENCIES = {
+    'build/obj/main.c.o': ['src/main.c', 'src/thing.h', 'src/config.h'],
+    'build/obj/thing.c.o': ['src/thing.c', 'src/config.h'],
+    'build/obj/other.c.o': ['src/other.c'],
+}
+
+
+class DependencyIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = dep_index.DependencyIndex(
+            DEPENDENCIES, {'build/lib.a': ['build/obj/thing.c.o'],
+                           'app.exe': ['build/obj/main.c.o', 'build/lib.a']})
+
+    def test_lookups_in_both_directions(self):
+        self.assertEqual(['build/obj/main.c.o', 'build/obj/thing.c.o'],
+                         self.index.get_dependents('src/config.h'))
+        self.assertEqual(['build/obj/main.c.o'],
+                         self.index.get_dependents(
+                             os.path.abspath('src/thing.h')))
+        self.assertEqual(['src/config.h', 'src/thing.c'],
+                         self.index.get_dependencies('build/obj/thing.c.o'))
+        self.assertEqual([], self.index.get_dependents('src/unused.h'))
+
+    def test_rebuild_set_reaches_link_outputs(self):
+        self.assertEqual(['app.exe', 'build/lib.a', 'build/obj/thing.c.o'],
+                         self.index.get_rebuild_set('src/thing.c'))
+        self.assertEqual(['app.exe', 'build/obj/main.c.o'],
+                         self.index.get_rebuild_set(['src/thing.h']))
+        self.assertEqual([], self.index.get_rebuild_set('build/obj/x.o'))
+
+    def test_rebuild_cost(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'times')
+            with open(path, 'w') as outfile:
+                for name, duration in [('build/obj/main.c.o', 3),
+                                       ('build/obj/thing.c.o', 2),
+                                       ('build/lib.a', 1),
+                                       ('app.exe', 1)]:
+                    outfile.write('s1\t%s\tcompile\t0\t%d\n' % (name,
+                                                                duration))
+            times = task_times.TaskTimes(path)
+            self.assertEqual((7, 5), self.index.get_rebuild_cost(
+                'src/config.h', times, jobs=2))
+            report = self.index.get_rebuild_report(['src/config.h'], times, 2)
+            self.assertTrue('4 targets rebuilt (2 linked)' in report)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_gcc_env_index(self):
+        env = gcc_utils.GccEnv('build')
+        env.variables['c source files'] = ['src/main.c', 'src/thing.c']
+        env._depmap = DEPENDENCIES
+        index = env.get_dependency_index(['app.exe'])
+        self.assertEqual(['app.exe', 'build/obj/main.c.o'],
+                         index.get_rebuild_set('src/thing.h'))
+        task = env.get_dependency_index_task(['app.exe'])
+        self.assertEqual('paths', task['pos_arg'])
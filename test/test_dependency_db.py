@@ -0,0 +1,58 @@
+import os
+import time
+import sys
+sys.path.append('..')
+
+from doit_helpers import gcc_utils
+from helpers import TmpDirTestCase
+
+
+class DependencyDbTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.write_depfile('main.c.o: main.c thing.h\n', time.time() - 60)
+
+    def write_depfile(self, contents, mtime=None):
+        depfile = self.write('main.c.d', contents)
+        if mtime is not None:
+            os.utime(depfile, (mtime, mtime))
+
+    def test_unchanged_depfile_is_not_reparsed(self):
+        db = gcc_utils.DependencyDb()
+        deps = db.get_dependency_dict(self.tmp_dir)
+        self.assertEqual({'main.c.o': ['main.c', 'thing.h']}, deps)
+
+        # a fresh database loads parsed depfiles from disk
+        db = gcc_utils.DependencyDb()
+        parse = gcc_utils.read_dependency_files
+        gcc_utils.read_dependency_files = None
+        try:
+            deps = db.get_dependency_dict(self.tmp_dir)
+        finally:
+            gcc_utils.read_dependency_files = parse
+        self.assertEqual({'main.c.o': ['main.c', 'thing.h']}, deps)
+
+    def test_changed_depfile_is_reparsed(self):
+        db = gcc_utils.DependencyDb()
+        db.get_dependency_dict(self.tmp_dir)
+        self.write_depfile('main.c.o: main.c thing.h other.h\n')
+        deps = db.get_dependency_dict(self.tmp_dir)
+        self.assertEqual({'main.c.o': ['main.c', 'thing.h', 'other.h']}, deps)
+
+    def test_recently_changed_depfile_is_not_cached(self):
+        mtime = time.time()
+        self.write_depfile('main.c.o: main.c thing.h\n', mtime)
+        db = gcc_utils.DependencyDb()
+        db.get_dependency_dict(self.tmp_dir)
+        # changed again within the mtime resolution, with the same size
+        self.write_depfile('main.c.o: main.c other.h\n', mtime)
+        deps = db.get_dependency_dict(self.tmp_dir)
+        self.assertEqual({'main.c.o': ['main.c', 'other.h']}, deps)
+        deps = gcc_utils.DependencyDb().get_dependency_dict(self.tmp_dir)
+        self.assertEqual({'main.c.o': ['main.c', 'other.h']}, deps)
+
+    def test_save_leaves_no_temporary_files(self):
+        gcc_utils.DependencyDb().get_dependency_dict(self.tmp_dir)
+        self.assertEqual(['.depdb', 'main.c.d'],
+                         sorted(os.listdir(self.tmp_dir)))
@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+sys.path.append('..')
+
+from doit_helpers import file_checker
+from helpers import TmpDirTestCase
+
+
+class StatCheckerTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.path = self.write('header.h', 'int x;\n')
+        # as if written long before the build
+        os.utime(self.path, (time.time() - 60, time.time() - 60))
+        file_checker.clear_md5_memo()
+        self.checker = file_checker.StatChecker()
+
+    def check_modified(self, state):
+        return self.checker.check_modified(self.path, os.stat(self.path),
+                                           state)
+
+    def test_unchanged_stat_is_not_hashed(self):
+        state = self.checker.get_state(self.path, None)
+        self.assertEqual(None, self.checker.get_state(self.path, state))
+        file_checker.clear_md5_memo()
+        self.assertFalse(self.check_modified(state))
+        self.assertEqual({}, file_checker._md5_memo)
+
+    def test_touched_file_is_unchanged(self):
+        state = self.checker.get_state(self.path, None)
+        os.utime(self.path, None)
+        self.assertFalse(self.check_modified(state))
+        # saved state is racy, so the content is checked
+        new_state = self.checker.get_state(self.path, state)
+        self.assertEqual(None, new_state[0])
+        self.assertFalse(self.check_modified(new_state))
+
+    def test_changed_content_is_modified(self):
+        state = self.checker.get_state(self.path, None)
+        self.write('header.h', 'int y;\n')
+        self.assertTrue(self.check_modified(state))
+        self.write('header.h', 'int yy;\n')
+        self.assertTrue(self.check_modified(state))
+
+    def test_files_are_hashed_once(self):
+        file_checker.get_file_md5(self.path)
+        stat_key, md5 = file_checker._md5_memo[self.path]
+        file_checker._md5_memo[self.path] = (stat_key, 'remembered')
+        self.assertEqual('remembered', file_checker.get_file_md5(self.path))
+        self.write('header.h', 'changed')
+        self.assertNotEqual('remembered',
+                            file_checker.get_file_md5(self.path))
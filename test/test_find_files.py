@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import sys
+sys.path.append('..')
+
+from doit_helpers import file_utils
+from doit_helpers import shutil2
+from helpers import TmpDirTestCase
+
+
+class FindFilesTestCase(TmpDirTestCase):
+
+    files = [
+        'main.c',
+        'main.h',
+        'readme.txt',
+        'lib/thing.c',
+        'lib/thing.cpp',
+        'lib/test/test_thing.c',
+        'lib/deeper/other.c',
+    ]
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        for name in self.files:
+            self.write(name, '')
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, *name.split('/'))
+
+    def test_top_dir_only(self):
+        found = shutil2.find_files(self.tmp_dir, ['*.c', '*.h'])
+        self.assertEqual(sorted([self.path('main.c'), self.path('main.h')]),
+                         sorted(found))
+
+    def test_subdirs_in_walk_order(self):
+        found = shutil2.find_files(self.tmp_dir, '*.c', search_subdirs=True)
+        expected = []
+        for root, dirnames, filenames in os.walk(self.tmp_dir):
+            expected += [os.path.join(root, f) for f in filenames
+                         if f.endswith('.c')]
+        self.assertEqual(expected, found)
+
+    def test_exclude_by_name(self):
+        found = shutil2.find_files(self.tmp_dir, ['*.c', '*.cpp'], 'test_*',
+                                   search_subdirs=True)
+        self.assertEqual(sorted([self.path('main.c'),
+                                 self.path('lib/thing.c'),
+                                 self.path('lib/thing.cpp'),
+                                 self.path('lib/deeper/other.c')]),
+                         sorted(found))
+
+    def test_exclude_by_path_prunes_dirs(self):
+        searched = []
+        list_dir = shutil2._list_dir
+
+        def recording_list_dir(path):
+            searched.append(path)
+            return list_dir(path)
+
+        shutil2._list_dir = recording_list_dir
+        try:
+            found = file_utils.find(self.tmp_dir, '*.c',
+                                    '*' + os.sep + 'test*',
+                                    search_subdirs=True)
+        finally:
+            shutil2._list_dir = list_dir
+        self.assertEqual(sorted([self.path('main.c'),
+                                 self.path('lib/thing.c'),
+                                 self.path('lib/deeper/other.c')]),
+                         sorted(found))
+        self.assertFalse(self.path('lib/test') in searched)
+
+    def test_missing_path(self):
+        self.assertEqual([], file_utils.find(self.path('nope'), '*.c'))
+
+
+class DirSnapshotCacheTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        open(os.path.join(self.tmp_dir, 'main.c'), 'w').close()
+        self.set_old_mtime(self.tmp_dir, 1000)
+
+    def set_old_mtime(self, path, mtime):
+        os.utime(path, (mtime, mtime))
+
+    def test_listing_reused_until_mtime_changes(self):
+        cache = shutil2.DirSnapshotCache()
+        self.assertEqual([('main.c', False, False)],
+                         cache.get_listing(self.tmp_dir))
+
+        # adding a file without changing the dir mtime isn't noticed
+        open(os.path.join(self.tmp_dir, 'other.c'), 'w').close()
+        self.set_old_mtime(self.tmp_dir, 1000)
+        self.assertEqual(1, len(cache.get_listing(self.tmp_dir)))
+
+        self.set_old_mtime(self.tmp_dir, 2000)
+        self.assertEqual(2, len(cache.get_listing(self.tmp_dir)))
+
+    def test_snapshots_saved_between_runs(self):
+        cache_path = os.path.join(tempfile.mkdtemp(), 'snapshots')
+        try:
+            cache = shutil2.DirSnapshotCache(cache_path)
+            cache.get_listing(self.tmp_dir)
+            cache.save()
+
+            cache = shutil2.DirSnapshotCache(cache_path)
+            read_dir = shutil2._read_dir
+            shutil2._read_dir = None
+            try:
+                listing = cache.get_listing(self.tmp_dir)
+            finally:
+                shutil2._read_dir = read_dir
+            self.assertEqual([('main.c', False, False)], listing)
+        finally:
+            shutil.rmtree(os.path.dirname(cache_path))
+
+    def test_relative_paths_in_other_directories_are_listed(self):
+        cache_path = os.path.join(self.tmp_dir, 'snapshots')
+        cwd = os.getcwd()
+        try:
+            for project, name in [('a', 'a.c'), ('b', 'b.c')]:
+                src_dir = os.path.join(self.tmp_dir, project, 'src')
+                shutil2.mkdirs(src_dir)
+                open(os.path.join(src_dir, name), 'w').close()
+                self.set_old_mtime(src_dir, 1000)
+
+            # both projects share a snapshot file
+            os.chdir(os.path.join(self.tmp_dir, 'a'))
+            cache = shutil2.DirSnapshotCache(cache_path)
+            self.assertEqual([('a.c', False, False)], cache.get_listing('src'))
+            cache.save()
+            os.chdir(os.path.join(self.tmp_dir, 'b'))
+            cache = shutil2.DirSnapshotCache(cache_path)
+            self.assertEqual([('b.c', False, False)], cache.get_listing('src'))
+            cache.save()
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(['a', 'b', 'main.c', 'snapshots'],
+                         sorted(os.listdir(self.tmp_dir)))
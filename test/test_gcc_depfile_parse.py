@@ -1,3 +1,4 @@
+import glob
 import unittest
 import sys
 sys.path.append('..')
@@ -23,3 +24,44 @@ class GccDepfileParsingTestCase(unittest.TestCase):
         for key in deps.keys():
             self.assertEqual(sorted(deps[key]),
                              sorted(self.test_file_1_exp_output[key]))
+
+    def test_parse_escaped_paths_and_multiple_targets(self):
+        deps = gcc_utils.read_dependency_file(
+            'test_data/gcc_dep_files/escaped.c.d')
+        exp_deps = [
+            'src/my file.c',
+            'src/a#b.h',
+            'src/cost$.h',
+            'C:/avr/include/stdio.h',
+        ]
+        self.assertEqual({
+            'build/obj/my file.c.o': exp_deps,
+            'build/obj/my file.c.d': exp_deps,
+        }, deps)
+
+    def test_phony_header_rules_are_ignored(self):
+        deps = gcc_utils.read_dependency_file(
+            'test_data/gcc_dep_files/phony.c.d')
+        self.assertEqual({
+            'build/obj/main.c.o': [
+                'src/main.c', 'src/thing.h', 'C:/avr/include/stdint.h']
+        }, deps)
+
+    def test_batch_parse_interns_paths(self):
+        files = ['test_data/gcc_dep_files/phony.c.d', self.test_file_1]
+        results = gcc_utils.read_dependency_files(files)
+        self.assertEqual(sorted(files), sorted(results.keys()))
+        self.assertEqual(gcc_utils.read_dependency_file(self.test_file_1),
+                         results[self.test_file_1])
+        dep = results[files[0]]['build/obj/main.c.o'][1]
+        self.assertTrue(dep is intern('src/thing.h'))
+
+    def test_pooled_parse_matches_serial_parse(self):
+        files = sorted(glob.glob('test_data/gcc_dep_files/*.d'))
+        serial = gcc_utils.read_dependency_files(files)
+        pooled = gcc_utils.read_dependency_files(files, jobs=2, threshold=0,
+                                                 chunk_size=1)
+        self.assertEqual(serial, pooled)
+        dep = pooled['test_data/gcc_dep_files/phony.c.d'][
+            'build/obj/main.c.o'][1]
+        self.assertTrue(dep is intern('src/thing.h'))
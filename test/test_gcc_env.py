@@ -0,0 +1,184 @@
+import inspect
+import os
+import unittest
+import sys
+from distutils.spawn import find_executable
+sys.path.append('..')
+
+from doit.task import Task
+
+from doit_helpers import gcc_utils
+from doit_helpers import task_times
+from helpers import TmpDirTestCase
+
+
+class GccEnvTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = gcc_utils.GccEnv('build_that_does_not_exist')
+        self.env.variables['c++ source files'] = ['src/main.cpp',
+                                                  'src/thing.cpp']
+
+    def get_tasks_by_name(self, tasks):
+        return dict((task['name'], task) for task in tasks)
+
+    def get_dirs_stamp(self, language):
+        return os.path.join('build_that_does_not_exist', 'obj',
+                            '.dirs_' + language)
+
+    def test_compile_actions_are_argument_lists(self):
+        self.env.variables['c++ compiler flags'] = ['-x c++', '-Os']
+        tasks = self.get_tasks_by_name(self.env.get_cpp_compile_tasks())
+        obj = os.path.join('build_that_does_not_exist', 'obj', 'main.cpp.o')
+        self.assertEqual(['gcc', '-x', 'c++', '-Os', '-c', '-o', obj,
+                          'src/main.cpp'],
+                         tasks[obj]['actions'][0])
+        self.assertEqual('gcc -x c++ -Os -c -o ' + obj + ' src/main.cpp',
+                         gcc_utils.get_compile_cmd_str(
+                             'src/main.cpp', obj,
+                             flags=['-x c++', '-Os']))
+
+    def test_output_dirs_are_created_once(self):
+        tasks = self.get_tasks_by_name(self.env.get_cpp_compile_tasks())
+        stamp = self.get_dirs_stamp('cpp')
+        self.assertEqual([(gcc_utils.create_output_dirs,
+                           [[os.path.join('build_that_does_not_exist', 'obj')],
+                            stamp])],
+                         tasks[stamp]['actions'])
+        for name, task in tasks.items():
+            if name != stamp:
+                self.assertTrue(stamp in task['file_dep'])
+
+    def test_compile_tasks_rebuild_when_command_changes(self):
+        obj = os.path.join('build_that_does_not_exist', 'obj', 'main.cpp.o')
+
+        def is_uptodate(values):
+            """ Check the task as doit would, return whether it's up to
+                date and the values doit would save after running it
+            """
+            tasks = self.get_tasks_by_name(self.env.get_cpp_compile_tasks())
+            checker = tasks[obj]['uptodate'][0]
+            task = Task(obj, [], uptodate=[checker])
+            saved = {}
+            for saver in task.value_savers:
+                saved.update(saver())
+            return checker(task, values), saved
+
+        uptodate, values = is_uptodate({})
+        self.assertFalse(uptodate)
+        self.assertTrue(is_uptodate(values)[0])
+        self.env.variables['c++ preprocessor defs'] = ['DEBUG']
+        self.assertFalse(is_uptodate(values)[0])
+
+    def test_iter_tasks_generates_same_tasks(self):
+        generator = self.env.iter_cpp_compile_tasks()
+        # doit only accepts generators, not other iterables, from a task
+        # creator
+        self.assertTrue(inspect.isgenerator(generator))
+        self.assertEqual([task['name'] for task in
+                          self.env.get_cpp_compile_tasks()],
+                         [task['name'] for task in generator])
+
+    def test_precompiled_headers(self):
+        self.env.variables['c++ precompiled headers'] = ['inc/big.h']
+        tasks = self.get_tasks_by_name(self.env.get_cpp_compile_tasks())
+        gch = os.path.join('build_that_does_not_exist', 'pch', 'c++',
+                           'big.h.gch')
+        obj = os.path.join('build_that_does_not_exist', 'obj',
+                           'main.cpp.o')
+
+        pch_cmd = tasks[gch]['actions'][0]
+        self.assertEqual(['-x', 'c++-header', '-o', gch, 'inc/big.h'],
+                         pch_cmd[-5:])
+        self.assertEqual(['inc/big.h', self.get_dirs_stamp('cpp')],
+                         tasks[gch]['file_dep'])
+        self.assertEqual((gcc_utils.write_pch_stub, [gch[:-4], 'inc/big.h']),
+                         tasks[gch]['actions'][1])
+        self.assertTrue(gch[:-4] in tasks[gch]['targets'])
+
+        compile_cmd = tasks[obj]['actions'][0]
+        include_index = compile_cmd.index('-include')
+        self.assertEqual(gch[:-4], compile_cmd[include_index + 1])
+        self.assertTrue(gch in tasks[obj]['file_dep'])
+
+    def test_paths_with_spaces_stay_whole(self):
+        env = gcc_utils.GccEnv('my build')
+        env.variables['c++ source files'] = ['src/main.cpp']
+        env.variables['c++ precompiled headers'] = ['inc/big.h']
+        env.variables['c++ compiler flags'] = ['-x c++', '-MMD']
+        tasks = self.get_tasks_by_name(env.get_cpp_compile_tasks())
+        gch = os.path.join('my build', 'pch', 'c++', 'big.h.gch')
+        obj = os.path.join('my build', 'obj', 'main.cpp.o')
+
+        pch_cmd = tasks[gch]['actions'][0]
+        self.assertEqual(['-MF', gch + '.d'],
+                         pch_cmd[pch_cmd.index('-MF'):][:2])
+        compile_cmd = tasks[obj]['actions'][0]
+        self.assertEqual(['gcc', '-x', 'c++', '-MMD', '-include', gch[:-4],
+                          '-c', '-o', obj, 'src/main.cpp'], compile_cmd)
+
+    def test_flags_and_defs_keep_shell_quoting(self):
+        cmd = gcc_utils.get_compile_cmd_args(
+            'main.c', 'main.o', defs=['VERSION=\\"1.0\\"', 'MSG="a b"'],
+            flags=['-Wl,-Map,"my dir/x.map"', '-x c'])
+        self.assertEqual(['gcc', '-DVERSION="1.0"', '-DMSG=a b',
+                          '-Wl,-Map,my dir/x.map', '-x', 'c', '-c',
+                          '-o', 'main.o', 'main.c'], cmd)
+        cmd = gcc_utils.get_link_cmd_args('a.elf', ['main.o'],
+                                          flags=["-Wl,-Map,'my dir/x.map'"])
+        self.assertEqual(['gcc', '-Wl,-Map,my dir/x.map', '-o', 'a.elf',
+                          'main.o'], cmd)
+
+    def test_unity_build_batches(self):
+        self.env.variables['c++ source files'] = [
+            'src/a.cpp', 'src/b.cpp', 'src/c.cpp', 'src/syscalls.cpp']
+        self.env.variables['unity build batch size'] = 2
+        self.env.variables['unity build exclude'] = ['syscalls*']
+        obj_dir = os.path.join('build_that_does_not_exist', 'obj')
+        self.assertEqual([os.path.join(obj_dir, 'syscalls.cpp.o'),
+                          os.path.join(obj_dir, 'unity_cpp_0.cpp.o'),
+                          os.path.join(obj_dir, 'unity_cpp_1.cpp.o')],
+                         self.env.get_all_objs())
+
+        tasks = self.get_tasks_by_name(self.env.get_cpp_compile_tasks())
+        unity_source = os.path.join('build_that_does_not_exist', 'unity',
+                                    'unity_cpp_0.cpp')
+        self.assertEqual((gcc_utils.write_unity_source,
+                          [unity_source, ['src/a.cpp', 'src/b.cpp']]),
+                         tasks[unity_source]['actions'][0])
+        batch_task = tasks[os.path.join(obj_dir, 'unity_cpp_0.cpp.o')]
+        self.assertEqual([unity_source, self.get_dirs_stamp('cpp'),
+                          'src/a.cpp', 'src/b.cpp'],
+                         batch_task['file_dep'])
+
+
+@unittest.skipIf(find_executable('g++') is None, 'needs g++')
+class PrecompiledHeaderTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.header = self.write('big.h', '#define BIG 42\n')
+        source = self.write('main.cpp', 'int main() { return BIG - 42; }\n')
+        self.env = gcc_utils.GccEnv(os.path.join(self.tmp_dir, 'build'))
+        self.env.variables['c++ compiler'] = 'g++'
+        self.env.variables['c++ source files'] = [source]
+        self.env.variables['c++ precompiled headers'] = [self.header]
+        self.obj = os.path.join(self.tmp_dir, 'build', 'obj', 'main.cpp.o')
+
+    def run_tasks(self, skip_precompile=False):
+        for task in self.env.get_cpp_compile_tasks():
+            if skip_precompile and task['name'].endswith('.gch'):
+                continue
+            for action in task['actions']:
+                self.assertNotEqual(False,
+                                    task_times.run_action(action, []))
+
+    def test_mismatched_precompiled_header_falls_back_to_header(self):
+        self.env.variables['c++ compiler flags'] = ['-c', '-fexceptions']
+        self.run_tasks()
+        self.assertTrue(os.path.isfile(self.obj))
+        os.remove(self.obj)
+        # the .gch is now invalid for the compile
+        self.env.variables['c++ compiler flags'] = ['-c', '-fno-exceptions']
+        self.run_tasks(skip_precompile=True)
+        self.assertTrue(os.path.isfile(self.obj))
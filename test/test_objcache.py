@@ -0,0 +1,68 @@
+import os
+import sys
+sys.path.append('..')
+
+from doit.task import Task
+
+from doit_helpers import objcache
+from helpers import TmpDirTestCase
+
+FAKE_GCC = os.path.abspath('test_data/fake_compiler/fake_gcc.py')
+
+
+class ObjectCacheTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.cache = objcache.ObjectCache(os.path.join(self.tmp_dir, 'cache'))
+        self.source = self.write('main.c', 'int main() {}\n')
+        self.header = self.write('main.h', '#define THING 1\n')
+        self.obj = os.path.join(self.tmp_dir, 'main.c.o')
+        self.dep = os.path.join(self.tmp_dir, 'main.c.d')
+        self.cmd = ' '.join(['"%s"' % sys.executable, '"%s"' % FAKE_GCC,
+                             self.source, self.obj, self.dep, self.header])
+
+    def compile(self):
+        if os.path.exists(self.obj):
+            os.remove(self.obj)
+        return self.cache.compile(sys.executable, self.cmd, self.source,
+                                  self.obj, self.dep)
+
+    def read_obj(self):
+        with open(self.obj) as infile:
+            return infile.read()
+
+    def test_hit_restores_outputs(self):
+        self.assertTrue(self.compile())
+        self.assertTrue(self.compile())
+        self.assertEqual('int main() {}\n#define THING 1\n', self.read_obj())
+        stats = self.cache.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_compiler_errors_are_captured_by_doit(self):
+        cmd = '"%s" -c "import sys; sys.stderr.write(\'main.c:1: oops\')' \
+            '; sys.exit(1)"' % sys.executable
+        task = Task('compile', [(self.cache.compile, [
+            sys.executable, cmd, self.source, self.obj, self.dep])])
+        task.init_options()
+        action = task.actions[0]
+        self.assertTrue(action.execute() is not None)
+        self.assertEqual('main.c:1: oops', action.err)
+
+    def test_changed_header_misses(self):
+        self.compile()
+        self.write('main.h', '#define THING 2\n')
+        # a new cache instance doesn't remember the old header hash
+        self.cache = objcache.ObjectCache(self.cache.cache_dir)
+        self.compile()
+        self.assertEqual('int main() {}\n#define THING 2\n', self.read_obj())
+        self.assertEqual(2, self.cache.get_stats()['misses'])
+
+    def test_cleanup_evicts_to_max_size(self):
+        self.compile()
+        self.cache.max_size = 0
+        self.cache.cleanup()
+        self.assertEqual(0, self.cache.get_stats()['size'])
+        self.compile()
+        self.assertEqual(0, self.cache.get_stats()['hits'])
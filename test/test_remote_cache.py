@@ -0,0 +1,75 @@
+import os
+import socket
+import sys
+sys.path.append('..')
+
+from doit_helpers import objcache
+from doit_helpers import remote_cache
+from helpers import TmpDirTestCase
+
+FAKE_GCC = os.path.abspath('test_data/fake_compiler/fake_gcc.py')
+
+
+class RemoteCacheTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.server = remote_cache.CacheServer(
+            os.path.join(self.tmp_dir, 'server'), port=0)
+        self.server.start()
+        self.source = self.write('main.c', 'int main() {}\n')
+        self.header = self.write('main.h', '#define THING 1\n')
+        self.obj = os.path.join(self.tmp_dir, 'main.c.o')
+        self.dep = os.path.join(self.tmp_dir, 'main.c.d')
+        self.cmd = [sys.executable, FAKE_GCC, self.source, self.obj,
+                    self.dep, self.header]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        TmpDirTestCase.tearDown(self)
+
+    def make_cache(self, name, read_only=False, url=None):
+        """ Return an object cache as used by another machine """
+        remote = remote_cache.RemoteStore(url or self.server.get_url(),
+                                          read_only, timeout=1.0)
+        return objcache.ObjectCache(os.path.join(self.tmp_dir, name),
+                                    remote=remote)
+
+    def compile(self, cache):
+        for path in [self.obj, self.dep]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.assertTrue(cache.compile(sys.executable, self.cmd, self.source,
+                                      self.obj, self.dep))
+        return cache.last_status
+
+    def test_objects_are_shared(self):
+        self.assertEqual('miss', self.compile(self.make_cache('a')))
+        other = self.make_cache('b')
+        self.assertEqual('remote hit', self.compile(other))
+        with open(self.obj) as infile:
+            self.assertEqual('int main() {}\n#define THING 1\n',
+                             infile.read())
+        # and is kept in the local cache
+        self.assertEqual('hit', self.compile(other))
+        self.assertEqual(1, other.get_stats()['remote hits'])
+
+        self.write('main.h', '#define THING 2\n')
+        self.assertEqual('miss', self.compile(self.make_cache('c')))
+
+    def test_read_only_doesnt_upload(self):
+        self.assertEqual('miss', self.compile(self.make_cache('a', True)))
+        self.assertEqual('miss', self.compile(self.make_cache('b')))
+        self.assertEqual('remote hit',
+                         self.compile(self.make_cache('c', True)))
+
+    def test_unreachable_server_falls_back_to_compiling(self):
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        url = 'http://localhost:%d' % sock.getsockname()[1]
+        sock.close()
+        cache = self.make_cache('a', url=url)
+        self.assertEqual('miss', self.compile(cache))
+        self.assertTrue(cache.remote.disabled)
+        self.assertEqual('hit', self.compile(cache))
@@ -0,0 +1,88 @@
+import multiprocessing
+import os
+import sys
+import threading
+import time
+sys.path.append('..')
+
+from doit_helpers import file_utils, shutil2
+from helpers import TmpDirTestCase
+
+
+class RmtreeTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.tree = os.path.join(self.tmp_dir, 'build')
+        self.make_tree(self.tree, 10)
+
+    def make_tree(self, path, num_files):
+        for i in range(num_files):
+            directory = os.path.join(path, 'd%d' % (i % 7), 'sub')
+            shutil2.mkdirs(directory)
+            open(os.path.join(directory, 'f%d' % i), 'w').close()
+        os.symlink(self.tmp_dir, os.path.join(path, 'link'))
+
+    def test_tree_is_removed_in_background(self):
+        shutil2.rmtree(self.tree)
+        # the path is free straight away
+        self.assertFalse(os.path.exists(self.tree))
+        os.mkdir(self.tree)
+        self.assertEqual([], shutil2.wait_for_rmtrees())
+        self.assertEqual(['build'], os.listdir(self.tmp_dir))
+
+    def test_wait(self):
+        shutil2.rmtree(self.tree, wait=True)
+        self.assertEqual([], os.listdir(self.tmp_dir))
+        # missing trees are ignored
+        shutil2.rmtree(self.tree)
+
+    def test_large_trees_are_removed_in_parallel(self):
+        big_tree = os.path.join(self.tmp_dir, 'big')
+        self.make_tree(big_tree, shutil2.RMTREE_PARALLEL_THRESHOLD + 100)
+        shutil2.rmtree(big_tree)
+        shutil2.rmtree(self.tree)
+        self.assertEqual([], shutil2.wait_for_rmtrees())
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+    def test_removed_files_are_not_found(self):
+        # hold up the background removal
+        removing = threading.Event()
+        remove_tree = shutil2._remove_tree
+
+        def wait_and_remove_tree(path):
+            removing.wait()
+            return remove_tree(path)
+        shutil2._remove_tree = wait_and_remove_tree
+        try:
+            shutil2.rmtree(self.tree)
+            self.assertEqual([], file_utils.find(self.tmp_dir, '*',
+                                                 search_subdirs=True))
+            zip_path = os.path.join(self.tmp_dir, 'all.zip')
+            shutil2.zipdir(self.tmp_dir, zip_path)
+            self.assertEqual([], shutil2.zipfile.ZipFile(zip_path).namelist())
+            os.remove(zip_path)
+        finally:
+            removing.set()
+            shutil2._remove_tree = remove_tree
+        self.assertEqual([], shutil2.wait_for_rmtrees())
+        self.assertEqual([], os.listdir(self.tmp_dir))
+
+    def test_child_processes_remove_trees_before_exiting(self):
+        # slow down the removal, so a background thread wouldn't finish
+        # before the child exits
+        remove_tree = shutil2._remove_tree
+
+        def slow_remove_tree(path):
+            time.sleep(0.2)
+            return remove_tree(path)
+        shutil2._remove_tree = slow_remove_tree
+        try:
+            child = multiprocessing.Process(target=shutil2.rmtree,
+                                            args=(self.tree,))
+            child.start()
+            child.join()
+        finally:
+            shutil2._remove_tree = remove_tree
+        self.assertEqual(0, child.exitcode)
+        self.assertEqual([], os.listdir(self.tmp_dir))
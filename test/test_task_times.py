@@ -0,0 +1,70 @@
+import os
+import sys
+sys.path.append('..')
+
+from doit_helpers import gcc_utils
+from doit_helpers import task_times
+from helpers import TmpDirTestCase
+
+
+class TaskTimesTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.path = os.path.join(self.tmp_dir, 'times')
+
+    def write_records(self, records):
+        with open(self.path, 'a') as outfile:
+            for record in records:
+                outfile.write('\t'.join(str(x) for x in record) + '\n')
+
+    def test_run_records_successful_actions(self):
+        times = task_times.TaskTimes(self.path)
+        self.assertTrue(times.run('good', (lambda: True, []), []))
+        self.assertFalse(times.run('bad', (lambda: False, []), []))
+        times = task_times.TaskTimes(self.path)
+        self.assertTrue(times.get_duration('good') >= 0)
+        self.assertEqual([('good', task_times.STAGE_COMPILE)],
+                         [(r[1], r[2]) for r in times._read_records()])
+
+    def test_run_action_passes_changed(self):
+        def action(value, changed, extra=None):
+            return (value, changed, extra)
+        self.assertEqual((1, ['a.o'], 2), task_times.run_action(
+            (action, [1], {'extra': 2}), ['a.o']))
+        self.assertEqual(1, task_times.run_action((lambda x: x, [1]), []))
+        self.assertTrue(task_times.run_action(
+            [sys.executable, '-c', 'pass'], []))
+        self.assertFalse(task_times.run_action(
+            [sys.executable, '-c', 'import sys; sys.exit(1)'], []))
+
+        def run_cmd(cmd):
+            return 0
+        self.assertEqual(run_cmd, task_times.run_action(
+            (lambda run_cmd: run_cmd, []), [], run_cmd))
+
+    def test_longest_tasks_are_generated_first(self):
+        self.write_records([('s1', 'build/obj/a.c.o', 'compile', 0, 1),
+                            ('s1', 'build/obj/b.c.o', 'compile', 0, 5),
+                            ('s1', 'build/obj/c.c.o', 'compile', 0, 3)])
+        env = gcc_utils.GccEnv('build')
+        env.variables['c source files'] = ['a.c', 'b.c', 'new.c', 'c.c']
+        env.variables['task times'] = task_times.TaskTimes(self.path)
+        names = [task['name'] for task in env.get_c_compile_tasks()
+                 if task['name'].endswith('.o')]
+        # new.c hasn't been timed, so is estimated at the mean, 3
+        self.assertEqual(['build/obj/b.c.o', 'build/obj/new.c.o',
+                          'build/obj/c.c.o', 'build/obj/a.c.o'], names)
+
+    def test_makespan_report(self):
+        self.write_records([('s1', 'a', 'compile', 0, 4),
+                            ('s1', 'b', 'compile', 0, 1),
+                            ('s1', 'c', 'compile', 1, 2),
+                            ('s1', 'exe', 'link', 4, 5),
+                            ('s2', 'a', 'compile', 10, 14),
+                            ('s2', 'b', 'compile', 10, 11),
+                            ('s2', 'c', 'compile', 11, 12),
+                            ('s2', 'exe', 'link', 14, 16)])
+        report = task_times.TaskTimes(self.path).get_makespan_report(jobs=2)
+        self.assertTrue('predicted makespan: 5.00 s' in report)
+        self.assertTrue('actual makespan:    6.00 s' in report)
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+import time
+import unittest
+from distutils.spawn import find_executable
+sys.path.append('..')
+
+from doit.task import Task
+
+from doit_helpers import gcc_utils
+from helpers import TmpDirTestCase
+
+
+@unittest.skipIf(find_executable('ar') is None, 'needs GNU ar')
+class UpdateArchiveTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.archive = os.path.join(self.tmp_dir, 'core.a')
+        self.objs = [self.write('a.o', 'a'), self.write('b.o', 'b'),
+                     self.write('c.o', 'c')]
+
+    def update(self, objs, changed=None, deterministic=False):
+        self.assertTrue(gcc_utils.update_archive(
+            'ar', self.archive, objs, deterministic=deterministic,
+            changed=changed))
+
+    def get_members(self):
+        output = subprocess.check_output(['ar', 't', self.archive])
+        return output.decode('ascii').split()
+
+    def get_member_contents(self, member):
+        return subprocess.check_output(
+            ['ar', 'p', self.archive, member]).decode('ascii')
+
+    def read_archive(self):
+        with open(self.archive, 'rb') as infile:
+            return infile.read()
+
+    def test_only_changed_members_are_replaced(self):
+        self.update(self.objs)
+        self.write('b.o', 'new b')
+        # if all objects were archived again, a.o would have this content
+        self.write('a.o', 'unchanged a')
+        self.update(self.objs, changed=[self.objs[1]])
+        self.assertEqual(['a.o', 'b.o', 'c.o'], self.get_members())
+        self.assertEqual('a', self.get_member_contents('a.o'))
+        self.assertEqual('new b', self.get_member_contents('b.o'))
+
+    def test_changed_is_filled_in_by_doit(self):
+        self.update(self.objs)
+        self.write('b.o', 'new b')
+        self.write('a.o', 'unchanged a')
+        task = Task('archive', [(gcc_utils.update_archive,
+                                 ['ar', self.archive, self.objs])],
+                    file_dep=self.objs)
+        task.init_options()
+        task.dep_changed = [self.objs[1]]
+        action = task.actions[0]
+        self.assertEqual(None, action.execute())
+        self.assertEqual('a', self.get_member_contents('a.o'))
+        self.assertEqual('new b', self.get_member_contents('b.o'))
+
+    def test_removed_objects_are_removed_from_archive(self):
+        self.update(self.objs)
+        self.update(self.objs[:2], changed=[])
+        self.assertEqual(['a.o', 'b.o'], self.get_members())
+
+    def test_deterministic_archives_are_identical(self):
+        self.update(self.objs, deterministic=True)
+        first = self.read_archive()
+        os.remove(self.archive)
+        time.sleep(1)
+        for obj in self.objs:
+            os.utime(obj, None)
+        self.update(self.objs, deterministic=True)
+        self.assertEqual(first, self.read_archive())
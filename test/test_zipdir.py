@@ -0,0 +1,195 @@
+import gzip
+import os
+import subprocess
+import sys
+import time
+import zipfile
+from distutils.spawn import find_executable
+sys.path.append('..')
+
+from doit_helpers import shutil2
+from helpers import TmpDirTestCase
+
+
+class ZipdirTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.src = os.path.join(self.tmp_dir, 'src')
+        self.dest = os.path.join(self.tmp_dir, 'out', 'src.zip')
+        self.write('src/b.txt', 'b' * 10000)
+        self.write('src/a/c.txt', 'c')
+        self.write('src/tool.sh', '#!/bin/sh\n')
+        os.chmod(os.path.join(self.src, 'tool.sh'), 0o755)
+        with gzip.open(os.path.join(self.src, 'data.gz'), 'wb') as outfile:
+            outfile.write(b'd' * 10000)
+
+    def read_dest(self):
+        with open(self.dest, 'rb') as infile:
+            return infile.read()
+
+    def test_entries(self):
+        shutil2.zipdir(self.src, self.dest, jobs=2)
+        archive = zipfile.ZipFile(self.dest)
+        self.assertEqual(None, archive.testzip())
+        infos = archive.infolist()
+        self.assertEqual(['a/c.txt', 'b.txt', 'data.gz', 'tool.sh'],
+                         [i.filename for i in infos])
+        self.assertEqual('b' * 10000, archive.read('b.txt').decode('ascii'))
+        types = dict((i.filename, i.compress_type) for i in infos)
+        self.assertEqual(zipfile.ZIP_DEFLATED, types['b.txt'])
+        self.assertEqual(zipfile.ZIP_STORED, types['data.gz'])
+        # too small to get smaller
+        self.assertEqual(zipfile.ZIP_STORED, types['a/c.txt'])
+        modes = dict((i.filename, i.external_attr >> 16) for i in infos)
+        self.assertEqual(0o100755, modes['tool.sh'])
+        self.assertEqual(0o100644, modes['b.txt'])
+        self.assertEqual(set([shutil2.ZIP_DATE_TIME]),
+                         set(i.date_time for i in infos))
+        archive.close()
+
+    def test_unchanged_files_give_identical_archive(self):
+        shutil2.zipdir(self.src, self.dest)
+        contents = self.read_dest()
+        old_time = time.time() - 60
+        os.utime(self.dest, (old_time, old_time))
+        os.utime(os.path.join(self.src, 'b.txt'), None)
+        shutil2.zipdir(self.src, self.dest, jobs=1)
+        self.assertEqual(contents, self.read_dest())
+        # not rewritten
+        self.assertEqual(int(old_time), int(os.path.getmtime(self.dest)))
+
+        self.write('src/b.txt', 'changed')
+        shutil2.zipdir(self.src, self.dest)
+        self.assertNotEqual(contents, self.read_dest())
+
+    def test_zip64_archives_are_valid(self):
+        limits = (zipfile.ZIP64_LIMIT, zipfile.ZIP_FILECOUNT_LIMIT)
+        # as if the files were over 4 GB, and there were over 65535 of them
+        zipfile.ZIP64_LIMIT = 1000
+        zipfile.ZIP_FILECOUNT_LIMIT = 2
+        try:
+            shutil2.zipdir(self.src, self.dest, jobs=2)
+        finally:
+            zipfile.ZIP64_LIMIT, zipfile.ZIP_FILECOUNT_LIMIT = limits
+        archive = zipfile.ZipFile(self.dest)
+        self.assertEqual(None, archive.testzip())
+        self.assertEqual('b' * 10000, archive.read('b.txt').decode('ascii'))
+        self.assertEqual(4, len(archive.namelist()))
+        archive.close()
+        if find_executable('unzip') is not None:
+            self.assertEqual(0, subprocess.call(
+                ['unzip', '-tqq', self.dest]))
+
+    def test_files_are_compressed_a_few_ahead(self):
+        for i in range(50):
+            self.write('src/many/%02d.txt' % i, 'x' * 100)
+        counts = {'pending': 0, 'max': 0}
+        compress = shutil2._compress_zip_entry
+        write = shutil2._write_zip_entry
+
+        def counting_compress(path, compress_level, store=False):
+            if not store:
+                counts['pending'] += 1
+                counts['max'] = max(counts['max'], counts['pending'])
+            return compress(path, compress_level, store)
+
+        def counting_write(*args):
+            counts['pending'] -= 1
+            return write(*args)
+
+        shutil2._compress_zip_entry = counting_compress
+        shutil2._write_zip_entry = counting_write
+        try:
+            shutil2.zipdir(self.src, self.dest, jobs=2)
+        finally:
+            shutil2._compress_zip_entry = compress
+            shutil2._write_zip_entry = write
+        self.assertEqual(0, counts['pending'])
+        self.assertTrue(counts['max'] <= 4, counts['max'])
+        self.assertEqual(54, len(zipfile.ZipFile(self.dest).namelist()))
+
+    def test_dest_inside_path_is_skipped(self):
+        dest = os.path.join(self.src, 'self.zip')
+        shutil2.zipdir(self.src, dest)
+        shutil2.zipdir(self.src, dest)
+        names = zipfile.ZipFile(dest).namelist()
+        self.assertFalse('self.zip' in names)
+        self.assertEqual([], [n for n in names if '.tmp' in n])
+
+
+class IncrementalUnzipTestCase(TmpDirTestCase):
+
+    def setUp(self):
+        TmpDirTestCase.setUp(self)
+        self.archive = os.path.join(self.tmp_dir, 'bundle.zip')
+        self.dest = os.path.join(self.tmp_dir, 'dest')
+        self.make_archive({'a.txt': 'a', 'dir/b.txt': 'b', 'dir/c.txt': 'c'})
+
+    def make_archive(self, files, create_system=3):
+        archive = zipfile.ZipFile(self.archive, 'w')
+        for name, contents in sorted(files.items()):
+            info = zipfile.ZipInfo(name, (2010, 6, 1, 12, 0, 0))
+            info.create_system = create_system
+            if create_system == 3:
+                info.external_attr = 0o100755 << 16
+            archive.writestr(info, contents)
+        archive.close()
+
+    def unzip(self):
+        return shutil2.unzip(self.archive, self.dest, incremental=True,
+                             jobs=2)
+
+    def test_only_changed_entries_are_extracted(self):
+        self.assertEqual(['a.txt', 'dir/b.txt', 'dir/c.txt'], self.unzip())
+        a_path = os.path.join(self.dest, 'a.txt')
+        self.assertEqual(time.mktime((2010, 6, 1, 12, 0, 0, 0, 0, -1)),
+                         os.path.getmtime(a_path))
+        self.assertEqual(0o755, os.stat(a_path).st_mode & 0o777)
+        # unchanged archive, found from the manifest
+        self.assertEqual([], self.unzip())
+
+        self.make_archive({'a.txt': 'a', 'dir/b.txt': 'B', 'dir/c.txt': 'c',
+                           'd.txt': 'd'})
+        self.assertEqual(['d.txt', 'dir/b.txt'], self.unzip())
+        with open(os.path.join(self.dest, 'dir', 'b.txt')) as infile:
+            self.assertEqual('B', infile.read())
+
+    def test_umask_is_left_alone_by_extract_threads(self):
+        # made on windows, so files get the default permissions
+        self.make_archive(dict(('dir%d/f.txt' % i, 'x') for i in range(50)),
+                          create_system=0)
+        umask = os.umask(0o022)
+        umask_calls = []
+
+        def record_umask(mask):
+            umask_calls.append(mask)
+            return real_umask(mask)
+        real_umask, os.umask = os.umask, record_umask
+        try:
+            self.unzip()
+        finally:
+            os.umask = real_umask
+            os.umask(umask)
+        self.assertEqual([], umask_calls)
+        for i in range(50):
+            path = os.path.join(self.dest, 'dir%d' % i)
+            self.assertEqual(0, os.stat(path).st_mode & 0o002)
+            self.assertEqual(0o666 & ~shutil2._umask, os.stat(os.path.join(
+                path, 'f.txt')).st_mode & 0o777)
+
+    def test_changed_files_are_restored(self):
+        self.unzip()
+        with open(os.path.join(self.dest, 'dir', 'c.txt'), 'w') as outfile:
+            outfile.write('edited')
+        self.assertEqual(['dir/c.txt'], self.unzip())
+
+        # without a manifest, files are compared by CRC
+        os.remove(os.path.join(self.dest, shutil2.UNZIP_MANIFEST_NAME))
+        self.assertEqual([], self.unzip())
+
+    def test_unsafe_paths_are_refused(self):
+        self.make_archive({'../evil.txt': 'x'})
+        self.assertRaises(Exception, self.unzip)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir,
+                                                     'evil.txt')))